@@ -0,0 +1,218 @@
+#    genre.guide - Benchmarks: Track and subgenre syncs against fake backends
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from os import devnull, environ
+
+# The tab names are read from the environment when sheet_to_db is imported, so they need to be there first
+environ.setdefault("CATALOG_SHEET_NAME", "Main")
+environ.setdefault("GENRES_SHEET_NAME", "Genres")
+environ.setdefault("GENRE_INFO_SHEET_NAME", "Genre Info")
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from json import dump, load
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List, Optional, TypedDict
+
+from ..sheet_to_db import GENRE_INFO_SHEET_NAME, GENRE_SHEET_CATALOG_SHEET_NAME, GENRES_SHEET_NAME, SHEETS_MAX_CONCURRENT_REQUESTS
+from ..sheet_to_db.fakes import FakeAPI, FakeFirestore
+from ..sheet_to_db.metrics import StageReport, start_run
+from ..sheet_to_db.quota import RequestScheduler
+from ..sheet_to_db.sinks import JSONLSink, LocalSink, SQLiteSink
+from ..sheet_to_db.subgenres import build_up_subgenre_information, seed_firestore_with_subgenre_data, subgenre_table_from_sheet
+from ..sheet_to_db.tracks import build_up_track_information, seed_firestore_with_track_data
+from .synthetic import genre_color_sheet, NEWEST_RELEASE, OLDEST_RELEASE, track_sheets
+
+try:
+	from resource import getrusage, RUSAGE_SELF
+except ImportError:
+	# Not available on Windows
+	getrusage = None  # type: ignore
+
+
+class BenchmarkOptions(TypedDict):
+	latency: float
+	sheets_quota_error_rate: float
+	firestore_quota_error_rate: float
+	transform_workers: int
+	# fake-firestore, sqlite, or jsonl
+	sink: str
+
+
+class BenchmarkResult(TypedDict):
+	name: str
+	rows: int
+	seconds: float
+	rows_per_second: float
+	# How much the process grew while the sync was running (None if that can't be measured here)
+	peak_memory_mb: Optional[float]
+	calls: Dict[str, int]
+	quota_errors: int
+	documents_written: int
+	stages: Dict[str, StageReport]
+
+
+def max_rss_mb() -> Optional[float]:
+	if getrusage is None:
+		return None
+
+	from sys import platform
+	# Kilobytes on Linux, bytes on macOS
+	return getrusage(RUSAGE_SELF).ru_maxrss / (1024 * 1024 if platform == "darwin" else 1024)
+
+
+def run_benchmark(kind: str, rows: int, options: BenchmarkOptions) -> BenchmarkResult:
+	"""Runs one sync against freshly made fake backends (meant to be run in a process of its own,
+	   so that caches and memory from one benchmark don't carry over to the next)"""
+
+	sheets_api = FakeAPI(latency=options["latency"], quota_error_rate=options["sheets_quota_error_rate"], seed=1)
+	firestore_api = FakeAPI(latency=options["latency"], quota_error_rate=options["firestore_quota_error_rate"], seed=2)
+	# Quota errors get retried like they would be for real, but the fake Sheets has no quota to pace requests to
+	scheduler = RequestScheduler("sheets", [], max_concurrent=SHEETS_MAX_CONCURRENT_REQUESTS, initial_backoff=0.05, seed=3)
+	# Holding onto every document would count towards the sync's memory
+	firestore = FakeFirestore(firestore_api, keep_documents=False)
+	scratch = TemporaryDirectory()
+	local_sink: Optional[LocalSink] = None
+	if options["sink"] == "sqlite":
+		local_sink = SQLiteSink(Path(scratch.name) / "documents.sqlite3")
+	elif options["sink"] == "jsonl":
+		local_sink = JSONLSink(Path(scratch.name))
+	sink = firestore if local_sink is None else local_sink
+
+	# The same family tree that the synthetic tracks' subgenres come from, made ahead of time like the cached one would be
+	if kind == "tracks":
+		with open(devnull, "w") as nowhere, redirect_stdout(nowhere):
+			subgenre_table = subgenre_table_from_sheet(genre_color_sheet(FakeAPI(), 500, genres_sheet_name=str(GENRES_SHEET_NAME),
+			                                                             genre_info_sheet_name=str(GENRE_INFO_SHEET_NAME)))
+
+	run = start_run(f"{kind}-{rows}")
+	memory_before = max_rss_mb()
+	start_time = perf_counter()
+
+	# Printing isn't what's being measured
+	with open(devnull, "w") as nowhere, redirect_stdout(nowhere):
+		if kind == "tracks":
+			genre_sheet, subgenre_sheet = track_sheets(sheets_api, rows, catalog_sheet_name=str(GENRE_SHEET_CATALOG_SHEET_NAME), scheduler=scheduler)
+			tracks = build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE)
+			seed_firestore_with_track_data(sink, tracks, transform_workers=options["transform_workers"], subgenre_table=subgenre_table)  # type: ignore
+		elif kind == "subgenres":
+			genre_sheet = genre_color_sheet(sheets_api, rows, genres_sheet_name=str(GENRES_SHEET_NAME),
+			                                genre_info_sheet_name=str(GENRE_INFO_SHEET_NAME), scheduler=scheduler)
+			subgenre_data, aliases = build_up_subgenre_information(genre_sheet)
+			seed_firestore_with_subgenre_data(sink, subgenre_data, aliases)  # type: ignore
+		else:
+			raise ValueError(f"there's no benchmark for {kind}")
+
+	seconds = perf_counter() - start_time
+	memory_after = max_rss_mb()
+
+	if local_sink is not None:
+		local_sink.close()
+	scratch.cleanup()
+
+	return {
+		"name": f"{kind}-{rows}",
+		"rows": rows,
+		"seconds": seconds,
+		"rows_per_second": rows / seconds,
+		"peak_memory_mb": None if memory_before is None or memory_after is None else memory_after - memory_before,
+		"calls": dict(sheets_api.calls + firestore_api.calls),
+		"quota_errors": sheets_api.quota_errors + firestore_api.quota_errors,
+		"documents_written": firestore.writes if local_sink is None else run.counters["firestore.writes"],
+		"stages": run.report()["stages"],
+	}
+
+
+def regressions(results: List[BenchmarkResult], baseline: List[BenchmarkResult], tolerance: float) -> List[str]:
+	"""What got slower than the baseline by more than tolerance (a fraction), or started making more API calls"""
+
+	baseline_by_name = {result["name"]: result for result in baseline}
+	problems: List[str] = []
+
+	for result in results:
+		before = baseline_by_name.get(result["name"])
+		if before is None:
+			continue
+
+		if result["rows_per_second"] < before["rows_per_second"] * (1 - tolerance):
+			problems.append(f"{result['name']} went from {before['rows_per_second']:,.0f} to {result['rows_per_second']:,.0f} rows/s")
+
+		for call, count in result["calls"].items():
+			if count > before["calls"].get(call, 0):
+				problems.append(f"{result['name']} went from {before['calls'].get(call, 0)} to {count} {call} calls")
+
+	return problems
+
+
+def print_result(result: BenchmarkResult) -> None:
+	memory = "?" if result["peak_memory_mb"] is None else f"{result['peak_memory_mb']:,.1f} MB"
+	calls = ", ".join(f"{call} ×{count}" for call, count in sorted(result["calls"].items()))
+	print(f"{result['name']:>18}: {result['seconds']:8.2f} s, {result['rows_per_second']:>10,.0f} rows/s, +{memory} peak, "
+	      f"{result['documents_written']} documents written, {result['quota_errors']} quota errors ({calls})")
+	stages = ", ".join(f"{stage} {stage_report['seconds']:.2f} s" for stage, stage_report in result.get("stages", {}).items())
+	if stages:
+		print(f"{'':>18}  {stages}")
+
+
+if __name__ == "__main__":
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description="Benchmark the track and subgenre syncs against in-memory Sheets and Firestore")
+	parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="how many tracks the synthetic catalogs have")
+	parser.add_argument("--subgenres", type=int, nargs="*", default=[2_000], help="how many subgenres the synthetic family trees have")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds that every API call takes")
+	parser.add_argument("--sheets-quota-error-rate", type=float, default=0.0, help="the chance that a Sheets API call fails for being over quota")
+	parser.add_argument("--firestore-quota-error-rate", type=float, default=0.0, help="the chance that a Firestore call fails for being over quota")
+	parser.add_argument("--transform-workers", type=int, default=0, help="how many processes turn tracks into documents in the track sync")
+	parser.add_argument("--sink", choices=["fake-firestore", "sqlite", "jsonl"], default="fake-firestore", help="what the syncs write to (the local sinks write to a temporary directory)")
+	parser.add_argument("--save", type=Path, metavar="PATH", help="save the results as JSON")
+	parser.add_argument("--compare", type=Path, metavar="PATH", help="fail if anything regressed from results saved with --save")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="how much slower than --compare's results is still fine (0.2 = 20%%)")
+	arguments = parser.parse_args()
+
+	options: BenchmarkOptions = {
+		"latency": arguments.latency,
+		"sheets_quota_error_rate": arguments.sheets_quota_error_rate,
+		"firestore_quota_error_rate": arguments.firestore_quota_error_rate,
+		"transform_workers": arguments.transform_workers,
+		"sink": arguments.sink,
+	}
+
+	results: List[BenchmarkResult] = []
+	cases = [("tracks", rows) for rows in arguments.rows] + [("subgenres", count) for count in arguments.subgenres]
+	for kind, rows in cases:
+		with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+			result = executor.submit(run_benchmark, kind, rows, options).result()
+		print_result(result)
+		results.append(result)
+
+	if arguments.save is not None:
+		with arguments.save.open("w", encoding="utf8") as file:
+			dump(results, file, indent="\t")
+
+	if arguments.compare is not None:
+		with arguments.compare.open(encoding="utf8") as file:
+			baseline: List[BenchmarkResult] = load(file)
+
+		problems = regressions(results, baseline, arguments.tolerance)
+		for problem in problems:
+			print(f"⚠️ {problem}")
+		if problems:
+			raise SystemExit(1)
+		print(f"no regressions compared to {arguments.compare}")
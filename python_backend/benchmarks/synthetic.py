@@ -0,0 +1,251 @@
+#    genre.guide - Benchmarks: Synthetic Genre Sheet and Subgenre Sheet
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import date
+from random import Random
+from typing import Callable, Dict, List, NamedTuple, Optional, overload, Sequence, Tuple, Union
+
+from ..sheet_to_db.fakes import FakeAPI, FakeSpreadsheet, FakeWorksheet
+from ..sheet_to_db.quota import RequestScheduler
+from ..sheet_to_db.sheet_reads import TextFormat
+
+
+# The newest and oldest release dates on the synthetic sheets
+NEWEST_RELEASE = date(2020, 12, 31)
+OLDEST_RELEASE = date(2000, 1, 1)
+
+GENRE_SHEET_HEADER = ["Artist", "Track", "Release", "Label", "Genre", "Subgenre"]
+SUBGENRE_SHEET_HEADER = ["Artists", "Song Title", "Primary Label", "Date", "Genre Color", "Subgenres", "Length", "BPM", "Key"]
+
+# Tabs of the Subgenre Sheet, and the releases that are on each one
+SUBGENRE_SHEET_TABS = [
+	("2020-2024", date(2020, 1, 1), NEWEST_RELEASE),
+	("2015-2019", date(2015, 1, 1), date(2019, 12, 31)),
+	("2010-2014", date(2010, 1, 1), date(2014, 12, 31)),
+	("Pre-2010s", OLDEST_RELEASE, date(2009, 12, 31)),
+]
+
+# The deepest column a subgenre can be in on the genres tab
+MAX_DEPTH = 8
+
+
+def mix(number: int) -> int:
+	"""A cheap, repeatable scramble of number, so that every row can be made up on the spot without any state"""
+
+	number = (number * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+	number ^= number >> 29
+	number = (number * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+	return number ^ (number >> 32)
+
+
+class SyntheticRows(Sequence[List[str]]):
+	"""A header row followed by count rows that are only made (by make_row, from the row's index) when they're looked at"""
+
+	def __init__(self, header: List[str], count: int, make_row: Callable[[int], List[str]]) -> None:
+		self.header = header
+		self.make_row = make_row
+
+		# (Not count, which would hide Sequence.count)
+		self._row_count = count
+
+	def __len__(self) -> int:
+		return self._row_count + 1
+
+	@overload
+	def __getitem__(self, index: int) -> List[str]:
+		...
+
+	@overload
+	def __getitem__(self, index: "slice[Optional[int], Optional[int], Optional[int]]") -> List[List[str]]:
+		...
+
+	def __getitem__(self, index: Union[int, "slice[Optional[int], Optional[int], Optional[int]]"]) -> Union[List[str], List[List[str]]]:
+		if isinstance(index, slice):
+			return [self[row_index] for row_index in range(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError(index)
+		return self.header if index == 0 else self.make_row(index - 1)
+
+
+def subgenre_text(subgenres: List[str], seed: int, *, tilde: str = "~") -> str:
+	"""A subgenre text like the sheets have, made of mostly single subgenres, some with operators, and a few with dividers"""
+
+	a, b, c = [subgenres[(seed >> shift) % len(subgenres)] for shift in (8, 24, 40)]
+
+	kind = seed % 20
+	if kind < 10:
+		return a
+	if kind < 15:
+		return f"{a} | {b}"
+	if kind < 17:
+		return f"{a} > {b}"
+	if kind < 19:
+		return f"{a} {tilde} {b}"
+	return f"{a} || {b} > {c}"
+
+
+def release_date(index: int, count: int, newest: date, oldest: date) -> str:
+	"""Release dates spread evenly from newest (at index 0) to oldest (at index count - 1)"""
+
+	days = newest.toordinal() - oldest.toordinal() + 1
+	return date.fromordinal(newest.toordinal() - index * days // count).isoformat()
+
+
+def genre_sheet_catalog(title: str, count: int, subgenres: List[str], *, salt: int = 0) -> FakeWorksheet:
+	def make_row(index: int) -> List[str]:
+		seed = mix(index ^ salt)
+		subgenre = subgenre_text(subgenres, seed)
+		return [
+			f"Artist {seed % 20000}",
+			f"Track {index}",
+			release_date(index, count, NEWEST_RELEASE, OLDEST_RELEASE),
+			f"Label {(seed >> 16) % 1500}",
+			subgenre.split(" ", 1)[0],
+			subgenre,
+		]
+
+	return FakeWorksheet(title, SyntheticRows(GENRE_SHEET_HEADER, count, make_row), col_count=len(GENRE_SHEET_HEADER))
+
+
+def subgenre_sheet_tab(title: str, newest: date, oldest: date, count: int, subgenres: List[str], *, salt: int = 0) -> FakeWorksheet:
+	def make_row(index: int) -> List[str]:
+		seed = mix(index ^ salt)
+		subgenre = subgenre_text(subgenres, seed, tilde="/")
+		return [
+			f"Artist {seed % 20000}",
+			f"Song {title} {index}",
+			f"Label {(seed >> 16) % 1500}",
+			release_date(index, count, newest, oldest),
+			subgenre.split(" ", 1)[0],
+			subgenre,
+			f"{2 + seed % 4}:{seed % 60:02}",
+			str(100 + seed % 80),
+			f"{'ABCDEFG'[seed % 7]} {'Major' if seed & 1 else 'Minor'}",
+		]
+
+	return FakeWorksheet(title, SyntheticRows(SUBGENRE_SHEET_HEADER, count, make_row), col_count=len(SUBGENRE_SHEET_HEADER))
+
+
+def track_sheets(api: FakeAPI, count: int, *, catalog_sheet_name: str, subgenres: Optional[List[str]] = None,
+                 scheduler: Optional[RequestScheduler] = None) -> Tuple[FakeSpreadsheet, FakeSpreadsheet]:
+	"""A Genre Sheet with half of count tracks on its catalog tab, and a Subgenre Sheet with the other half spread across its tabs"""
+
+	if subgenres is None:
+		subgenres = [subgenre.name for subgenre in genre_tree(500)]
+
+	genre_sheet = FakeSpreadsheet(api, title="Genre Sheet", id="genre-sheet", scheduler=scheduler)
+	genre_sheet.add_worksheet(genre_sheet_catalog(catalog_sheet_name, count // 2, subgenres))
+
+	subgenre_sheet = FakeSpreadsheet(api, title="Subgenre Sheet", id="subgenre-sheet", scheduler=scheduler)
+	for salt, (title, oldest, newest) in enumerate(SUBGENRE_SHEET_TABS, start=1):
+		tab_count = (count - count // 2) // len(SUBGENRE_SHEET_TABS)
+		subgenre_sheet.add_worksheet(subgenre_sheet_tab(title, newest, oldest, tab_count, subgenres, salt=salt))
+
+	return genre_sheet, subgenre_sheet
+
+
+class SyntheticSubgenre(NamedTuple):
+	name: str
+	# The column it's in on the genres tab (1 for genres)
+	column: int
+	# Whether this row is a second mention of a subgenre under another parent (which is italicized)
+	is_extra_origin: bool
+	note: Optional[str]
+
+
+def genre_tree(count: int, *, genre_count: int = 20, seed: int = 0) -> List[SyntheticSubgenre]:
+	"""Rows of the genres tab, top to bottom: genre_count genres with count subgenres (in total) under them,
+	   where every subgenre's parent is the closest row above it that's one column to the left, like on the real sheet"""
+
+	random = Random(seed)
+
+	# Each subgenre's parent, which always comes before it, so that there can't be any cycles
+	parents: List[Optional[int]] = [None] * genre_count
+	depths: List[int] = [1] * genre_count
+	for index in range(genre_count, genre_count + count):
+		parent_index = random.randrange(index)
+		while depths[parent_index] >= MAX_DEPTH:
+			parent_index = random.randrange(index)
+		parents.append(parent_index)
+		depths.append(depths[parent_index] + 1)
+
+	names = [f"Genre {index}" if index < genre_count else f"Subgenre {index}" for index in range(len(parents))]
+
+	children: Dict[int, List[int]] = {}
+	extra_origins: Dict[int, List[int]] = {}
+	for index, parent in enumerate(parents):
+		if parent is None:
+			continue
+		children.setdefault(parent, []).append(index)
+
+		# Some subgenres come from a second subgenre too (one before them, which can't be one of their descendants)
+		if random.random() < 0.05:
+			other_parent = random.randrange(index)
+			if other_parent != parent and depths[other_parent] < MAX_DEPTH:
+				extra_origins.setdefault(other_parent, []).append(index)
+
+	rows: List[SyntheticSubgenre] = []
+
+	def visit(index: int) -> None:
+		note = f"Alternative names:\n{names[index]} Alt" if random.random() < 0.2 else None
+		rows.append(SyntheticSubgenre(names[index], depths[index], False, note))
+
+		# Second mentions are leaves, since nothing is listed under an italicized subgenre
+		for extra in extra_origins.get(index, []):
+			rows.append(SyntheticSubgenre(names[extra], depths[index] + 1, True, None))
+		for child in children.get(index, []):
+			visit(child)
+
+	for genre in range(genre_count):
+		visit(genre)
+
+	return rows
+
+
+def genre_color_sheet(api: FakeAPI, subgenre_count: int, *, genres_sheet_name: str, genre_info_sheet_name: str,
+                      genre_count: int = 20, seed: int = 0, scheduler: Optional[RequestScheduler] = None) -> FakeSpreadsheet:
+	"""A Genre Sheet with the genres tab (the family tree) and genre info tab (the colors) that the subgenre sync reads"""
+
+	tree = genre_tree(subgenre_count, genre_count=genre_count, seed=seed)
+
+	values: List[List[str]] = [["Genre", *[f"Subgenre {column}" for column in range(2, MAX_DEPTH + 1)]]]
+	formats: List[List[TextFormat]] = [[{"bold": True}] * MAX_DEPTH]
+	notes: List[List[Optional[str]]] = [[None] * MAX_DEPTH]
+
+	for subgenre in tree:
+		row = [""] * MAX_DEPTH
+		row[subgenre.column - 1] = subgenre.name
+		values.append(row)
+
+		# The cell is merged across the rest of the row, so every cell has its format
+		formats.append([{"bold": subgenre.column == 1, "italic": subgenre.is_extra_origin}] * MAX_DEPTH)
+
+		row_notes: List[Optional[str]] = [None] * MAX_DEPTH
+		row_notes[subgenre.column - 1] = subgenre.note
+		notes.append(row_notes)
+
+	genres = [subgenre.name for subgenre in tree if subgenre.column == 1]
+	color_values = [["Genre", "Color (#Hex)"], *[[genre, f"#{mix(index) & 0xFFFFFF:06x}"] for index, genre in enumerate(genres)]]
+	white_text: TextFormat = {"foregroundColor": {"red": 1, "green": 1, "blue": 1}}
+	color_formats: List[List[TextFormat]] = [[{}, {}]]
+	color_formats.extend([white_text, {}] for _ in genres)
+
+	genre_sheet = FakeSpreadsheet(api, title="Genre Sheet", id="genre-sheet", scheduler=scheduler)
+	genre_sheet.add_worksheet(FakeWorksheet(genres_sheet_name, values, formats=formats, notes=notes))
+	genre_sheet.add_worksheet(FakeWorksheet(genre_info_sheet_name, color_values, formats=color_formats))
+	return genre_sheet
@@ -0,0 +1,303 @@
+#    genre.guide - Offline track catalog
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from struct import calcsize, pack, unpack_from
+from sys import byteorder
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, TypedDict
+
+
+# A whole catalog in one file:
+# MAGIC, the length of the header, the header (JSON: row count, where each column is, and the dictionaries),
+# and then each column, little-endian and aligned to 8 bytes so that it can be used straight out of a memory map
+MAGIC = b"GGCATLG\x00"
+CATALOG_VERSION = 1
+HEADER_LENGTH_FORMAT = "<I"
+ALIGNMENT = 8
+
+# IDs from id_for_track are hex blake2b digests (64 bytes once they're turned back into bytes)
+TRACK_ID_SIZE = 64
+
+if array("i").itemsize != 4:
+	raise ImportError("the catalog needs C ints to be 32 bits")
+
+
+class CatalogTrack(NamedTuple):
+	track_id: str
+	artist: str
+	title: str
+	release_date: date
+	record_label: str
+	index_on_label_on_release: int
+	subgenres: Tuple[str, ...]
+	# The same JSON as subgenresNested in Firestore
+	subgenres_nested: str
+
+
+class CatalogHeader(TypedDict):
+	version: int
+	rows: int
+	# Column name to (offset from the start of the data, length), in bytes
+	columns: Dict[str, Tuple[int, int]]
+	labels: List[str]
+	artists: List[str]
+	subgenres: List[str]
+
+
+def dictionary_encode(values: Iterable[str]) -> Tuple[List[str], Dict[str, int]]:
+	"""The distinct values (sorted, so codes compare like the values do) and each value's code"""
+
+	dictionary = sorted(set(values))
+	return dictionary, {value: code for code, value in enumerate(dictionary)}
+
+
+def string_heap(strings: Iterable[str]) -> Tuple["array[int]", bytes]:
+	"""Offsets (one more than there are strings) into all of the strings' UTF-8 laid end to end"""
+
+	offsets = array("i", [0])
+	heap = bytearray()
+	for string in strings:
+		heap += string.encode("utf8")
+		offsets.append(len(heap))
+	return offsets, bytes(heap)
+
+
+def little_endian(column: "array[int]") -> bytes:
+	if byteorder == "big":
+		column = array("i", column)
+		column.byteswap()
+	return column.tobytes()
+
+
+def write_catalog(path: Path, tracks: Iterable[CatalogTrack]) -> int:
+	"""Writes tracks (in any order) to path as a catalog, and gives back how many there were"""
+
+	# Oldest first, so that a date range is a contiguous run of rows
+	rows = sorted(tracks, key=lambda track: (track.release_date, track.record_label, track.index_on_label_on_release, track.track_id))
+
+	labels, label_codes = dictionary_encode(track.record_label for track in rows)
+	artists, artist_codes = dictionary_encode(track.artist for track in rows)
+	subgenres, subgenre_codes = dictionary_encode(subgenre for track in rows for subgenre in track.subgenres)
+
+	subgenre_offsets = array("i", [0])
+	flat_subgenres = array("i")
+	for track in rows:
+		flat_subgenres.extend(sorted(subgenre_codes[subgenre] for subgenre in track.subgenres))
+		subgenre_offsets.append(len(flat_subgenres))
+
+	title_offsets, title_heap = string_heap(track.title for track in rows)
+	nested_offsets, nested_heap = string_heap(track.subgenres_nested for track in rows)
+
+	columns: Dict[str, bytes] = {
+		"release": little_endian(array("i", [track.release_date.toordinal() for track in rows])),
+		"label": little_endian(array("i", [label_codes[track.record_label] for track in rows])),
+		"artist": little_endian(array("i", [artist_codes[track.artist] for track in rows])),
+		"index_on_label": little_endian(array("i", [track.index_on_label_on_release for track in rows])),
+		"subgenre_offsets": little_endian(subgenre_offsets),
+		"subgenres": little_endian(flat_subgenres),
+		"title_offsets": little_endian(title_offsets),
+		"titles": title_heap,
+		"nested_offsets": little_endian(nested_offsets),
+		"nested": nested_heap,
+		"track_id": b"".join(bytes.fromhex(track.track_id) for track in rows),
+	}
+
+	# Work out where each column goes before writing anything, since the header says where they are
+	locations: Dict[str, Tuple[int, int]] = {}
+	position = 0
+	for name, data in columns.items():
+		locations[name] = (position, len(data))
+		position += len(data) + (-len(data) % ALIGNMENT)
+
+	header_data: CatalogHeader = {
+		"version": CATALOG_VERSION,
+		"rows": len(rows),
+		"columns": locations,
+		"labels": labels,
+		"artists": artists,
+		"subgenres": subgenres,
+	}
+	header = dumps(header_data, ensure_ascii=False).encode("utf8")
+
+	data_start = len(MAGIC) + calcsize(HEADER_LENGTH_FORMAT) + len(header)
+	data_start += -data_start % ALIGNMENT
+
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temporary_path = path.with_suffix(".tmp")
+	with temporary_path.open("wb") as file:
+		file.write(MAGIC)
+		file.write(pack(HEADER_LENGTH_FORMAT, len(header)))
+		file.write(header)
+		file.write(b"\0" * (data_start - file.tell()))
+
+		for name, data in columns.items():
+			file.write(data)
+			file.write(b"\0" * (-len(data) % ALIGNMENT))
+	temporary_path.replace(path)
+
+	return len(rows)
+
+
+class Catalog:
+	"""Read-only queries over a catalog file, which is memory mapped instead of read in,
+	   so opening it only costs reading the header"""
+
+	def __init__(self, path: Path) -> None:
+		self._file = path.open("rb")
+		self._mmap = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+		self._view = memoryview(self._mmap)
+
+		if self._view[:len(MAGIC)] != MAGIC:
+			raise ValueError(f"{path} isn't a catalog")
+
+		header_length, = unpack_from(HEADER_LENGTH_FORMAT, self._mmap, len(MAGIC))
+		header_start = len(MAGIC) + calcsize(HEADER_LENGTH_FORMAT)
+		header: CatalogHeader = loads(bytes(self._view[header_start:header_start + header_length]))
+		if header["version"] != CATALOG_VERSION:
+			raise ValueError(f"version {header['version']} of the catalog format isn't understood (only version {CATALOG_VERSION} is)")
+
+		data_start = header_start + header_length
+		data_start += -data_start % ALIGNMENT
+
+		self.labels = header["labels"]
+		self.artists = header["artists"]
+		self.subgenres = header["subgenres"]
+		self._label_codes = {label: code for code, label in enumerate(self.labels)}
+		self._artist_codes = {artist: code for code, artist in enumerate(self.artists)}
+		self._subgenre_codes = {subgenre: code for code, subgenre in enumerate(self.subgenres)}
+
+		self._rows = header["rows"]
+		self._columns: Dict[str, memoryview] = {
+			name: self._view[data_start + offset:data_start + offset + length]
+			for name, (offset, length) in header["columns"].items()
+		}
+
+		self._release = self._int_column("release")
+		self._label = self._int_column("label")
+		self._artist = self._int_column("artist")
+		self._index_on_label = self._int_column("index_on_label")
+		self._subgenre_offsets = self._int_column("subgenre_offsets")
+		self._flat_subgenres = self._int_column("subgenres")
+		self._title_offsets = self._int_column("title_offsets")
+		self._nested_offsets = self._int_column("nested_offsets")
+
+		# Subgenre code -> rows with it, built the first time that a subgenre is asked about
+		self._rows_by_subgenre: Optional[List["array[int]"]] = None
+
+	def _int_column(self, name: str) -> Sequence[int]:
+		if byteorder == "big":
+			# A copy is the only way to flip the bytes around
+			column = array("i", bytes(self._columns[name]))
+			column.byteswap()
+			return column
+		return self._columns[name].cast("i")
+
+	def close(self) -> None:
+		for column in [self._release, self._label, self._artist, self._index_on_label, self._subgenre_offsets,
+		               self._flat_subgenres, self._title_offsets, self._nested_offsets]:
+			if isinstance(column, memoryview):
+				column.release()
+		for view in self._columns.values():
+			view.release()
+		self._view.release()
+		self._mmap.close()
+		self._file.close()
+
+	def __enter__(self) -> "Catalog":
+		return self
+
+	def __exit__(self, *exception_info: object) -> None:
+		self.close()
+
+	def __len__(self) -> int:
+		return self._rows
+
+	def _string(self, offsets: Sequence[int], heap: str, row: int) -> str:
+		return str(self._columns[heap][offsets[row]:offsets[row + 1]], "utf8")
+
+	def track(self, row: int) -> CatalogTrack:
+		subgenre_codes = self._flat_subgenres[self._subgenre_offsets[row]:self._subgenre_offsets[row + 1]]
+
+		return CatalogTrack(
+			track_id=self._columns["track_id"][row * TRACK_ID_SIZE:(row + 1) * TRACK_ID_SIZE].hex(),
+			artist=self.artists[self._artist[row]],
+			title=self._string(self._title_offsets, "titles", row),
+			release_date=date.fromordinal(self._release[row]),
+			record_label=self.labels[self._label[row]],
+			index_on_label_on_release=self._index_on_label[row],
+			subgenres=tuple(self.subgenres[code] for code in subgenre_codes),
+			subgenres_nested=self._string(self._nested_offsets, "nested", row),
+		)
+
+	def date_range(self, start: Optional[date] = None, end: Optional[date] = None) -> range:
+		"""The rows released from start through end (both inclusive, and either one can be left open)"""
+
+		first = 0 if start is None else bisect_left(self._release, start.toordinal())
+		last = self._rows if end is None else bisect_right(self._release, end.toordinal())
+		return range(first, max(first, last))
+
+	def _subgenre_rows(self, subgenre_code: int) -> "array[int]":
+		if self._rows_by_subgenre is None:
+			rows_by_subgenre: List["array[int]"] = [array("i") for _ in self.subgenres]
+			offsets = self._subgenre_offsets
+			flat_subgenres = self._flat_subgenres
+			for row in range(self._rows):
+				for index in range(offsets[row], offsets[row + 1]):
+					rows_by_subgenre[flat_subgenres[index]].append(row)
+			self._rows_by_subgenre = rows_by_subgenre
+
+		return self._rows_by_subgenre[subgenre_code]
+
+	def rows(self, *, start: Optional[date] = None, end: Optional[date] = None, label: Optional[str] = None,
+	         artist: Optional[str] = None, subgenre: Optional[str] = None) -> List[int]:
+		"""Rows (oldest first) of the tracks that match every filter that's given"""
+
+		candidates: Sequence[int] = self.date_range(start, end)
+
+		if subgenre is not None:
+			subgenre_code = self._subgenre_codes.get(subgenre)
+			if subgenre_code is None:
+				return []
+
+			# The subgenre's rows are sorted too, so the date range is a slice of them
+			subgenre_rows = self._subgenre_rows(subgenre_code)
+			candidates = subgenre_rows[bisect_left(subgenre_rows, candidates.start):bisect_left(subgenre_rows, candidates.stop)]  # type: ignore
+
+		if label is not None:
+			label_code = self._label_codes.get(label)
+			if label_code is None:
+				return []
+			label_column = self._label
+			candidates = [row for row in candidates if label_column[row] == label_code]
+
+		if artist is not None:
+			artist_code = self._artist_codes.get(artist)
+			if artist_code is None:
+				return []
+			artist_column = self._artist
+			candidates = [row for row in candidates if artist_column[row] == artist_code]
+
+		return list(candidates)
+
+	def query(self, *, start: Optional[date] = None, end: Optional[date] = None, label: Optional[str] = None,
+	          artist: Optional[str] = None, subgenre: Optional[str] = None) -> List[CatalogTrack]:
+		return [self.track(row) for row in self.rows(start=start, end=end, label=label, artist=artist, subgenre=subgenre)]
@@ -15,128 +15,194 @@
 #    along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 
-from collections import defaultdict
+from functools import lru_cache
+from json import dumps
 from re import compile
-from typing import DefaultDict, Dict, Generator, Iterator, List, Set, Tuple, Union, cast
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 
 OPERATORS: Set[str] = {"|", ">", "~"}
 DIVIDERS: Set[str] = {"||", ">>", "~~"}
 
-def error_on_more_than_one_kind_of_divider(*, genre_text: str, divider_counts: Dict[str, int]) -> None:
-	if sum(divider_counts.values()) <= 1:
-		return
-	
-	for this_divider in divider_counts:
-		if not any(dcount for divider, dcount in divider_counts.items() if divider != this_divider):
-			return
-	
-	raise ValueError(f"too many dividers in {genre_text}")
+WORD_PATTERN = compile(r"\S+")
 
-def error_on_misplaced_operators_even(*, genre_text: str, joined_words: List[str]) -> None:
-	for index in range(0, len(joined_words), 2):
-		if joined_words[index] in DIVIDERS or joined_words[index] in OPERATORS:
-			raise ValueError(f"misplaced operator in {genre_text}")
 
-def error_on_misplaced_operators_odd(*, genre_text: str, joined_words: List[str]) -> None:
-	for index in range(1, len(joined_words), 2):
-		if not (joined_words[index] in DIVIDERS or joined_words[index] in OPERATORS):
-			raise ValueError(f"misplaced operator in {genre_text} (this should not be possible in my mind)")
+class GenreSyntaxError(ValueError):
+	"""A genre text that can't be parsed, and where in it the problem is"""
 
-def make_genre_groups(*, joined_words: List[str]) -> Generator[Union[str, Tuple[str, str, str]], None, None]:
-	skip_indices: Set[int] = set()
+	def __init__(self, message: str, *, genre_text: str, position: int) -> None:
+		super().__init__(f"{message} at position {position} of {genre_text!r}\n{genre_text}\n{' ' * position}^")
+		self.genre_text = genre_text
+		self.position = position
 
-	for index, word_or_symbol in enumerate(joined_words):
-		if index in skip_indices:
-			continue
 
-		# Prevent out of index errors
-		if index + 2 >= len(joined_words):
-			yield word_or_symbol[0]
-			yield joined_words[index + 1]
-			break
+class Token(NamedTuple):
+	kind: str
+	text: str
+	position: int
 
-		if joined_words[index + 1] in OPERATORS:
-			yield (joined_words[index], joined_words[index + 1][0], joined_words[index + 2])
-			skip_indices.add(index + 1)
-			skip_indices.add(index + 2)
-		elif joined_words[index + 1] in DIVIDERS:
-			yield word_or_symbol
-			yield joined_words[index + 1][0]
 
+# Kinds of tokens
+NAME = "name"
+OPERATOR = "operator"
+DIVIDER = "divider"
+OPEN = "("
+CLOSE = ")"
+END = "end"
 
-def parse_genre(genre_text: str) -> Tuple:  # type: ignore
-	words_or_symbols: List[str] = genre_text.split()
 
-	operator_counts: Dict[str, int] = {
-		operator: words_or_symbols.count(operator)
-		for operator in OPERATORS
-	}
-	divider_counts: Dict[str, int] = {
-		divider: words_or_symbols.count(divider)
-		for divider in DIVIDERS
-	}
+def tokenize_genre(genre_text: str) -> List[Token]:
+	"""Splits genre text into genre names, operators, dividers, and grouping parentheses in one pass over its words
+	   Parentheses that belong to a name, like in Trap (EDM), stay a part of the name"""
 
-	# If there are no operators or dividers, just return the text as the only element in a tuple, right away
-	if sum(operator_counts.values()) == sum(divider_counts.values()) == 0:
-		return genre_text,
+	tokens: List[Token] = []
 
-	# If there is more than one kind of divider -- that's an error
-	error_on_more_than_one_kind_of_divider(genre_text=genre_text, divider_counts=divider_counts)
+	name_words: List[str] = []
+	name_position = 0
+	# How many parentheses inside of the current name are still open
+	name_depth = 0
 
-	subgenre_index: int = 0
-	words: DefaultDict[int, Union[str, List[str]]] = defaultdict(list)
-	for index, word in enumerate(words_or_symbols):
-		if word in operator_counts or word in divider_counts:
-			subgenre_index += 1
-			words[subgenre_index] = word
+	def end_name() -> None:
+		nonlocal name_words
+		if name_words:
+			tokens.append(Token(NAME, " ".join(name_words), name_position))
+			name_words = []
 
-			subgenre_index += 1
+	for match in WORD_PATTERN.finditer(genre_text):
+		word, position = match.group(), match.start()
+
+		if word in OPERATORS or word in DIVIDERS:
+			end_name()
+			name_depth = 0
+			tokens.append(Token(OPERATOR if word in OPERATORS else DIVIDER, word, position))
 			continue
 
-		cast(List[str], words[subgenre_index]).append(word)
+		start = 0
+		# Parentheses at the start of a genre name open a group
+		if not name_words:
+			while start < len(word) and word[start] == "(":
+				tokens.append(Token(OPEN, "(", position + start))
+				start += 1
 
-	joined_words: List[str] = [
-		" ".join(word) if isinstance(word, list) else word
-		for word in words.values()
-	]
+		body = word[start:]
+		inner = body.rstrip(")")
+		name_depth += inner.count("(") - inner.count(")")
 
-	# Verify that there are only genre names at even indices
-	error_on_misplaced_operators_even(genre_text=genre_text, joined_words=joined_words)
-	# Verify that there are only dividers or operators at odd indices
-	error_on_misplaced_operators_odd(genre_text=genre_text, joined_words=joined_words)
+		# Parentheses at the end close whatever was opened inside the name first, and then groups
+		trailing = len(body) - len(inner)
+		closes_in_name = min(trailing, max(name_depth, 0))
+		name_depth -= closes_in_name
 
-	# Verify that the last word or symbol in the list is not an operator or divider
-	if joined_words[-1] in DIVIDERS | OPERATORS:
-		raise ValueError(f"misplaced operator at the end of {genre_text}")
+		text = inner + ")" * closes_in_name
+		if text:
+			if not name_words:
+				name_position = position + start
+			name_words.append(text)
 
-	
-	# If there are no dividers,
-	if sum(divider_counts.values()) == 0:
-		# And there is only one kind of operator,
-		for this_operator in operator_counts:
-			if not any(operator_counts[operator]
-					   for operator in operator_counts.keys()
-					   if operator != this_operator):
-				# Then return the result as it is
-				return tuple(joined_words)
-		
-		# Or, there could be subgroups in here
-		subgroups_pattern = compile(r"\((.+?)\)")
-		subgroups_results = subgroups_pattern.findall(genre_text)
-		if not subgroups_results:
-			# There is an ambiguity error (because there are multiple operators and no subgroups)
-			raise ValueError(f"ambiguous grouping of genres from {genre_text}")
-
-		for subgroup in subgroups_results:
-			parsed_grouping = parse_genre(subgroup)
-			replace_start = next(index for index, word in enumerate(joined_words) if isinstance(word, str) and word.startswith("("))
-			replace_end = next(index for index, word in enumerate(joined_words) if isinstance(word, str) and word.endswith(")"))
-
-			joined_words[replace_start:replace_end + 1] = cast(Tuple[str, str, str], (parsed_grouping,))
-		return tuple(joined_words)
-		
-	return tuple(make_genre_groups(joined_words=joined_words))
+		if trailing > closes_in_name:
+			end_name()
+			for close_position in range(position + start + len(text), position + len(word)):
+				tokens.append(Token(CLOSE, ")", close_position))
+
+	end_name()
+	tokens.append(Token(END, "", len(genre_text)))
+
+	return tokens
+
+
+class GenreParser:
+	"""Precedence climbing over the tokens of a genre text, in one pass
+	   Dividers bind the loosest, then operators, then parentheses; mixing different operators
+	   (or different dividers) at the same level is ambiguous, so it's an error"""
+
+	# From the loosest to the tightest binding
+	LEVELS = (DIVIDER, OPERATOR)
+
+	def __init__(self, genre_text: str, tokens: List[Token]) -> None:
+		self.genre_text = genre_text
+		self.tokens = tokens
+		self.index = 0
+
+	def error(self, message: str, token: Token) -> GenreSyntaxError:
+		return GenreSyntaxError(message, genre_text=self.genre_text, position=token.position)
+
+	def peek(self) -> Token:
+		return self.tokens[self.index]
+
+	def advance(self) -> Token:
+		token = self.tokens[self.index]
+		self.index += 1
+		return token
+
+	def parse(self) -> Union[str, Tuple]:  # type: ignore
+		result = self.sequence(0)
+
+		token = self.peek()
+		if token.kind == CLOSE:
+			raise self.error("unmatched closing parenthesis", token)
+		if token.kind != END:
+			raise self.error("expected an operator", token)
+
+		return result
+
+	def sequence(self, level: int) -> Union[str, Tuple]:  # type: ignore
+		kind = self.LEVELS[level]
+
+		items: List[Union[str, Tuple]] = [self.operand(level)]  # type: ignore
+		symbol: Optional[str] = None
+
+		while self.peek().kind == kind:
+			token = self.advance()
+
+			if symbol is None:
+				symbol = token.text
+			elif token.text != symbol:
+				if kind == DIVIDER:
+					raise self.error(f"too many kinds of dividers ({symbol} and {token.text})", token)
+				raise self.error(f"ambiguous grouping of {symbol} and {token.text} (it needs a divider or parentheses)", token)
 
+			# Dividers are stored as the operator they divide with
+			items.append(token.text[0])
+			items.append(self.operand(level))
+
+		return items[0] if len(items) == 1 else tuple(items)
+
+	def operand(self, level: int) -> Union[str, Tuple]:  # type: ignore
+		if level + 1 < len(self.LEVELS):
+			return self.sequence(level + 1)
+
+		token = self.advance()
+		if token.kind == NAME:
+			return token.text
+
+		if token.kind == OPEN:
+			grouped = self.sequence(0)
+
+			closing = self.advance()
+			if closing.kind != CLOSE:
+				raise self.error("unclosed parenthesis", token)
+
+			return grouped
+
+		if token.kind == END:
+			raise self.error("misplaced operator at the end", self.tokens[self.index - 2])
+		raise self.error(f"expected a genre name, not {token.text}", token)
+
+
+# The same subgenre strings show up over and over again across the whole catalog
+# parse_genre.cache_info() tells how well that's working out
+PARSE_GENRE_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=PARSE_GENRE_CACHE_SIZE)
+def parse_genre(genre_text: str) -> Tuple:  # type: ignore
+	# If there are no operators or dividers, just return the text as the only element in a tuple, right away
+	words = genre_text.split()
+	if OPERATORS.isdisjoint(words) and DIVIDERS.isdisjoint(words):
+		return genre_text,
+
+	parsed = GenreParser(genre_text, tokenize_genre(genre_text)).parse()
+
+	# A lone (parenthesized) genre still comes back in a tuple
+	return (parsed,) if isinstance(parsed, str) else parsed
 
 
 def flatten_subgenres_iter(subgenres: Tuple) -> Iterator[str]: # type: ignore
@@ -164,6 +230,44 @@ def unordered_subgenres_and_operators(subgenres_and_operators: List[str]) -> Tup
 	return subgenres, operators
 
 
+class ParsedGenres(NamedTuple):
+	"""Columns of parse results, where each column lines up with the genre texts that were given"""
+
+	nested: List[Tuple]  # type: ignore
+	nested_json: List[str]
+	flat: List[Tuple[str, ...]]
+	subgenres: List[FrozenSet[str]]
+	operators: List[FrozenSet[str]]
+
+
+def parse_genres(genre_texts: Iterable[str]) -> ParsedGenres:
+	"""Batch version of parse_genre -> flatten_subgenres -> unordered_subgenres_and_operators (and JSON-dumping):
+	   every distinct text is only worked on once, and the results are shared by every position that had that text"""
+
+	# Number each distinct text in order of appearance, and remember which one is at each position
+	unique_indices: Dict[str, int] = {}
+	positions: List[int] = [unique_indices.setdefault(genre_text, len(unique_indices)) for genre_text in genre_texts]
+
+	unique_nested = [parse_genre(genre_text) for genre_text in unique_indices]
+	unique_nested_json = [dumps(nested) for nested in unique_nested]
+	unique_flat = [tuple(flatten_subgenres(nested)) for nested in unique_nested]
+
+	unique_subgenres: List[FrozenSet[str]] = []
+	unique_operators: List[FrozenSet[str]] = []
+	for flat in unique_flat:
+		subgenres, operators = unordered_subgenres_and_operators(list(flat))
+		unique_subgenres.append(frozenset(subgenres))
+		unique_operators.append(frozenset(operators))
+
+	return ParsedGenres(
+		nested=[unique_nested[index] for index in positions],
+		nested_json=[unique_nested_json[index] for index in positions],
+		flat=[unique_flat[index] for index in positions],
+		subgenres=[unique_subgenres[index] for index in positions],
+		operators=[unique_operators[index] for index in positions],
+	)
+
+
 def non_empty_lines_no_whitespace(text: str) -> Iterator[str]:
 	return map(str.strip, filter(bool, text.splitlines(keepends=False)))
 
@@ -14,12 +14,16 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
 from os import getenv
 from pathlib import Path
 
 from firebase_admin import credentials, firestore, initialize_app
 from google.cloud.firestore_v1.client import Client as FirestoreClient
-from gspread import service_account, Spreadsheet
+from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+from gspread import Client as SheetsClient, Spreadsheet
+from gspread.auth import DEFAULT_SCOPES
+from requests import Response
 
 
 CURRENT_DIRECTORY = Path(__file__).parent
@@ -27,21 +31,87 @@ CONFIG_DIRECTORY = CURRENT_DIRECTORY.parent.parent / "config"
 SHEET_SECRET_PATH = CONFIG_DIRECTORY / "sheet_secret.json"
 FIREBASE_SECRET_PATH = CONFIG_DIRECTORY / "firebase_admin_secret.json"
 
+# Local state that's kept between runs
+# None of it is the only copy of anything, but without a manifest the next sync writes everything again
+# and can't tell which of what it wrote before has disappeared from the sheets since (so that's left in Firestore)
+CACHE_DIRECTORY = CURRENT_DIRECTORY.parent.parent / "cache"
+TRACK_MANIFEST_PATH = CACHE_DIRECTORY / "track_manifest.json"
+SUBGENRE_MANIFEST_PATH = CACHE_DIRECTORY / "subgenre_manifest.json"
+SHEETS_RESPONSE_CACHE_PATH = CACHE_DIRECTORY / "sheets_responses.sqlite3"
+ALIAS_INDEX_PATH = CACHE_DIRECTORY / "alias_index.json"
+BACKFILL_STATE_DIRECTORY = CACHE_DIRECTORY / "backfill"
+
 GENRE_INFO_SHEET_NAME = getenv("GENRE_INFO_SHEET_NAME")
 GENRE_SHEET_CATALOG_SHEET_NAME = getenv("CATALOG_SHEET_NAME")
 GENRE_SHEET_KEY = getenv("GENRE_SHEET_KEY", "")
 GENRES_SHEET_NAME = getenv("GENRES_SHEET_NAME")
 SUBGENRE_SHEET_KEY = getenv("SUBGENRE_SHEET_KEY", "")
 
+# How many requests to the Sheets API can be going at the same time (across every thread)
+SHEETS_MAX_CONCURRENT_REQUESTS = int(getenv("SHEETS_MAX_CONCURRENT_REQUESTS", "4"))
+# The Sheets API's read quotas: per minute for the service account, and per minute for the whole project
+SHEETS_READS_PER_MINUTE_PER_USER = int(getenv("SHEETS_READS_PER_MINUTE_PER_USER", "60"))
+SHEETS_READS_PER_MINUTE = int(getenv("SHEETS_READS_PER_MINUTE", "300"))
+
+# off: always ask Google
+# on: reuse responses saved in SHEETS_RESPONSE_CACHE_PATH as long as the spreadsheet hasn't been modified since
+# offline: only use saved responses (and fail on anything that hasn't been saved)
+SHEETS_CACHE_MODE = getenv("SHEETS_CACHE_MODE", "off")
+
+# Where the syncs write documents to: firestore, sqlite:PATH (one SQLite database), or jsonl:DIRECTORY (a .jsonl log for each collection)
+SYNC_SINK = getenv("SYNC_SINK", "firestore")
+
+
+def record_sheets_response(response: Response, *args: object, **kwargs: object) -> None:
+    """Counts every response from Google towards the metrics of the current run"""
+
+    from . import metrics
+
+    metrics.current_run.count("sheets.requests")
+    metrics.current_run.count("sheets.bytes_received", len(response.content))
+
+
+@lru_cache(maxsize=None)
+def get_sheets_client(cache_mode: str = SHEETS_CACHE_MODE) -> SheetsClient:
+    # Authorize once and share the session between both sheets (and every thread reading from them)
+    client = make_sheets_client(cache_mode)
+    client.session.hooks["response"].append(record_sheets_response)
+    return client
+
+
+def sheets_credentials() -> ServiceAccountCredentials:
+    # (google-auth doesn't have type hints for this)
+    service_account: ServiceAccountCredentials = ServiceAccountCredentials.from_service_account_file(  # type: ignore[no-untyped-call]
+        str(SHEET_SECRET_PATH), scopes=DEFAULT_SCOPES)
+    return service_account
+
+
+def make_sheets_client(cache_mode: str) -> SheetsClient:
+    if cache_mode == "off":
+        from .quota import ScheduledClient
+
+        return ScheduledClient(sheets_credentials())
+
+    from .response_cache import CACHE_MODES, CachingClient, ResponseCache
+
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"the Sheets cache mode needs to be one of {CACHE_MODES}, not {cache_mode}")
+
+    offline = cache_mode == "offline"
+    # Running offline doesn't need the secret
+    auth = None if offline and not SHEET_SECRET_PATH.exists() else sheets_credentials()
+
+    return CachingClient(auth, ResponseCache(SHEETS_RESPONSE_CACHE_PATH), offline=offline)
+
 
-def get_genre_sheet() -> Spreadsheet:
-    client = service_account(filename=str(SHEET_SECRET_PATH))
+def get_genre_sheet(cache_mode: str = SHEETS_CACHE_MODE) -> Spreadsheet:
+    client = get_sheets_client(cache_mode)
 
     return client.open_by_key(GENRE_SHEET_KEY)
 
 
-def get_subgenre_sheet() -> Spreadsheet:
-    client = service_account(filename=str(SHEET_SECRET_PATH))
+def get_subgenre_sheet(cache_mode: str = SHEETS_CACHE_MODE) -> Spreadsheet:
+    client = get_sheets_client(cache_mode)
 
     return client.open_by_key(SUBGENRE_SHEET_KEY)
 
@@ -0,0 +1,242 @@
+#    genre.guide - From Google Sheets to Firestore: Resumable backfills of tracks
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from json import dump, load
+from os import replace
+from pathlib import Path
+from typing import ContextManager, List, Optional, Tuple, TypedDict
+
+from gspread import Spreadsheet
+
+from ..subgenre_utils import SubgenreTable
+
+from . import BACKFILL_STATE_DIRECTORY, get_genre_sheet, get_subgenre_sheet, SHEETS_CACHE_MODE, SYNC_SINK
+from .batched_writes import INITIAL_WRITE_RATE
+from .metrics import start_run
+from .quota import share_quota, sheets_scheduler
+from .sinks import open_sink, Ref, Sink, SinkDocumentReference, SINK_KINDS
+from .subgenres import get_subgenre_table
+from .tracks import build_up_track_information, INTERLEAVE_WINDOW, seed_firestore_with_track_data
+
+
+BACKFILL_STATE_VERSION = 1
+
+
+class ChunkState(TypedDict):
+	version: int
+	start: str
+	end: str
+	# Every track from start back to (and including) this release date has been written (None if none have been yet)
+	committedThrough: Optional[str]
+	done: bool
+	tracks: int
+
+
+def date_chunks(start: date, end: date, days: int) -> List[Tuple[date, date]]:
+	"""(newest, oldest) ranges of days days each (the last one may be shorter), from start back to end"""
+
+	if days < 1:
+		raise ValueError(f"chunks need to be at least 1 day long, not {days}")
+
+	chunks: List[Tuple[date, date]] = []
+	chunk_start = start
+	while chunk_start >= end:
+		chunk_end = max(end, chunk_start - timedelta(days=days - 1))
+		chunks.append((chunk_start, chunk_end))
+		chunk_start = chunk_end - timedelta(days=1)
+
+	return chunks
+
+
+def state_directory_for(start: date, end: date, days: int) -> Path:
+	"""Where the chunks of a backfill keep their state (which depends on how it's split up, so that's part of it too)"""
+
+	return BACKFILL_STATE_DIRECTORY / f"{start}_{end}_{days}d"
+
+
+def chunk_state_path(state_directory: Path, start: date, end: date) -> Path:
+	return state_directory / f"{start}_{end}.json"
+
+
+def load_chunk_state(path: Path, start: date, end: date) -> ChunkState:
+	"""The chunk's saved state, or a fresh one if it hasn't been started (or was saved by an incompatible version)"""
+
+	try:
+		with path.open(encoding="utf8") as file:
+			state: ChunkState = load(file)
+	except FileNotFoundError:
+		pass
+	else:
+		if state.get("version") == BACKFILL_STATE_VERSION and state["start"] == start.isoformat() and state["end"] == end.isoformat():
+			return state
+
+	return {"version": BACKFILL_STATE_VERSION, "start": start.isoformat(), "end": end.isoformat(), "committedThrough": None, "done": False, "tracks": 0}
+
+
+def save_chunk_state(path: Path, state: ChunkState) -> None:
+	# Write to the side and then move it over, so that a crash while saving can't leave half of a file behind
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temporary_path = path.with_suffix(".tmp")
+	with temporary_path.open("w", encoding="utf8") as file:
+		dump(state, file, indent="\t")
+	replace(str(temporary_path), str(path))
+
+
+def remaining_range(state: ChunkState) -> Optional[Tuple[date, date]]:
+	"""The (newest, oldest) release dates of the chunk that still need to be written, or None if it's done"""
+
+	start = datetime.strptime(state["start"], "%Y-%m-%d").date()
+	end = datetime.strptime(state["end"], "%Y-%m-%d").date()
+
+	if state["done"]:
+		return None
+	if state["committedThrough"] is None:
+		return start, end
+
+	resume_from = datetime.strptime(state["committedThrough"], "%Y-%m-%d").date() - timedelta(days=1)
+	return (resume_from, end) if resume_from >= end else None
+
+
+def backfill_chunk(firestore: Sink[Ref], genre_sheet: Spreadsheet, subgenre_sheet: Spreadsheet, state_directory: Path,
+                   start: date, end: date, *, write_rate: Optional[float] = None, bisect: bool = True,
+                   checkpoint_every: int = INTERLEAVE_WINDOW, transform_workers: int = 0,
+                   subgenre_table: Optional[SubgenreTable] = None, postings_lock: ContextManager[object] = nullcontext()) -> ChunkState:
+	"""Writes the tracks released from start back to end, picking up after the last checkpoint if the chunk was started before,
+	   and saving a checkpoint whenever a stretch of release dates is completely committed
+	   Chunks in the same year share posting lists, so chunks being backfilled at the same time need to share a postings_lock"""
+
+	path = chunk_state_path(state_directory, start, end)
+	state = load_chunk_state(path, start, end)
+
+	remaining = remaining_range(state)
+	if remaining is None:
+		if not state["done"]:
+			state["done"] = True
+			save_chunk_state(path, state)
+		return state
+
+	tracks_before = state["tracks"]
+
+	def checkpoint(committed_through: date, processed: int) -> None:
+		state["committedThrough"] = committed_through.isoformat()
+		state["tracks"] = tracks_before + processed
+		save_chunk_state(path, state)
+
+	resume_start, resume_end = remaining
+	tracks = build_up_track_information(genre_sheet, subgenre_sheet, resume_start, resume_end, bisect=bisect)
+	seed_firestore_with_track_data(firestore, tracks, write_rate=write_rate, checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+	                               transform_workers=transform_workers, subgenre_table=subgenre_table, postings_lock=postings_lock)
+
+	state["committedThrough"] = end.isoformat()
+	state["done"] = True
+	save_chunk_state(path, state)
+	return state
+
+
+# Set up once in every worker process by start_worker
+worker_sink: Sink[SinkDocumentReference]
+worker_genre_sheet: Spreadsheet
+worker_subgenre_sheet: Spreadsheet
+worker_subgenre_table: SubgenreTable
+worker_postings_lock: ContextManager[object]
+
+
+def start_worker(workers: int, concurrency: int, cache_mode: str, sink: str, postings_lock: ContextManager[object]) -> None:
+	global worker_sink, worker_genre_sheet, worker_subgenre_sheet, worker_subgenre_table, worker_postings_lock
+
+	# Every worker reads from Sheets at the same time, all under the same quota
+	share_quota(workers)
+	sheets_scheduler.limit_concurrency(concurrency)
+
+	worker_sink = open_sink(sink)
+	worker_genre_sheet = get_genre_sheet(cache_mode)
+	worker_subgenre_sheet = get_subgenre_sheet(cache_mode)
+	worker_subgenre_table = get_subgenre_table(worker_genre_sheet, sink)
+	worker_postings_lock = postings_lock
+
+
+def backfill_chunk_in_worker(state_directory: Path, start: date, end: date, write_rate: Optional[float], bisect: bool,
+                             transform_workers: int) -> ChunkState:
+	run = start_run(f"backfill {start}:{end}")
+	state = backfill_chunk(worker_sink, worker_genre_sheet, worker_subgenre_sheet, state_directory, start, end,
+	                       write_rate=write_rate, bisect=bisect, transform_workers=transform_workers,
+	                       subgenre_table=worker_subgenre_table, postings_lock=worker_postings_lock)
+	print(run.summary())
+	return state
+
+
+if __name__ == "__main__":
+	from argparse import ArgumentParser
+	from concurrent.futures import as_completed, ProcessPoolExecutor
+	from multiprocessing import get_context
+	from shutil import rmtree
+
+	from . import SHEETS_MAX_CONCURRENT_REQUESTS
+
+	parser = ArgumentParser(description="Clone a long history of tracks into Firestore in date chunks that can be resumed after a failure")
+	parser.add_argument("dates", help="the newest and oldest release dates to clone, like 2020-06-28:2010-01-01")
+	parser.add_argument("--chunk-days", type=int, default=90, help="how many days of releases each chunk covers")
+	parser.add_argument("--workers", type=int, default=2, help="how many chunks are cloned at the same time (in processes of their own)")
+	parser.add_argument("--concurrency", type=int, default=SHEETS_MAX_CONCURRENT_REQUESTS, help="how many requests to the Sheets API each worker can have going at once")
+	parser.add_argument("--sink", default=SYNC_SINK, metavar="|".join(SINK_KINDS), help="where to write the tracks to (Firestore unless told otherwise)")
+	parser.add_argument("--write-rate", type=float, default=INITIAL_WRITE_RATE, help="writes a second to Firestore to start out at across every worker (0 for no limit)")
+	parser.add_argument("--transform-workers", type=int, default=0, help="how many processes each worker has turning tracks into documents (0 for doing it in the worker itself)")
+	parser.add_argument("--sheets-cache", choices=["off", "on", "offline"], default=SHEETS_CACHE_MODE, help="whether to reuse (or only use) Sheets responses saved on disk")
+	parser.add_argument("--restart", action="store_true", help="forget the checkpoints of this backfill and start over")
+	arguments = parser.parse_args()
+
+	start_string, _, end_string = arguments.dates.partition(":")
+	start, end = [datetime.strptime(thing, "%Y-%m-%d").date() for thing in [start_string, end_string or start_string]]
+
+	state_directory = state_directory_for(start, end, arguments.chunk_days)
+	if arguments.restart and state_directory.exists():
+		rmtree(state_directory)
+
+	chunks = date_chunks(start, end, arguments.chunk_days)
+	states = {chunk: load_chunk_state(chunk_state_path(state_directory, *chunk), *chunk) for chunk in chunks}
+	pending = [chunk for chunk in chunks if not states[chunk]["done"]]
+	print(f"🗓️ {len(chunks)} chunks from {start} back to {end}: {len(chunks) - len(pending)} already done, "
+	      f"{sum(states[chunk]['committedThrough'] is not None for chunk in pending)} partly done, checkpoints in {state_directory}")
+
+	workers = max(1, min(arguments.workers, len(pending)))
+	write_rate = arguments.write_rate / workers if arguments.write_rate and arguments.sink == "firestore" else None
+	failures: List[str] = []
+
+	context = get_context("spawn")
+	with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=start_worker,
+	                         initargs=(workers, arguments.concurrency, arguments.sheets_cache, arguments.sink, context.Lock())) as executor:
+		futures = {
+			executor.submit(backfill_chunk_in_worker, state_directory, chunk_start, chunk_end, write_rate, True, arguments.transform_workers): (chunk_start, chunk_end)
+			for chunk_start, chunk_end in pending
+		}
+
+		for done_count, future in enumerate(as_completed(futures), start=1):
+			chunk_start, chunk_end = futures[future]
+			try:
+				state = future.result()
+			except Exception as error:
+				failures.append(f"{chunk_start} to {chunk_end}: {error!r}")
+				print(f"⚠️ {chunk_start} to {chunk_end} failed ({done_count}/{len(pending)}): {error!r}")
+			else:
+				print(f"✅ {chunk_start} to {chunk_end} is done with {state['tracks']} tracks ({done_count}/{len(pending)})")
+
+	if failures:
+		print(f"⚠️ {len(failures)} chunks didn't finish; run the same command again to pick up where they left off")
+		raise SystemExit(1)
+
+	print(f"🧬 the backfill from {start} back to {end} is done!")
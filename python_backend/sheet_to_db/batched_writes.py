@@ -0,0 +1,306 @@
+#    genre.guide - From Google Sheets to Firestore: Batched writes
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from random import uniform
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+from types import TracebackType
+from typing import Callable, Deque, Dict, Generic, Hashable, List, Optional, Tuple, Type
+
+from google.api_core.exceptions import Aborted, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
+
+from . import metrics
+from .sinks import DocumentData, Ref, Sink
+
+
+# Firestore refuses to commit more than this many writes at once
+MAX_BATCH_SIZE = 500
+
+# Errors that mean "try again later" rather than "this write is wrong"
+RETRYABLE_ERRORS: Tuple[Type[Exception], ...] = (Aborted, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable)
+
+# Errors that mean there's too much going on (in general, or in one part of an index) right now
+CONTENTION_ERRORS: Tuple[Type[Exception], ...] = (Aborted, DeadlineExceeded, ResourceExhausted)
+
+# Firestore's "500/50/5" rule for writing to a collection that isn't used to the traffic:
+# start at 500 writes a second and go up by 50% every 5 minutes
+INITIAL_WRITE_RATE = 500.0
+WRITE_RATE_GROWTH = 1.5
+WRITE_RATE_GROWTH_INTERVAL = 5 * 60.0
+
+# ("set", reference, document) or ("delete", reference, None)
+Write = Tuple[str, Ref, Optional[DocumentData]]
+
+
+class RampUpLimiter:
+	"""Paces writes to initial_rate a second, growing by growth every interval seconds,
+	   and cutting the rate down (then ramping up from there again) whenever Firestore pushes back"""
+
+	def __init__(self, initial_rate: float = INITIAL_WRITE_RATE, *, growth: float = WRITE_RATE_GROWTH,
+	             interval: float = WRITE_RATE_GROWTH_INTERVAL, min_rate: float = 50.0, backoff_factor: float = 0.5,
+	             clock: Callable[[], float] = monotonic, sleep: Callable[[float], None] = sleep) -> None:
+		if initial_rate <= 0:
+			raise ValueError(f"initial_rate needs to be more than 0, not {initial_rate}")
+
+		self.growth = growth
+		self.interval = interval
+		self.min_rate = min_rate
+		self.backoff_factor = backoff_factor
+		self.clock = clock
+		self.sleep = sleep
+
+		self.operations = 0
+		self.contentions = 0
+
+		self._base_rate = initial_rate
+		self._ramp_start = self._started = self._next_free = clock()
+		self._lock = Lock()
+
+	def _rate_at(self, when: float) -> float:
+		return self._base_rate * self.growth ** int((when - self._ramp_start) // self.interval)
+
+	def rate(self) -> float:
+		"""The writes a second that are allowed right now"""
+
+		with self._lock:
+			return self._rate_at(self.clock())
+
+	def take(self, operations: int) -> float:
+		"""Waits until operations writes are allowed to go, and gives back how many seconds that took"""
+
+		with self._lock:
+			now = self.clock()
+			start = max(now, self._next_free)
+			# The writes go all at once, and the ones after them wait for the time that they would've taken
+			self._next_free = start + operations / self._rate_at(start)
+			self.operations += operations
+
+		wait = start - now
+		if wait > 0:
+			self.sleep(wait)
+		return wait
+
+	def contention(self) -> None:
+		"""Firestore said to slow down, so slow down, and take another interval before speeding up again"""
+
+		with self._lock:
+			now = self.clock()
+			self._base_rate = max(self.min_rate, self._rate_at(now) * self.backoff_factor)
+			self._ramp_start = now
+			self.contentions += 1
+
+	def achieved_rate(self) -> float:
+		"""The writes a second that actually went out since the start"""
+
+		elapsed = self.clock() - self._started
+		return self.operations / elapsed if elapsed > 0 else 0.0
+
+
+class BatchedWriter(Generic[Ref]):
+	"""Groups document writes into WriteBatch commits of up to batch_size writes,
+	   keeps at most max_in_flight of them committing at the same time,
+	   and retries commits that fail for transient reasons with exponential backoff
+	   With a limiter, commits are paced by it (and tell it when there's contention)
+	   With an interleave_window, writes given a partition are held until there are that many,
+	   then written taking one from each partition in turn, so that neighboring index entries aren't all written together
+	   Writes to the same document still land in the order they were made: a write to a document that's waiting to go replaces that one,
+	   and a batch with a document that's in a commit still going waits for that commit before it goes"""
+
+	def __init__(self, firestore: Sink[Ref], *, batch_size: int = MAX_BATCH_SIZE, max_in_flight: int = 4,
+	             max_attempts: int = 5, initial_backoff: float = 1.0, max_backoff: float = 32.0,
+	             limiter: Optional[RampUpLimiter] = None, interleave_window: int = 0,
+	             sleep: Callable[[float], None] = sleep) -> None:
+		if not 0 < batch_size <= MAX_BATCH_SIZE:
+			raise ValueError(f"batch_size needs to be between 1 and {MAX_BATCH_SIZE}, not {batch_size}")
+		if max_in_flight < 1:
+			raise ValueError(f"max_in_flight needs to be at least 1, not {max_in_flight}")
+
+		self.firestore = firestore
+		self.batch_size = batch_size
+		self.max_attempts = max_attempts
+		self.initial_backoff = initial_backoff
+		self.max_backoff = max_backoff
+		self.limiter = limiter
+		self.interleave_window = interleave_window
+		self.sleep = sleep
+
+		self.committed_writes = 0
+		self.committed_batches = 0
+		self.retries = 0
+
+		# The latest write to each document that hasn't gone into a batch yet, by path,
+		# which are taken in the order that the paths are in the next batch or the partitions
+		self._held: Dict[str, Write[Ref]] = {}
+		self._pending: List[str] = []
+		self._partitions: Dict[Hashable, Deque[str]] = {}
+		self._partitioned = 0
+		self._in_flight: List["Future[None]"] = []
+		# The commit that each document is in, for the ones that are still going
+		self._committing: Dict[str, "Future[None]"] = {}
+		self._slots = BoundedSemaphore(max_in_flight)
+		self._lock = Lock()
+		self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="batched-writer")
+
+	def set(self, document_ref: Ref, document: DocumentData, *, partition: Optional[Hashable] = None) -> None:
+		self._add(("set", document_ref, document), partition)
+
+	def delete(self, document_ref: Ref) -> None:
+		self._add(("delete", document_ref, None), None)
+
+	def _add(self, write: Write[Ref], partition: Optional[Hashable]) -> None:
+		path = write[1].path
+		if path in self._held:
+			# Only the latest write to a document matters, so it takes the place of the one that's waiting
+			self._held[path] = write
+			return
+		self._held[path] = write
+
+		if partition is not None and self.interleave_window > 0:
+			self._partitions.setdefault(partition, deque()).append(path)
+			self._partitioned += 1
+			if self._partitioned >= self.interleave_window:
+				self._interleave()
+			return
+
+		self._queue(path)
+
+	def _queue(self, path: str) -> None:
+		self._pending.append(path)
+
+		if len(self._pending) >= self.batch_size:
+			self._submit()
+
+	def _interleave(self) -> None:
+		"""Lets go of every write held in a partition, one partition at a time in turn"""
+
+		partitions = list(self._partitions.values())
+		self._partitions = {}
+		self._partitioned = 0
+
+		while partitions:
+			for paths in partitions:
+				self._queue(paths.popleft())
+			partitions = [paths for paths in partitions if paths]
+
+	def _submit(self) -> None:
+		if not self._pending:
+			return
+
+		paths, self._pending = self._pending, []
+		writes = [self._held.pop(path) for path in paths]
+
+		# Commits in flight can finish in any order, so the ones that have these documents in them have to finish first
+		with self._lock:
+			earlier = {self._committing[path] for path in paths if path in self._committing}
+		for in_flight in earlier:
+			in_flight.result()
+
+		# Blocks until one of the commits in flight finishes, which is what bounds memory use
+		self._slots.acquire()
+		future = self._executor.submit(self._commit_with_retries, writes)
+		with self._lock:
+			for path in paths:
+				self._committing[path] = future
+		future.add_done_callback(lambda _: self._finished(future, paths))
+		self._in_flight.append(future)
+
+		# Surface failures from earlier batches as soon as possible instead of at the very end
+		still_in_flight: List["Future[None]"] = []
+		for in_flight in self._in_flight:
+			if in_flight.done():
+				in_flight.result()
+			else:
+				still_in_flight.append(in_flight)
+		self._in_flight = still_in_flight
+
+	def _finished(self, future: "Future[None]", paths: List[str]) -> None:
+		with self._lock:
+			for path in paths:
+				if self._committing.get(path) is future:
+					del self._committing[path]
+		self._slots.release()
+
+	def _commit_with_retries(self, writes: List[Write[Ref]]) -> None:
+		for attempt in range(self.max_attempts):
+			# A batch that failed to commit is thrown away and rebuilt from scratch
+			batch = self.firestore.batch()
+			for _, document_ref, document in writes:
+				if document is not None:
+					# Batches take a dict (which a TypedDict only is at runtime)
+					batch.set(document_ref, dict(document))
+				else:
+					batch.delete(document_ref)
+
+			if self.limiter is not None:
+				self.limiter.take(len(writes))
+
+			try:
+				batch.commit()
+			except RETRYABLE_ERRORS as error:
+				if isinstance(error, ResourceExhausted):
+					metrics.current_run.count("firestore.throttled")
+				if self.limiter is not None and isinstance(error, CONTENTION_ERRORS):
+					self.limiter.contention()
+					metrics.current_run.count("firestore.rate_cuts")
+				if attempt + 1 == self.max_attempts:
+					raise
+
+				with self._lock:
+					self.retries += 1
+				metrics.current_run.count("firestore.retries")
+
+				# Exponential backoff with jitter so that parallel commits don't retry in lockstep
+				backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+				self.sleep(uniform(backoff / 2, backoff))
+			else:
+				with self._lock:
+					self.committed_writes += len(writes)
+					self.committed_batches += 1
+				metrics.current_run.count("firestore.commits")
+				metrics.current_run.count("firestore.writes", len(writes))
+				return
+
+	def flush(self) -> None:
+		"""Commits whatever is left over and waits for every commit to finish"""
+
+		self._interleave()
+		self._submit()
+
+		in_flight, self._in_flight = self._in_flight, []
+		for future in in_flight:
+			future.result()
+
+	def close(self) -> None:
+		try:
+			self.flush()
+		finally:
+			self._executor.shutdown(wait=True)
+
+	def __enter__(self) -> "BatchedWriter[Ref]":
+		return self
+
+	def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+	             traceback: Optional[TracebackType]) -> None:
+		if exc_type is None:
+			self.close()
+		else:
+			# Don't commit the rest after something went wrong, but still wait for what's already going
+			self._held = {}
+			self._pending = []
+			self._partitions = {}
+			self._executor.shutdown(wait=True)
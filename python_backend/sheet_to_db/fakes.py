@@ -0,0 +1,387 @@
+#    genre.guide - From Google Sheets to Firestore: In-memory stand-ins for Sheets and Firestore
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import Counter, deque
+from json import dumps, loads
+from random import Random
+from re import fullmatch
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Deque, Dict, Hashable, Iterator, List, Mapping, Optional, Sequence, Tuple, TypedDict, TypeVar
+
+from google.api_core.exceptions import ResourceExhausted
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+
+from .batched_writes import MAX_BATCH_SIZE
+from .quota import RequestScheduler
+from .sheet_reads import CellData, GridResponse, RowData, TextFormat
+from .sinks import DocumentData
+
+
+T = TypeVar("T")
+
+
+# Just enough of a row of cells for the fakes: values, and optionally the text format and note of each cell
+Row = Sequence[str]
+FormatRow = Sequence[TextFormat]
+NoteRow = Sequence[Optional[str]]
+
+
+class ValueRange(TypedDict, total=False):
+	range: str
+	majorDimension: str
+	values: List[List[str]]
+
+
+class MetadataParams(TypedDict, total=False):
+	includeGridData: bool
+	ranges: List[str]
+	fields: str
+
+
+class FakeAPI:
+	"""Call counts, latency, and quota errors that are shared by everything talking to one fake backend"""
+
+	def __init__(self, *, latency: float = 0.0, quota_error_rate: float = 0.0, seed: int = 0,
+	             sleep: Callable[[float], None] = sleep) -> None:
+		self.latency = latency
+		self.quota_error_rate = quota_error_rate
+		self.sleep = sleep
+
+		self.calls: "Counter[str]" = Counter()
+		self.quota_errors = 0
+
+		self._random = Random(seed)
+		self._lock = Lock()
+
+	def call(self, name: str) -> bool:
+		"""Counts a call to name and waits out the latency, and gives back whether the call should fail with a quota error"""
+
+		with self._lock:
+			self.calls[name] += 1
+			is_over_quota = self._random.random() < self.quota_error_rate
+			if is_over_quota:
+				self.quota_errors += 1
+
+		if self.latency:
+			self.sleep(self.latency)
+
+		return is_over_quota
+
+
+class FakeErrorResponse:
+	"""What gspread's APIError looks for in a response"""
+
+	def __init__(self, code: int, status: str, message: str) -> None:
+		self.status_code = code
+		self.text = dumps({"error": {"code": code, "status": status, "message": message}})
+
+	def json(self) -> Dict[str, object]:
+		response: Dict[str, object] = loads(self.text)
+		return response
+
+
+def sheets_quota_error() -> APIError:
+	return APIError(FakeErrorResponse(429, "RESOURCE_EXHAUSTED", "Quota exceeded for quota metric 'Read requests' (fake)"))
+
+
+def firestore_quota_error(message: str) -> ResourceExhausted:
+	return ResourceExhausted(f"{message} (fake)")  # type: ignore[no-untyped-call]
+
+
+def parse_range(range_name: str) -> Tuple[str, int, int, Optional[int], Optional[int]]:
+	"""'Tab'!A1:F10, Tab!A1:F10, or 'Tab'!1:1 -> (tab, first row, first column, last row, last column)
+	   (None for the last row or column means there's no end to it)"""
+
+	title, _, a1 = range_name.rpartition("!")
+	if title.startswith("'") and title.endswith("'"):
+		title = title[1:-1].replace("''", "'")
+
+	first, _, last = a1.partition(":")
+	last = last or first
+
+	if fullmatch(r"\d+", first) and fullmatch(r"\d+", last):
+		return title, int(first), 1, int(last), None
+
+	first_row, first_col = a1_to_rowcol(first)
+	last_row, last_col = a1_to_rowcol(last)
+	return title, first_row, first_col, last_row, last_col
+
+
+class FakeWorksheet:
+	"""A tab, where values (and formats and notes, if they matter) can be any sequence of rows
+	   (including ones that make up rows as they're looked at, so huge tabs don't take up any memory)"""
+
+	def __init__(self, title: str, values: Sequence[Row], *, id: int = 0, formats: Optional[Sequence[FormatRow]] = None,
+	             notes: Optional[Sequence[NoteRow]] = None, row_count: Optional[int] = None, col_count: Optional[int] = None) -> None:
+		self.title = title
+		self.id = id
+		self.values = values
+		self.formats = formats
+		self.notes = notes
+		self.row_count = row_count if row_count is not None else len(values)
+		self.col_count = col_count if col_count is not None else max((len(values[row]) for row in range(min(len(values), 10))), default=0)
+		self.spreadsheet: "FakeSpreadsheet"
+
+	def __repr__(self) -> str:
+		return f"<FakeWorksheet {self.title!r} id:{self.id}>"
+
+	def cell(self, row: int, col: int) -> Tuple[str, TextFormat, Optional[str]]:
+		"""(value, text format, note) of a cell, 1-indexed"""
+
+		if row > len(self.values):
+			return "", {}, None
+
+		values = self.values[row - 1]
+		value = values[col - 1] if col <= len(values) else ""
+
+		cell_format: TextFormat = {}
+		if self.formats is not None:
+			formats = self.formats[row - 1]
+			cell_format = formats[col - 1] if col <= len(formats) else {}
+
+		note: Optional[str] = None
+		if self.notes is not None:
+			notes = self.notes[row - 1]
+			note = notes[col - 1] if col <= len(notes) else None
+
+		return value, cell_format, note
+
+
+class FakeSpreadsheet:
+	"""The parts of gspread's Spreadsheet that the sync uses: worksheet(s), values_get, and fetch_sheet_metadata
+	   (going through scheduler like a ScheduledClient's requests do, if there is one)"""
+
+	def __init__(self, api: FakeAPI, title: str = "Fake Sheet", id: str = "fake", *, scheduler: Optional[RequestScheduler] = None) -> None:
+		self.api = api
+		self.title = title
+		self.id = id
+		self.scheduler = scheduler
+		self._worksheets: List[FakeWorksheet] = []
+
+	def add_worksheet(self, worksheet: FakeWorksheet) -> FakeWorksheet:
+		worksheet.spreadsheet = self
+		worksheet.id = worksheet.id or len(self._worksheets) + 1
+		self._worksheets.append(worksheet)
+		return worksheet
+
+	def _request(self, name: str, key: Hashable, respond: Callable[[], T]) -> T:
+		def send() -> T:
+			if self.api.call(f"sheets.{name}"):
+				raise sheets_quota_error()
+			return respond()
+
+		if self.scheduler is None:
+			return send()
+		return self.scheduler.call((self.id, name, key), send)
+
+	def worksheets(self) -> List[FakeWorksheet]:
+		return self._request("fetch_sheet_metadata", "worksheets", lambda: list(self._worksheets))
+
+	def worksheet(self, title: str) -> FakeWorksheet:
+		return self._request("fetch_sheet_metadata", f"worksheet {title}", lambda: self._find(title))
+
+	def _find(self, title: str) -> FakeWorksheet:
+		for worksheet in self._worksheets:
+			if worksheet.title == title:
+				return worksheet
+		raise WorksheetNotFound(title)
+
+	def values_get(self, range_name: str, params: Optional[Mapping[str, object]] = None) -> ValueRange:
+		return self._request("values_get", range_name, lambda: self._values(range_name))
+
+	def _values(self, range_name: str) -> ValueRange:
+		title, first_row, first_col, last_row, last_col = parse_range(range_name)
+		worksheet = self._find(title)
+		last_row = min(last_row or worksheet.row_count, len(worksheet.values))
+
+		values: List[List[str]] = []
+		for row in range(first_row, last_row + 1):
+			row_values = list(worksheet.values[row - 1][first_col - 1:last_col])
+			# Like the real API, leave out empty cells at the end of a row
+			while row_values and row_values[-1] == "":
+				row_values.pop()
+			values.append(row_values)
+
+		# And empty rows at the end
+		while values and not values[-1]:
+			values.pop()
+
+		response: ValueRange = {"range": range_name, "majorDimension": "ROWS"}
+		if values:
+			response["values"] = values
+		return response
+
+	def fetch_sheet_metadata(self, params: Optional[MetadataParams] = None) -> Mapping[str, object]:
+		given_params: MetadataParams = params or {}
+		return self._request("fetch_sheet_metadata", dumps(given_params, sort_keys=True), lambda: self._metadata(given_params))
+
+	def _metadata(self, params: MetadataParams) -> Mapping[str, object]:
+		if not params.get("includeGridData"):
+			return {"sheets": [{"properties": {"title": worksheet.title, "sheetId": worksheet.id}} for worksheet in self._worksheets]}
+
+		fields = params.get("fields", "formattedValue,effectiveFormat,note")
+		title, first_row, first_col, last_row, last_col = parse_range(params["ranges"][0])
+		worksheet = self._find(title)
+		last_row = last_row or worksheet.row_count
+		last_col = last_col or worksheet.col_count
+
+		row_data: List[RowData] = []
+		for row in range(first_row, last_row + 1):
+			cells: List[CellData] = []
+			for col in range(first_col, last_col + 1):
+				value, cell_format, note = worksheet.cell(row, col)
+
+				cell: CellData = {}
+				if "formattedValue" in fields and value != "":
+					cell["formattedValue"] = value
+				if "effectiveFormat" in fields:
+					cell["effectiveFormat"] = {"textFormat": cell_format}
+				if "note" in fields and note:
+					cell["note"] = note
+				cells.append(cell)
+
+			row_data.append({"values": cells})
+
+		response: GridResponse = {"sheets": [{"data": [{"rowData": row_data}]}]}
+		return response
+
+
+class FakeDocumentSnapshot:
+	def __init__(self, reference: "FakeDocumentReference", data: Optional[Dict[str, object]]) -> None:
+		self.reference = reference
+		self.id = reference.id
+		self.exists = data is not None
+		self._data = data
+
+	def to_dict(self) -> Optional[Dict[str, object]]:
+		return self._data
+
+
+class FakeDocumentReference:
+	def __init__(self, firestore: "FakeFirestore", path: str) -> None:
+		self._firestore = firestore
+		self.path = path
+		self.id = path.rpartition("/")[2]
+
+	def __eq__(self, other: object) -> bool:
+		return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+	def __hash__(self) -> int:
+		return hash(self.path)
+
+	def get(self) -> FakeDocumentSnapshot:
+		if self._firestore.api.call("firestore.get"):
+			raise firestore_quota_error("quota exceeded")
+		return FakeDocumentSnapshot(self, self._firestore.documents.get(self.path))
+
+
+class FakeCollectionReference:
+	def __init__(self, firestore: "FakeFirestore", name: str) -> None:
+		self._firestore = firestore
+		self.id = name
+
+	def document(self, document_id: str) -> FakeDocumentReference:
+		return FakeDocumentReference(self._firestore, f"{self.id}/{document_id}")
+
+	def list_documents(self) -> Iterator[FakeDocumentReference]:
+		self._firestore.api.call("firestore.list_documents")
+		prefix = f"{self.id}/"
+		return iter([FakeDocumentReference(self._firestore, path) for path in list(self._firestore.documents) if path.startswith(prefix)])
+
+	def stream(self) -> Iterator[FakeDocumentSnapshot]:
+		self._firestore.api.call("firestore.stream")
+		prefix = f"{self.id}/"
+		return iter([
+			FakeDocumentSnapshot(FakeDocumentReference(self._firestore, path), data)
+			for path, data in list(self._firestore.documents.items()) if path.startswith(prefix)
+		])
+
+
+class FakeWriteBatch:
+	def __init__(self, firestore: "FakeFirestore") -> None:
+		self._firestore = firestore
+		self._writes: List[Tuple[FakeDocumentReference, Optional[Dict[str, object]]]] = []
+
+	def set(self, reference: FakeDocumentReference, document: DocumentData) -> None:
+		self._writes.append((reference, dict(document)))
+
+	def delete(self, reference: FakeDocumentReference) -> None:
+		self._writes.append((reference, None))
+
+	def commit(self) -> List[None]:
+		if len(self._writes) > MAX_BATCH_SIZE:
+			raise ValueError(f"a batch can't have more than {MAX_BATCH_SIZE} writes (fake)")
+
+		if self._firestore.api.call("firestore.commit"):
+			raise firestore_quota_error("quota exceeded")
+
+		with self._firestore.lock:
+			if self._firestore.is_too_busy_for(len(self._writes)):
+				self._firestore.throttled += 1
+				raise firestore_quota_error("too much contention on the index")
+
+			for reference, document in self._writes if self._firestore.keep_documents else []:
+				if document is None:
+					self._firestore.documents.pop(reference.path, None)
+				else:
+					self._firestore.documents[reference.path] = document
+			self._firestore.writes += len(self._writes)
+
+		return [None] * len(self._writes)
+
+
+class FakeFirestore:
+	"""The parts of the Firestore client that the sync uses: collections, documents, and write batches,
+	   with every document kept in a dict by its path (unless keep_documents is False, when writes are only counted)
+	   With a capacity, commits that would make it more than that many writes in the last second (by clock) are throttled"""
+
+	def __init__(self, api: FakeAPI, *, keep_documents: bool = True, capacity: Optional[float] = None,
+	             clock: Callable[[], float] = monotonic) -> None:
+		self.api = api
+		self.keep_documents = keep_documents
+		self.capacity = capacity
+		self.clock = clock
+		self.lock = Lock()
+		self.documents: Dict[str, Dict[str, object]] = {}
+		self.writes = 0
+		self.throttled = 0
+
+		# (when, how many writes) of the commits in the last second
+		self._recent: Deque[Tuple[float, int]] = deque()
+
+	def is_too_busy_for(self, writes: int) -> bool:
+		"""Whether writes more writes right now would go over capacity (and if not, counts them towards it)"""
+
+		if self.capacity is None:
+			return False
+
+		now = self.clock()
+		while self._recent and self._recent[0][0] <= now - 1:
+			self._recent.popleft()
+
+		if sum(count for _, count in self._recent) + writes > self.capacity:
+			return True
+
+		self._recent.append((now, writes))
+		return False
+
+	def collection(self, name: str) -> FakeCollectionReference:
+		return FakeCollectionReference(self, name)
+
+	def batch(self) -> FakeWriteBatch:
+		return FakeWriteBatch(self)
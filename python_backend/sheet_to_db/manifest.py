@@ -0,0 +1,186 @@
+#    genre.guide - From Google Sheets to Firestore: Track and subgenre manifests
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import date
+from json import dump, load
+from pathlib import Path
+from hashlib import sha1
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, TypedDict
+
+
+# (subgenre, year of release): which posting list a track is in
+PostingKey = Tuple[str, str]
+
+
+class ManifestEntry(TypedDict):
+	hash: str
+	releaseDate: str
+	subgenres: List[str]
+
+
+class TrackManifest:
+	"""What was written to the tracks collection last time, by track ID,
+	   so that the next run only has to write (or delete) what's different"""
+
+	def __init__(self, path: Path) -> None:
+		self.path = path
+		self.entries: Dict[str, ManifestEntry] = {}
+		# Track IDs that showed up during this run
+		self.seen: Set[str] = set()
+		# Posting lists that gained, lost, or moved a track during this run
+		self.touched: Set[PostingKey] = set()
+
+		if path.exists():
+			with path.open(encoding="utf8") as file:
+				self.entries = load(file)
+
+			# Manifests from before posting lists existed don't have subgenres in them
+			for entry in self.entries.values():
+				entry.setdefault("subgenres", [])
+
+	def is_unchanged(self, track_id: str, content_hash: str) -> bool:
+		entry = self.entries.get(track_id)
+		return entry is not None and entry["hash"] == content_hash
+
+	def record(self, track_id: str, content_hash: str, release_date: str, subgenres: Iterable[str] = ()) -> None:
+		entry: ManifestEntry = {"hash": content_hash, "releaseDate": release_date, "subgenres": sorted(subgenres)}
+
+		previous_entry = self.entries.get(track_id)
+		if previous_entry is None or previous_entry["subgenres"] != entry["subgenres"] or previous_entry["releaseDate"] != release_date:
+			self.touch(previous_entry)
+			self.touch(entry)
+
+		self.entries[track_id] = entry
+		self.seen.add(track_id)
+
+	def forget(self, track_id: str) -> None:
+		self.touch(self.entries.pop(track_id, None))
+
+	def touch(self, entry: Optional[ManifestEntry]) -> None:
+		if entry is not None:
+			self.touched.update(posting_keys(entry))
+
+	def unseen_between(self, start: date, end: date) -> Set[str]:
+		"""Track IDs released from start back to end (inclusive) that were written before but didn't show up this time"""
+
+		newest, oldest = start.isoformat(), end.isoformat()
+		return {
+			track_id
+			for track_id, entry in self.entries.items()
+			if oldest <= entry["releaseDate"] <= newest and track_id not in self.seen
+		}
+
+	def save(self) -> None:
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+
+		# Write to the side and swap it in so that a crash can't leave a half-written manifest behind
+		temporary_path = self.path.with_suffix(".tmp")
+		with temporary_path.open("w", encoding="utf8") as file:
+			dump(self.entries, file, sort_keys=True)
+		temporary_path.replace(self.path)
+
+
+class SubgenreManifestData(TypedDict):
+	# Every subgenre document as it was last written, by primary name
+	documents: Dict[str, Dict[str, object]]
+	aliasIndexRevision: Optional[str]
+
+
+class SubgenreManifest:
+	"""What was written to the subgenres collection (and which alias index) last time,
+	   so that the next run only has to write the subgenres that changed and delete the ones that are gone"""
+
+	def __init__(self, path: Path) -> None:
+		self.path = path
+		self.data: SubgenreManifestData = {"documents": {}, "aliasIndexRevision": None}
+		self.seen: Set[str] = set()
+
+		# What's different this run
+		self.added: List[str] = []
+		self.modified: Dict[str, List[str]] = {}
+		self.removed: List[str] = []
+
+		if path.exists():
+			with path.open(encoding="utf8") as file:
+				self.data = load(file)
+
+	@property
+	def documents(self) -> Dict[str, Dict[str, object]]:
+		return self.data["documents"]
+
+	def record(self, primary_name: str, document: Mapping[str, object]) -> bool:
+		"""Remembers document as what primary_name's is now, and gives back whether it's different from what was written last time"""
+
+		self.seen.add(primary_name)
+		previous_document = self.documents.get(primary_name)
+		if previous_document == document:
+			return False
+
+		if previous_document is None:
+			self.added.append(primary_name)
+		else:
+			self.modified[primary_name] = sorted(
+				field for field in {*previous_document, *document} if previous_document.get(field) != document.get(field)
+			)
+
+		self.documents[primary_name] = dict(document)
+		return True
+
+	def unseen(self) -> List[str]:
+		"""Subgenres that were written before but didn't show up this time"""
+
+		return sorted(primary_name for primary_name in self.documents if primary_name not in self.seen)
+
+	def forget(self, primary_name: str) -> None:
+		if self.documents.pop(primary_name, None) is not None:
+			self.removed.append(primary_name)
+
+	def summary(self, *, limit: int = 10) -> str:
+		def some_of(names: List[str]) -> str:
+			shown = ", ".join(names[:limit])
+			return f"{shown}, and {len(names) - limit} more" if len(names) > limit else shown
+
+		lines = [f"{len(self.added)} added, {len(self.modified)} modified, {len(self.removed)} removed"]
+		if self.added:
+			lines.append(f"  added: {some_of(sorted(self.added))}")
+		if self.modified:
+			modified = [f"{name} ({', '.join(fields)})" for name, fields in sorted(self.modified.items())]
+			lines.append(f"  modified: {some_of(modified)}")
+		if self.removed:
+			lines.append(f"  removed: {some_of(sorted(self.removed))}")
+		return "\n".join(lines)
+
+	def save(self) -> None:
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+
+		temporary_path = self.path.with_suffix(".tmp")
+		with temporary_path.open("w", encoding="utf8") as file:
+			dump(self.data, file, sort_keys=True, ensure_ascii=False)
+		temporary_path.replace(self.path)
+
+
+def manifest_path_for(path: Path, sink: str) -> Path:
+	"""Where the manifest at path is kept for sink (every sink has its own, since they don't hold the same documents)"""
+
+	if sink == "firestore":
+		return path
+	return path.with_name(f"{path.stem}-{sha1(sink.encode('utf8')).hexdigest()[:12]}.json")
+
+
+def posting_keys(entry: ManifestEntry) -> Iterator[PostingKey]:
+	year = entry["releaseDate"][:4]
+	for subgenre in entry["subgenres"]:
+		yield subgenre, year
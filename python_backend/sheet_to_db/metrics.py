@@ -0,0 +1,188 @@
+#    genre.guide - From Google Sheets to Firestore: Run metrics
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from json import dump
+from pathlib import Path
+from sys import stderr
+from threading import local, Lock
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, TypedDict, TypeVar
+
+
+T = TypeVar("T")
+
+
+class StageReport(TypedDict):
+	seconds: float
+	items: int
+
+
+class RunReport(TypedDict):
+	name: str
+	startedAt: str
+	seconds: float
+	# Time spent in each stage, not counting time spent in stages inside of it
+	stages: Dict[str, StageReport]
+	counters: Dict[str, int]
+
+
+class RunMetrics:
+	"""Wall time and item counts of the stages of a sync, and counters (API calls, bytes, retries, ...) from anywhere in it"""
+
+	def __init__(self, name: str) -> None:
+		self.name = name
+		self.started_at = datetime.now()
+		self._start = perf_counter()
+
+		self.stage_seconds: Dict[str, float] = {}
+		self.stage_items: "Counter[str]" = Counter()
+		self.counters: "Counter[str]" = Counter()
+
+		self._lock = Lock()
+		# The stages that each thread is in right now, innermost last
+		self._stack = local()
+
+	def count(self, counter: str, amount: int = 1) -> None:
+		with self._lock:
+			self.counters[counter] += amount
+
+	@contextmanager
+	def stage(self, name: str, items: int = 0) -> Iterator[None]:
+		"""Times what's inside of it as part of the name stage (and not as part of any stage it's inside of)"""
+
+		stack: List[List[float]] = self._stack.__dict__.setdefault("stages", [])
+		# [when it started, time spent in stages inside of it]
+		frame = [perf_counter(), 0.0]
+		stack.append(frame)
+
+		try:
+			yield
+		finally:
+			stack.pop()
+			elapsed = perf_counter() - frame[0]
+			if stack:
+				stack[-1][1] += elapsed
+
+			with self._lock:
+				self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed - frame[1]
+				self.stage_items[name] += items
+
+	def timed(self, name: str, items: Iterable[T]) -> Iterator[T]:
+		"""Passes items through, timing how long each one takes to come out of items as part of the name stage"""
+
+		iterator = iter(items)
+		while True:
+			with self.stage(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			with self._lock:
+				self.stage_items[name] += 1
+			yield item
+
+	@property
+	def seconds(self) -> float:
+		return perf_counter() - self._start
+
+	def report(self) -> RunReport:
+		with self._lock:
+			return {
+				"name": self.name,
+				"startedAt": self.started_at.isoformat(),
+				"seconds": self.seconds,
+				"stages": {
+					stage: {"seconds": seconds, "items": self.stage_items[stage]}
+					for stage, seconds in self.stage_seconds.items()
+				},
+				"counters": dict(sorted(self.counters.items())),
+			}
+
+	def save(self, path: Path) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with path.open("w", encoding="utf8") as file:
+			dump(self.report(), file, indent="\t")
+
+	def summary(self) -> str:
+		report = self.report()
+		lines = [f"⏱️ {report['name']} took {report['seconds']:.2f} s"]
+
+		for stage, stage_report in report["stages"].items():
+			rate = f", {stage_report['items'] / stage_report['seconds']:,.0f}/s" if stage_report["items"] and stage_report["seconds"] else ""
+			lines.append(f"  {stage}: {stage_report['seconds']:.2f} s for {stage_report['items']:,} items{rate}")
+
+		for counter, value in report["counters"].items():
+			lines.append(f"  {counter}: {value:,}")
+
+		return "\n".join(lines)
+
+
+# What everything counts towards; replaced at the start of every run by start_run
+current_run = RunMetrics("sync")
+
+
+def start_run(name: str) -> RunMetrics:
+	global current_run
+	current_run = RunMetrics(name)
+	return current_run
+
+
+class ProgressLine:
+	"""One line (rewritten in place) of how much is done, how fast, and how long is left"""
+
+	def __init__(self, label: str, *, stream: TextIO = stderr, interval: float = 0.5, enabled: Optional[bool] = None) -> None:
+		self.label = label
+		self.stream = stream
+		self.interval = interval
+		# Only worth showing to a person (and not in logs)
+		self.enabled = stream.isatty() if enabled is None else enabled
+
+		self._start = perf_counter()
+		self._last_shown = 0.0
+		self._width = 0
+
+	def update(self, done: int, *, fraction: Optional[float] = None, force: bool = False) -> None:
+		"""done items so far, and (if it's known) the fraction of all of the work that that is"""
+
+		if not self.enabled:
+			return
+
+		now = perf_counter()
+		if not force and now - self._last_shown < self.interval:
+			return
+		self._last_shown = now
+
+		elapsed = now - self._start
+		line = f"{self.label}: {done:,} done, {done / elapsed if elapsed else 0:,.0f}/s"
+		if fraction is not None and 0 < fraction <= 1:
+			remaining = timedelta(seconds=round(elapsed * (1 - fraction) / fraction))
+			line += f", {fraction:.0%}, ETA {remaining}"
+
+		# Pad over whatever was left from a longer line before
+		self.stream.write("\r" + line.ljust(self._width))
+		self.stream.flush()
+		self._width = len(line)
+
+	def finish(self, done: int) -> None:
+		if not self.enabled:
+			return
+
+		self.update(done, fraction=1.0, force=True)
+		self.stream.write("\n")
+		self.stream.flush()
@@ -0,0 +1,127 @@
+#    genre.guide - From Google Sheets to Firestore: Running the stages of a sync at the same time
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from asyncio import FIRST_EXCEPTION, gather, get_running_loop, Queue, run, Task, wait
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, cast, Iterable, Iterator, List, NoReturn, Optional, overload, Sequence, Tuple, TypeVar
+
+
+T = TypeVar("T")
+U = TypeVar("U")
+V = TypeVar("V")
+
+# A name (for the threads it runs on) and what it does to every item that comes to it
+# What the items are changes from stage to stage, which a list of stages can't say, so any function of one item is taken
+Stage = Tuple[str, Callable[[NoReturn], object]]
+
+# Put into a queue after the last item
+DONE = object()
+
+
+async def produce(source: Iterator[object], out_queue: "Queue[object]", executor: ThreadPoolExecutor) -> None:
+	loop = get_running_loop()
+	while True:
+		item = await loop.run_in_executor(executor, next, source, DONE)
+		await out_queue.put(item)
+		if item is DONE:
+			return
+
+
+async def consume(function: Callable[[object], object], in_queue: "Queue[object]", out_queue: Optional["Queue[object]"],
+                  executor: ThreadPoolExecutor) -> None:
+	loop = get_running_loop()
+	while True:
+		item = await in_queue.get()
+		if item is DONE:
+			break
+
+		result = await loop.run_in_executor(executor, function, item)
+		if out_queue is not None:
+			await out_queue.put(result)
+
+	if out_queue is not None:
+		await out_queue.put(DONE)
+
+
+async def first_failure(tasks: List["Task[None]"]) -> None:
+	"""Waits for every task, unless one fails, in which case the rest are cancelled and its exception is raised"""
+
+	done, pending = await wait(tasks, return_when=FIRST_EXCEPTION)
+	for task in pending:
+		task.cancel()
+	await gather(*pending, return_exceptions=True)
+
+	for task in done:
+		error = None if task.cancelled() else task.exception()
+		if error is not None:
+			raise error
+
+
+async def pipeline(source: Iterable[object], stages: Sequence[Stage], *, queue_size: int = 2) -> None:
+	"""Pulls items out of source and passes each one through stages, in order, with every stage working at the same time
+	   (each on a thread of its own, so blocking reads, transforms, and writes can overlap)
+	   Stages are connected by queues of at most queue_size items, so a slow stage holds up the ones before it instead of letting items pile up
+	   If anything fails, everything else is stopped and the exception is raised"""
+
+	queues: List["Queue[object]"] = [Queue(maxsize=queue_size) for _ in stages]
+	executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=name) for name in ["source", *[name for name, _ in stages]]]
+	iterator = iter(source)
+
+	loop = get_running_loop()
+	try:
+		tasks = [
+			loop.create_task(produce(iterator, queues[0], executors[0])),
+			# Each stage is only ever given what the stage before it gives back
+			*(loop.create_task(consume(cast(Callable[[object], object], function), queues[index],
+			                           queues[index + 1] if index + 1 < len(stages) else None, executors[index + 1]))
+			  for index, (_, function) in enumerate(stages)),
+		]
+		await first_failure(tasks)
+	finally:
+		# Whatever a stage was in the middle of when it was cancelled still runs to the end (threads can't be interrupted)
+		for executor in executors:
+			executor.shutdown(wait=True)
+
+		# Let the source clean up after itself (like stopping the threads that read ahead) if it's stopped early
+		close = getattr(iterator, "close", None)
+		if close is not None:
+			close()
+
+
+def run_pipeline(source: Iterable[object], stages: Sequence[Stage], *, queue_size: int = 2) -> None:
+	run(pipeline(source, stages, queue_size=queue_size))
+
+
+@overload
+def run_concurrently(__first: Callable[[], T], __second: Callable[[], U]) -> Tuple[T, U]:
+	...
+
+
+@overload
+def run_concurrently(__first: Callable[[], T], __second: Callable[[], U], __third: Callable[[], V]) -> Tuple[T, U, V]:
+	...
+
+
+def run_concurrently(*functions: Callable[[], object]) -> Tuple[object, ...]:
+	"""Calls every function at the same time (on threads of their own) and gives back what they give back, in order"""
+
+	async def call_all() -> Tuple[object, ...]:
+		loop = get_running_loop()
+		with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+			results: List[object] = await gather(*(loop.run_in_executor(executor, function) for function in functions))
+		return tuple(results)
+
+	return run(call_all())
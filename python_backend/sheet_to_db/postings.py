@@ -0,0 +1,144 @@
+#    genre.guide - From Google Sheets to Firestore: Subgenre posting lists
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+from math import ceil
+from typing import cast, Collection, DefaultDict, Dict, List, Optional, Set, Tuple, TypedDict
+from urllib.parse import quote
+
+from .batched_writes import BatchedWriter
+from .manifest import PostingKey
+from .sinks import Ref, SinkCollection
+
+
+# Every track with a subgenre in it, by subgenre and year, in documents of at most MAX_POSTINGS_PER_SHARD tracks
+POSTINGS_COLLECTION = "subgenreTracks"
+MAX_POSTINGS_PER_SHARD = 1000
+
+
+class PostingShard(TypedDict):
+	subgenre: str
+	year: int
+	# Which shard this is (0 has the newest tracks), out of how many this subgenre has in this year
+	shard: int
+	shards: int
+
+	# Newest first, lined up with each other
+	trackIds: List[str]
+	releaseDates: List[str]
+
+
+def shard_document_id(subgenre: str, year: str, shard: int) -> str:
+	# Subgenre names can have slashes in them, which document IDs can't
+	return f"{quote(subgenre, safe='')}:{year}:{shard}"
+
+
+class PostingChanges:
+	"""What a track sync has gone through so far, to be merged into the posting lists that are already stored
+	   (so that they stay whole no matter how little of the sheets one sync covers, or what's kept locally between syncs)"""
+
+	def __init__(self, newest: Optional[str] = None) -> None:
+		# Every track released from newest back to how far the sync has gotten comes through it,
+		# so a stored track from then that didn't isn't on the sheets anymore (unless newest is None, when nothing can be said)
+		self.newest = newest
+		# Which posting lists each track that came through (or was deleted, with none) is in now
+		self.keys_of: Dict[str, Set[PostingKey]] = {}
+		# The (track ID -> release date) postings that haven't been merged in yet
+		self.pending: DefaultDict[PostingKey, Dict[str, str]] = defaultdict(dict)
+
+	def add(self, track_id: str, release_date: str, subgenres: Collection[str]) -> None:
+		keys = {(subgenre, release_date[:4]) for subgenre in subgenres}
+		self.keys_of[track_id] = keys
+		for key in keys:
+			self.pending[key][track_id] = release_date
+
+	def remove(self, track_id: str) -> None:
+		self.keys_of[track_id] = set()
+
+	def keeps(self, key: PostingKey, track_id: str, release_date: str, through: Optional[str]) -> bool:
+		"""Whether a track that's stored in key's posting list is still in it, given that the sync has gone through every track back to through"""
+
+		keys = self.keys_of.get(track_id)
+		if keys is not None:
+			return key in keys
+		return self.newest is None or through is None or not through <= release_date <= self.newest
+
+
+def posting_shards(subgenre: str, year: str, postings: List[Tuple[str, str]], *, shard_size: int) -> List[PostingShard]:
+	shard_count = ceil(len(postings) / shard_size)
+
+	return [
+		{
+			"subgenre": subgenre,
+			"year": int(year),
+			"shard": shard_num,
+			"shards": shard_count,
+			"trackIds": [track_id for _, track_id in postings[start:start + shard_size]],
+			"releaseDates": [release_date for release_date, _ in postings[start:start + shard_size]],
+		}
+		for shard_num, start in enumerate(range(0, len(postings), shard_size))
+	]
+
+
+def read_posting_list(collection_ref: SinkCollection[Ref], subgenre: str, year: str) -> List[PostingShard]:
+	"""The shards of a posting list as they're stored now, in order"""
+
+	first = collection_ref.document(shard_document_id(subgenre, year, 0)).get().to_dict()
+	if first is None:
+		return []
+
+	shards = [cast(PostingShard, first)]
+	for shard_num in range(1, shards[0]["shards"]):
+		shard = collection_ref.document(shard_document_id(subgenre, year, shard_num)).get().to_dict()
+		if shard is not None:
+			shards.append(cast(PostingShard, shard))
+	return shards
+
+
+def merge_posting_lists(writer: BatchedWriter[Ref], collection_ref: SinkCollection[Ref], changes: PostingChanges, *, through: Optional[str] = None,
+                        also: Collection[PostingKey] = (), shard_size: int = MAX_POSTINGS_PER_SHARD) -> Tuple[int, int]:
+	"""Merges the postings that changes has gathered since the last merge into the posting lists stored in collection_ref,
+	   along with the lists in also (which may have lost a track without gaining any), given that every track released back to through came through changes
+	   Only shards that come out different are written, and shards that a list doesn't need anymore are deleted
+	   Gives back how many shards were written and deleted"""
+
+	written = deleted = 0
+
+	for key in sorted({*changes.pending, *also}):
+		subgenre, year = key
+		stored_shards = read_posting_list(collection_ref, subgenre, year)
+
+		postings = {
+			track_id: release_date
+			for shard in stored_shards
+			for track_id, release_date in zip(shard["trackIds"], shard["releaseDates"])
+			if changes.keeps(key, track_id, release_date, through)
+		}
+		postings.update(changes.pending.get(key, {}))
+
+		shards = posting_shards(subgenre, year, sorted(((release_date, track_id) for track_id, release_date in postings.items()), reverse=True),
+		                        shard_size=shard_size)
+		for shard in shards:
+			if shard["shard"] >= len(stored_shards) or stored_shards[shard["shard"]] != shard:
+				writer.set(collection_ref.document(shard_document_id(subgenre, year, shard["shard"])), shard)
+				written += 1
+
+		for shard_num in range(len(shards), stored_shards[0]["shards"] if stored_shards else 0):
+			writer.delete(collection_ref.document(shard_document_id(subgenre, year, shard_num)))
+			deleted += 1
+
+	changes.pending.clear()
+	return written, deleted
@@ -0,0 +1,210 @@
+#    genre.guide - From Google Sheets to Firestore: Staying within the Sheets API's quotas
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import Future
+from json import dumps
+from random import Random
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+from typing import Callable, cast, Dict, Hashable, Mapping, Optional, Protocol, Sequence, TypeVar
+
+from gspread import Client
+from gspread.exceptions import APIError
+from requests import Session
+
+from . import metrics, SHEETS_MAX_CONCURRENT_REQUESTS, SHEETS_READS_PER_MINUTE, SHEETS_READS_PER_MINUTE_PER_USER
+
+
+T = TypeVar("T")
+
+# Responses that mean "try again later" rather than "this request is wrong"
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+	"""Allows per_minute requests a minute on average, and bursts of up to per_minute at once after a quiet spell"""
+
+	def __init__(self, per_minute: int, *, clock: Callable[[], float] = monotonic, sleep: Callable[[float], None] = sleep) -> None:
+		if per_minute < 1:
+			raise ValueError(f"per_minute needs to be at least 1, not {per_minute}")
+
+		self.rate = per_minute / 60
+		self.capacity = float(per_minute)
+		self.clock = clock
+		self.sleep = sleep
+
+		self._tokens = self.capacity
+		self._updated = clock()
+		self._lock = Lock()
+
+	def _refill(self) -> None:
+		now = self.clock()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def take(self) -> float:
+		"""Takes a token, waiting until there is one if there isn't, and gives back how many seconds that took"""
+
+		with self._lock:
+			self._refill()
+			# Going negative reserves the next token to come in, so whoever asked first gets it first
+			self._tokens -= 1
+			wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+		if wait:
+			self.sleep(wait)
+		return wait
+
+	def drain(self) -> None:
+		"""Throws away the tokens that are left (after the API says that the quota is used up, whatever the bucket thought)"""
+
+		with self._lock:
+			self._refill()
+			self._tokens = min(self._tokens, 0.0)
+
+
+def retry_after(error: APIError) -> Optional[float]:
+	"""The seconds that the API asked to wait before trying again, if it said"""
+
+	headers = getattr(error.response, "headers", None) or {}
+	try:
+		return float(headers["Retry-After"])
+	except (KeyError, TypeError, ValueError):
+		return None
+
+
+class RequestScheduler:
+	"""What every request to one API goes through: a token from each of its quota's buckets first,
+	   at most max_concurrent requests at the same time, and retries with exponential backoff (and full jitter)
+	   when the API says it's over quota or having trouble
+	   Identical requests (by key) that are made while one is already going wait for its response instead of being sent again"""
+
+	def __init__(self, name: str, buckets: Sequence[TokenBucket], *, max_concurrent: int, max_attempts: int = 7,
+	             initial_backoff: float = 1.0, max_backoff: float = 64.0, seed: Optional[int] = None,
+	             sleep: Callable[[float], None] = sleep) -> None:
+		self.name = name
+		self.buckets = buckets
+		self.max_attempts = max_attempts
+		self.initial_backoff = initial_backoff
+		self.max_backoff = max_backoff
+		self.sleep = sleep
+
+		self._slots = BoundedSemaphore(max_concurrent)
+		self._random = Random(seed)
+		# (Whatever type of result each one's request gives back)
+		self._in_flight: Dict[Hashable, "Future[object]"] = {}
+		self._lock = Lock()
+
+	def limit_concurrency(self, limit: int) -> None:
+		self._slots = BoundedSemaphore(limit)
+
+	def call(self, key: Optional[Hashable], request: Callable[[], T]) -> T:
+		"""request() once it's allowed to go, or what an identical request already going gives back (if key isn't None)"""
+
+		if key is None:
+			return self._call_with_retries(request)
+
+		with self._lock:
+			shared = self._in_flight.get(key)
+			if shared is None:
+				future: "Future[object]" = Future()
+				self._in_flight[key] = future
+
+		if shared is not None:
+			metrics.current_run.count(f"{self.name}.coalesced")
+			return cast(T, shared.result())
+
+		try:
+			future.set_result(self._call_with_retries(request))
+		except BaseException as error:
+			future.set_exception(error)
+		finally:
+			with self._lock:
+				del self._in_flight[key]
+
+		return cast(T, future.result())
+
+	def _call_with_retries(self, request: Callable[[], T]) -> T:
+		for attempt in range(self.max_attempts):
+			waited = sum(bucket.take() for bucket in self.buckets)
+			if waited:
+				metrics.current_run.count(f"{self.name}.quota_wait_ms", round(waited * 1000))
+
+			try:
+				with self._slots:
+					return request()
+			except APIError as error:
+				status = error.response.status_code
+				if status not in RETRYABLE_STATUSES or attempt + 1 == self.max_attempts:
+					raise
+
+				if status == 429:
+					metrics.current_run.count(f"{self.name}.throttled")
+					# Every other request would just be turned away too until the quota refills
+					for bucket in self.buckets:
+						bucket.drain()
+				metrics.current_run.count(f"{self.name}.retries")
+
+				backoff = self._random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+				self.sleep(max(backoff, retry_after(error) or 0.0))
+
+		raise AssertionError("unreachable")
+
+
+# Shared by everything that reads from Google Sheets (reads count towards the same quota no matter which sheet they're from)
+sheets_scheduler = RequestScheduler(
+	"sheets",
+	[TokenBucket(SHEETS_READS_PER_MINUTE_PER_USER), TokenBucket(SHEETS_READS_PER_MINUTE)],
+	max_concurrent=SHEETS_MAX_CONCURRENT_REQUESTS,
+)
+
+
+def share_quota(ways: int) -> None:
+	"""Gives sheets_scheduler only 1/ways of the quota, for when ways processes are reading from Sheets at the same time"""
+
+	sheets_scheduler.buckets = [
+		TokenBucket(max(1, SHEETS_READS_PER_MINUTE_PER_USER // ways)),
+		TokenBucket(max(1, SHEETS_READS_PER_MINUTE // ways)),
+	]
+
+
+class SheetsResponse(Protocol):
+	"""What gspread reads from a response (a requests.Response, or anything standing in for one)"""
+
+	@property
+	def text(self) -> str:
+		...
+
+	def json(self) -> object:
+		...
+
+
+class ScheduledClient(Client):
+	"""A gspread Client whose every request goes through a RequestScheduler (sheets_scheduler unless told otherwise)"""
+
+	def __init__(self, auth: object, *, session: Optional[Session] = None, scheduler: Optional[RequestScheduler] = None) -> None:
+		super().__init__(auth, session=session)
+		self.scheduler = scheduler or sheets_scheduler
+
+	def request(self, method: str, endpoint: str, params: Optional[Mapping[str, object]] = None, data: object = None, json: object = None,
+	            files: object = None, headers: Optional[Dict[str, str]] = None) -> SheetsResponse:
+		# Only reads are the same request if they look the same
+		key = (endpoint, dumps(params, sort_keys=True)) if method == "get" else None
+
+		def send() -> SheetsResponse:
+			return super(ScheduledClient, self).request(method, endpoint, params=params, data=data, json=json, files=files, headers=headers)
+
+		return self.scheduler.call(key, send)
@@ -0,0 +1,159 @@
+#    genre.guide - From Google Sheets to Firestore: Sheets response cache
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from json import dumps, loads
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+from time import time
+from typing import cast, Dict, Mapping, Optional
+
+from gspread.urls import DRIVE_FILES_API_V3_URL, SPREADSHEETS_API_V4_BASE_URL
+from requests import Session
+
+from . import metrics
+from .quota import ScheduledClient, SheetsResponse, sheets_scheduler
+
+
+CACHE_MODES = ("off", "on", "offline")
+
+
+class CacheMiss(LookupError):
+	pass
+
+
+class CachedResponse:
+	"""Stands in for a requests.Response, as far as gspread's reading methods are concerned"""
+
+	ok = True
+	status_code = 200
+
+	def __init__(self, text: str) -> None:
+		self.text = text
+
+	def json(self) -> object:
+		return loads(self.text)
+
+
+class ResponseCache:
+	"""Raw Sheets API responses in SQLite, by request and the revision of the spreadsheet they came from"""
+
+	def __init__(self, path: Path) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		self._lock = Lock()
+		self._connection = connect(str(path), check_same_thread=False)
+		with self._connection:
+			self._connection.execute("""
+				CREATE TABLE IF NOT EXISTS responses (
+					request TEXT PRIMARY KEY,
+					spreadsheet TEXT NOT NULL,
+					revision TEXT NOT NULL,
+					body TEXT NOT NULL,
+					fetched_at REAL NOT NULL
+				)
+			""")
+
+	def get(self, request: str, revision: Optional[str]) -> Optional[str]:
+		"""The cached body for request, as long as it's from revision (or from any revision, if revision is None)"""
+
+		with self._lock:
+			row = self._connection.execute("SELECT revision, body FROM responses WHERE request = ?", (request,)).fetchone()
+
+		if row is None:
+			return None
+
+		cached_revision, body = row
+		if revision is not None and cached_revision != revision:
+			return None
+
+		body_text: str = body
+		return body_text
+
+	def put(self, request: str, spreadsheet: str, revision: str, body: str) -> None:
+		with self._lock, self._connection:
+			self._connection.execute(
+				"INSERT OR REPLACE INTO responses (request, spreadsheet, revision, body, fetched_at) VALUES (?, ?, ?, ?, ?)",
+				(request, spreadsheet, revision, body, time()),
+			)
+
+	def close(self) -> None:
+		self._connection.close()
+
+
+def spreadsheet_key_from_url(url: str) -> Optional[str]:
+	if not url.startswith(SPREADSHEETS_API_V4_BASE_URL + "/"):
+		return None
+
+	return url[len(SPREADSHEETS_API_V4_BASE_URL) + 1:].split("/", 1)[0].split(":", 1)[0]
+
+
+class CachingClient(ScheduledClient):
+	"""A gspread Client that answers reads of the Sheets API from a ResponseCache whenever the spreadsheet hasn't changed
+	   (according to its modifiedTime on Google Drive, checked once per spreadsheet), or always in offline mode
+	   (only the requests that aren't answered from the cache count towards the quota)"""
+
+	def __init__(self, auth: object, cache: ResponseCache, *, offline: bool = False, session: Optional[Session] = None) -> None:
+		if auth is None:
+			# Offline mode doesn't need to be able to log in
+			self.auth = None
+			self.session = session or Session()
+			self.scheduler = sheets_scheduler
+		else:
+			super().__init__(auth, session=session)
+
+		self.cache = cache
+		self.offline = offline
+		self.hits = 0
+		self.misses = 0
+
+		self._revisions: Dict[str, str] = {}
+		self._revisions_lock = Lock()
+
+	def revision(self, spreadsheet_key: str) -> str:
+		with self._revisions_lock:
+			if spreadsheet_key not in self._revisions:
+				response = super().request("get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet_key}", params={"fields": "modifiedTime", "supportsAllDrives": True})
+				self._revisions[spreadsheet_key] = cast(Dict[str, str], response.json())["modifiedTime"]
+
+			return self._revisions[spreadsheet_key]
+
+	def request(self, method: str, endpoint: str, params: Optional[Mapping[str, object]] = None, data: object = None, json: object = None,
+	            files: object = None, headers: Optional[Dict[str, str]] = None) -> SheetsResponse:
+		spreadsheet_key = spreadsheet_key_from_url(endpoint)
+
+		# Only reads from spreadsheets are cached
+		if method != "get" or spreadsheet_key is None:
+			if self.offline:
+				raise CacheMiss(f"can't {method} {endpoint} in offline mode")
+			return super().request(method, endpoint, params=params, data=data, json=json, files=files, headers=headers)
+
+		request = f"{endpoint} {dumps(params, sort_keys=True)}"
+		revision = None if self.offline else self.revision(spreadsheet_key)
+
+		body = self.cache.get(request, revision)
+		if body is not None:
+			self.hits += 1
+			metrics.current_run.count("sheets.cache_hits")
+			return CachedResponse(body)
+
+		if self.offline:
+			raise CacheMiss(f"{request} hasn't been cached, so it can't be read in offline mode")
+
+		self.misses += 1
+		response = super().request(method, endpoint, params=params, data=data, json=json, files=files, headers=headers)
+		self.cache.put(request, spreadsheet_key, revision or "", response.text)
+		return response
@@ -0,0 +1,237 @@
+#    genre.guide - From Google Sheets to Firestore: Reading from sheets
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, TypedDict, TypeVar, Union
+
+from gspread import Worksheet
+from gspread.utils import absolute_range_name, numericise_all, rightpad, rowcol_to_a1
+
+from . import metrics
+
+
+# What get_all_records gives back for a cell
+CellValue = Union[str, int, float]
+Record = Dict[str, CellValue]
+
+T = TypeVar("T")
+
+# Everything that's read about a cell in one request: its formatted value, text formatting, and note
+# (only the parts of the text format that get looked at are asked for, to keep the response small)
+GRID_FIELDS = "sheets.data.rowData.values(formattedValue,effectiveFormat.textFormat(bold,italic,strikethrough,foregroundColor),note)"
+
+
+# The parts of a grid read's response that get looked at (see GRID_FIELDS)
+class TextFormat(TypedDict, total=False):
+	bold: bool
+	italic: bool
+	strikethrough: bool
+	foregroundColor: Dict[str, float]
+
+
+class CellFormatProps(TypedDict, total=False):
+	textFormat: TextFormat
+
+
+class CellData(TypedDict, total=False):
+	formattedValue: str
+	effectiveFormat: CellFormatProps
+	note: str
+
+
+class RowData(TypedDict, total=False):
+	values: List[CellData]
+
+
+class GridData(TypedDict, total=False):
+	rowData: List[RowData]
+
+
+class SheetData(TypedDict):
+	data: List[GridData]
+
+
+class GridResponse(TypedDict):
+	sheets: List[SheetData]
+
+
+class LeanCellFormat:
+	"""The only parts of a cell's format that are ever looked at, as a few bit flags and an RGB int
+	   (instead of the tree of objects that gspread-formatting's CellFormat builds for every cell)"""
+
+	__slots__ = ("flags", "foreground")
+
+	BOLD = 1
+	ITALIC = 2
+	STRIKETHROUGH = 4
+
+	def __init__(self, flags: int, foreground: int) -> None:
+		self.flags = flags
+		self.foreground = foreground
+
+	@classmethod
+	def from_props(cls, props: CellFormatProps) -> "LeanCellFormat":
+		text_format: TextFormat = props.get("textFormat", {})
+
+		flags = (
+			(cls.BOLD if text_format.get("bold") else 0)
+			| (cls.ITALIC if text_format.get("italic") else 0)
+			| (cls.STRIKETHROUGH if text_format.get("strikethrough") else 0)
+		)
+
+		foreground_color: Dict[str, float] = text_format.get("foregroundColor", {})
+		red, green, blue = [round((foreground_color.get(color_component) or 0) * 255) for color_component in ["red", "green", "blue"]]
+
+		return cls(flags, (red << 16) | (green << 8) | blue)
+
+	@property
+	def bold(self) -> bool:
+		return bool(self.flags & self.BOLD)
+
+	@property
+	def italic(self) -> bool:
+		return bool(self.flags & self.ITALIC)
+
+	@property
+	def strikethrough(self) -> bool:
+		return bool(self.flags & self.STRIKETHROUGH)
+
+	@property
+	def foreground_hex(self) -> str:
+		return f"#{self.foreground:06x}"
+
+
+# What a cell without any formatting in the response is treated as: plain, black text
+NO_FORMAT = LeanCellFormat(0, 0)
+
+
+class GridCell(NamedTuple):
+	value: str
+	format: LeanCellFormat
+	note: Optional[str]
+
+
+def get_values(worksheet: Worksheet, range_name: str) -> List[List[str]]:
+	"""The values in range_name (in A1 notation) on worksheet, without any trailing empty rows or cells"""
+
+	response = worksheet.spreadsheet.values_get(absolute_range_name(worksheet.title, range_name))
+	metrics.current_run.count("sheets.value_reads")
+	values: List[List[str]] = response.get("values", [])
+	return values
+
+
+def get_grid(worksheet: Worksheet, row_start: int, col_start: int, row_end: int, col_end: int) -> List[List[GridCell]]:
+	"""The values, formats, and notes of a range of cells, all from one request (instead of one request for each)
+	   Rows at the end without any values are left out, just like get_all_values does"""
+
+	label = absolute_range_name(worksheet.title, f"{rowcol_to_a1(row_start, col_start)}:{rowcol_to_a1(row_end, col_end)}")
+
+	resp: GridResponse = worksheet.spreadsheet.fetch_sheet_metadata({
+		"includeGridData": True,
+		"ranges": [label],
+		"fields": GRID_FIELDS,
+	})
+	metrics.current_run.count("sheets.grid_reads")
+
+	this_sheets_data = resp["sheets"][0]["data"][0]
+
+	grid: List[List[GridCell]] = []
+	# Rows without values are held onto until it's clear that they aren't the ones at the end
+	empty_rows: List[List[GridCell]] = []
+	for row in this_sheets_data.get("rowData", []):
+		this_rows_cells: List[GridCell] = []
+
+		for cell_info in row.get("values", []):
+			props = cell_info.get("effectiveFormat")
+			cell_format = LeanCellFormat.from_props(props) if props is not None else NO_FORMAT
+			this_rows_cells.append(GridCell(cell_info.get("formattedValue", ""), cell_format, cell_info.get("note")))
+
+		if not any(cell.value for cell in this_rows_cells):
+			empty_rows.append(this_rows_cells)
+			continue
+
+		grid.extend(empty_rows)
+		empty_rows = []
+		grid.append(this_rows_cells)
+
+	return grid
+
+
+def get_header(worksheet: Worksheet) -> List[str]:
+	return get_values(worksheet, "1:1")[0]
+
+
+def iter_records(worksheet: Worksheet, *, header: List[str], row_start: int = 2, row_end: Optional[int] = None,
+                 chunk_size: int = 1000) -> Iterator[Tuple[int, Record]]:
+	"""Like get_all_records, but only fetches chunk_size rows at a time (when the previous ones are used up)
+	   and gives back (row number, record) pairs"""
+
+	if row_end is None:
+		row_end = worksheet.row_count
+
+	for chunk_start in range(row_start, row_end + 1, chunk_size):
+		chunk_end = min(chunk_start + chunk_size - 1, row_end)
+		rows = get_values(worksheet, f"{rowcol_to_a1(chunk_start, 1)}:{rowcol_to_a1(chunk_end, len(header))}")
+
+		for row_num, row in enumerate(rows, start=chunk_start):
+			yield row_num, dict(zip(header, numericise_all(rightpad(row, len(header)), default_blank="")))
+
+		# The API leaves out empty rows at the end, so this is the end of the data
+		if len(rows) < chunk_end - chunk_start + 1:
+			return
+
+
+def read_ahead(iterator: Iterator[T], buffer_size: int) -> Iterator[T]:
+	"""Runs iterator on its own thread, up to buffer_size items ahead of whoever is using them,
+	   so that several tabs can be downloading at the same time"""
+
+	# (is_done, item or exception)
+	buffer: "Queue[Tuple[bool, object]]" = Queue(maxsize=buffer_size)
+	stop = Event()
+
+	def put(message: Tuple[bool, object]) -> bool:
+		# Give up on putting if nobody is going to take it out anymore
+		while not stop.is_set():
+			try:
+				buffer.put(message, timeout=0.1)
+				return True
+			except Full:
+				continue
+		return False
+
+	def produce() -> None:
+		try:
+			for item in iterator:
+				if not put((False, item)):
+					return
+		except BaseException as exception:
+			put((True, exception))
+		else:
+			put((True, None))
+
+	Thread(target=produce, daemon=True).start()
+
+	try:
+		while True:
+			is_done, item = buffer.get()
+			if is_done:
+				if item is not None:
+					raise item  # type: ignore
+				return
+			yield item  # type: ignore
+	finally:
+		stop.set()
@@ -0,0 +1,349 @@
+#    genre.guide - From Google Sheets to Firestore: Where synced documents can go
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from itertools import groupby
+from json import dumps, loads
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+from typing import BinaryIO, cast, Dict, Iterator, List, Mapping, Optional, Protocol, Tuple, TypeVar
+
+
+# What's written as a document (a TypedDict like TrackDocumentData works too)
+DocumentData = Mapping[str, object]
+
+
+class SinkDocumentSnapshot(Protocol):
+	@property
+	def exists(self) -> bool:
+		...
+
+	def to_dict(self) -> Optional[Dict[str, object]]:
+		...
+
+
+class SinkDocumentReference(Protocol):
+	@property
+	def id(self) -> str:
+		...
+
+	@property
+	def path(self) -> str:
+		...
+
+	def get(self) -> SinkDocumentSnapshot:
+		...
+
+
+# The kind of document reference that a sink's collections give out, which is what its batches take back
+Ref = TypeVar("Ref", bound=SinkDocumentReference)
+Ref_co = TypeVar("Ref_co", bound=SinkDocumentReference, covariant=True)
+Ref_contra = TypeVar("Ref_contra", bound=SinkDocumentReference, contravariant=True)
+
+
+# The parameters are positional-only so that they don't have to be named the same as Firestore's
+class SinkCollection(Protocol[Ref_co]):
+	def document(self, __document_id: str) -> Ref_co:
+		...
+
+	def list_documents(self) -> Iterator[Ref_co]:
+		...
+
+
+class SinkBatch(Protocol[Ref_contra]):
+	def set(self, __reference: Ref_contra, __document_data: Dict[str, object]) -> object:
+		...
+
+	def delete(self, __reference: Ref_contra) -> object:
+		...
+
+	def commit(self) -> object:
+		...
+
+
+class Sink(Protocol[Ref]):
+	"""Everything that the syncs need from where they write documents to: collections of documents by ID (that can be read back), and batches of writes
+	   (which is a small part of Firestore's client, so a Firestore client is a sink already)"""
+
+	def collection(self, __name: str) -> SinkCollection[Ref]:
+		...
+
+	def batch(self) -> SinkBatch[Ref]:
+		...
+
+
+def any_sink(sink: Sink[Ref]) -> Sink[SinkDocumentReference]:
+	"""sink, for code that can be given any kind of sink
+	   (which is sound as long as every reference that goes into its batches came out of its own collections, like everywhere in the syncs)"""
+
+	return cast(Sink[SinkDocumentReference], sink)
+
+
+def encode_value(value: object) -> str:
+	"""What json can't write on its own (release dates) as strings"""
+
+	if isinstance(value, (date, datetime)):
+		return value.isoformat()
+	raise TypeError(f"{type(value).__name__} can't be written to a local sink")
+
+
+def encode_document(document: DocumentData) -> str:
+	return dumps(document, default=encode_value, ensure_ascii=False, separators=(",", ":"))
+
+
+class LocalDocumentSnapshot:
+	def __init__(self, reference: "LocalDocumentReference", data: Optional[Dict[str, object]]) -> None:
+		self.reference = reference
+		self.id = reference.id
+		self.exists = data is not None
+		self._data = data
+
+	def to_dict(self) -> Optional[Dict[str, object]]:
+		return self._data
+
+
+class LocalDocumentReference:
+	def __init__(self, sink: "LocalSink", collection: str, document_id: str) -> None:
+		self._sink = sink
+		self.collection = collection
+		self.id = document_id
+		self.path = f"{collection}/{document_id}"
+
+	def get(self) -> LocalDocumentSnapshot:
+		return LocalDocumentSnapshot(self, self._sink.get(self.collection, self.id))
+
+
+# ("set", reference, document) or ("delete", reference, None)
+LocalWrite = Tuple[str, LocalDocumentReference, Optional[DocumentData]]
+
+
+class LocalBatch:
+	"""Writes that are held until commit, which hands them all to the sink at once"""
+
+	def __init__(self, sink: "LocalSink") -> None:
+		self._sink = sink
+		self._writes: List[LocalWrite] = []
+
+	def set(self, reference: LocalDocumentReference, document: DocumentData) -> None:
+		self._writes.append(("set", reference, document))
+
+	def delete(self, reference: LocalDocumentReference) -> None:
+		self._writes.append(("delete", reference, None))
+
+	def commit(self) -> None:
+		self._sink.commit(self._writes)
+		self._writes = []
+
+
+class LocalCollection:
+	def __init__(self, sink: "LocalSink", name: str) -> None:
+		self._sink = sink
+		self.id = name
+
+	def document(self, document_id: str) -> LocalDocumentReference:
+		return LocalDocumentReference(self._sink, self.id, document_id)
+
+	def list_documents(self) -> Iterator[LocalDocumentReference]:
+		return iter([LocalDocumentReference(self._sink, self.id, document_id) for document_id in self._sink.document_ids(self.id)])
+
+
+class LocalSink(ABC):
+	"""What SQLiteSink and JSONLSink have in common: collections and batches that work like Firestore's"""
+
+	def collection(self, name: str) -> LocalCollection:
+		return LocalCollection(self, name)
+
+	def batch(self) -> LocalBatch:
+		return LocalBatch(self)
+
+	@abstractmethod
+	def commit(self, writes: List[LocalWrite]) -> None:
+		"""Makes every write (in order) at once"""
+
+	@abstractmethod
+	def document_ids(self, collection: str) -> List[str]:
+		"""The IDs of every document in collection"""
+
+	@abstractmethod
+	def get(self, collection: str, document_id: str) -> Optional[Dict[str, object]]:
+		"""The document (a copy that's the caller's to change), or None if there isn't one"""
+
+	def close(self) -> None:
+		pass
+
+	def __enter__(self) -> "LocalSink":
+		return self
+
+	def __exit__(self, *exc_info: object) -> None:
+		self.close()
+
+
+class SQLiteSink(LocalSink):
+	"""Every document in one SQLite table as JSON (which json_extract can query), with each batch committed in one transaction"""
+
+	def __init__(self, path: Path) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		self._lock = Lock()
+		# The timeout is for when other processes (like the workers of a backfill) are writing to the same database
+		self._connection = connect(str(path), timeout=60, check_same_thread=False)
+		# Bulk loading is the point, and the sheets are still the source of truth if a write gets lost
+		self._connection.execute("PRAGMA journal_mode = WAL")
+		self._connection.execute("PRAGMA synchronous = NORMAL")
+		with self._connection:
+			self._connection.execute("""
+				CREATE TABLE IF NOT EXISTS documents (
+					collection TEXT NOT NULL,
+					id TEXT NOT NULL,
+					data TEXT NOT NULL,
+					PRIMARY KEY (collection, id)
+				) WITHOUT ROWID
+			""")
+
+	def commit(self, writes: List[LocalWrite]) -> None:
+		with self._lock, self._connection:
+			# Runs of sets and deletes, in order, so that a set and then a delete of the same document (or the other way around) end up right
+			for kind, run in groupby(writes, key=lambda write: write[0]):
+				if kind == "set":
+					self._connection.executemany(
+						"INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+						[(reference.collection, reference.id, encode_document(document)) for _, reference, document in run],  # type: ignore
+					)
+				else:
+					self._connection.executemany(
+						"DELETE FROM documents WHERE collection = ? AND id = ?",
+						[(reference.collection, reference.id) for _, reference, _ in run],
+					)
+
+	def document_ids(self, collection: str) -> List[str]:
+		with self._lock:
+			return [document_id for document_id, in self._connection.execute("SELECT id FROM documents WHERE collection = ?", (collection,))]
+
+	def get(self, collection: str, document_id: str) -> Optional[Dict[str, object]]:
+		with self._lock:
+			row = self._connection.execute("SELECT data FROM documents WHERE collection = ? AND id = ?", (collection, document_id)).fetchone()
+		return None if row is None else loads(row[0])
+
+	def close(self) -> None:
+		self._connection.close()
+
+
+class JSONLSink(LocalSink):
+	"""A log of writes for each collection in directory (collection.jsonl), one JSON object a line:
+	   {"id": ..., "data": {...}} for a set, or {"id": ..., "deleted": true} for a delete
+	   Replaying a log from the top gives the documents that are in the collection"""
+
+	def __init__(self, directory: Path) -> None:
+		directory.mkdir(parents=True, exist_ok=True)
+		self.directory = directory
+
+		self._lock = Lock()
+		self._files: Dict[str, BinaryIO] = {}
+		# What's been replayed of each log so far: how far into it, and the line that last set each document that's left
+		# (kept as it was read, so that every get decodes a copy of its own)
+		self._replayed: Dict[str, Tuple[int, Dict[str, bytes]]] = {}
+
+	def _file(self, collection: str) -> BinaryIO:
+		if collection not in self._files:
+			self._files[collection] = (self.directory / f"{collection}.jsonl").open("ab", buffering=0)
+		return self._files[collection]
+
+	def commit(self, writes: List[LocalWrite]) -> None:
+		lines: Dict[str, List[str]] = {}
+		for kind, reference, document in writes:
+			record = {"id": reference.id, "data": document} if kind == "set" else {"id": reference.id, "deleted": True}
+			lines.setdefault(reference.collection, []).append(encode_document(record) + "\n")
+
+		with self._lock:
+			for collection, collection_lines in lines.items():
+				file = self._file(collection)
+				# One unbuffered append for the whole batch, so that batches from other processes writing to the same log don't get mixed into it
+				# (and if the write comes up short, more appends until the rest of it is in too)
+				remaining = memoryview("".join(collection_lines).encode("utf8"))
+				while remaining:
+					remaining = remaining[file.write(remaining):]
+
+	def _replay(self, collection: str) -> Dict[str, bytes]:
+		"""Picks up replaying collection's log where it was left off (it only ever grows, maybe from other processes too)"""
+
+		offset, lines = self._replayed.get(collection, (0, {}))
+		path = self.directory / f"{collection}.jsonl"
+		if not path.exists():
+			return lines
+
+		with path.open("rb") as file:
+			file.seek(offset)
+			for line in file:
+				# Another process could be in the middle of appending a batch
+				if not line.endswith(b"\n"):
+					break
+				offset += len(line)
+
+				record = loads(line)
+				if record.get("deleted"):
+					lines.pop(record["id"], None)
+				else:
+					lines[record["id"]] = line
+
+		self._replayed[collection] = (offset, lines)
+		return lines
+
+	def document_ids(self, collection: str) -> List[str]:
+		with self._lock:
+			return list(self._replay(collection))
+
+	def get(self, collection: str, document_id: str) -> Optional[Dict[str, object]]:
+		with self._lock:
+			line = self._replay(collection).get(document_id)
+		if line is None:
+			return None
+
+		document: Dict[str, object] = loads(line)["data"]
+		return document
+
+	def close(self) -> None:
+		with self._lock:
+			for file in self._files.values():
+				file.close()
+			self._files = {}
+
+
+SINK_KINDS = ("firestore", "sqlite:PATH", "jsonl:DIRECTORY")
+
+
+def open_sink(spec: str) -> Sink[SinkDocumentReference]:
+	"""firestore -> the Firestore client, sqlite:PATH -> a SQLiteSink, jsonl:DIRECTORY -> a JSONLSink"""
+
+	kind, _, location = spec.partition(":")
+	if kind == "firestore" and not location:
+		from . import get_firestore
+
+		return any_sink(get_firestore())
+	if kind == "sqlite" and location:
+		return any_sink(SQLiteSink(Path(location)))
+	if kind == "jsonl" and location:
+		return any_sink(JSONLSink(Path(location)))
+
+	raise ValueError(f"the sink needs to be one of {', '.join(SINK_KINDS)}, not {spec}")
+
+
+def close_sink(sink: Sink[Ref]) -> None:
+	"""Closes local sinks (Firestore's client is left alone)"""
+
+	if isinstance(sink, LocalSink):
+		sink.close()
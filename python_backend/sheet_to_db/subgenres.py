@@ -15,21 +15,36 @@
 #    along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 from collections import defaultdict
+from datetime import date, datetime
+from functools import lru_cache
 from itertools import count
-from json import dumps, loads
-from typing import Any, Awaitable, DefaultDict, Dict, Generator, Iterator, List, Set, Tuple, TypedDict
+from pathlib import Path
+from typing import Any, cast, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple, TypedDict
 
 from gspread import Spreadsheet, Worksheet
-from gspread.utils import rowcol_to_a1
-from gspread_formatting import CellFormat, CellFormatComponent
+from gspread.utils import rightpad
 
 from ..genre_utils import parse_alternative_names
-from . import FirestoreClient, GENRE_INFO_SHEET_NAME, GENRES_SHEET_NAME, get_firestore, get_genre_sheet
-from .gspread_notes import get_notes
+from ..subgenre_utils import AliasIndex, normalize_name, subgenre_closure, SubgenreTable, UNKNOWN_SUBGENRE_PATTERN
+from .batched_writes import BatchedWriter, INITIAL_WRITE_RATE, MAX_BATCH_SIZE
+from . import ALIAS_INDEX_PATH, GENRE_INFO_SHEET_NAME, GENRES_SHEET_NAME, get_genre_sheet, get_subgenre_sheet, metrics, SHEETS_CACHE_MODE, SUBGENRE_MANIFEST_PATH, SYNC_SINK, TRACK_MANIFEST_PATH
+from .manifest import manifest_path_for, SubgenreManifest, TrackManifest
+from .metrics import ProgressLine, start_run
+from .pipeline import run_concurrently, run_pipeline
+from .sheet_reads import get_grid, GridCell, LeanCellFormat
+from .sinks import close_sink, open_sink, Ref, Sink, SINK_KINDS
 
 
 Aliases = Dict[str, str]
 ReverseAliases = Dict[str, List[str]]
+# Everything build_up_subgenre_information finds out about a subgenre:
+# name, alternative_names, origins, subgenres, genre, is_genre, and color (background and text)
+SubgenreInformation = Dict[str, Any]
+
+# Where the alias index goes: an "index" document that says how many shards there are, and the shards themselves
+ALIAS_INDEX_COLLECTION = "subgenreNames"
+# Keeps each shard well under Firestore's 1 MiB document limit
+MAX_ALIAS_INDEX_SHARD_SIZE = 4000
 
 
 class SubgenreDocumentData(TypedDict):
@@ -37,47 +52,17 @@ class SubgenreDocumentData(TypedDict):
 	category: str
 	origins: List[str]
 	children: List[str]
+
+	# The whole family tree, so that a lineage is one read instead of one read per subgenre in it
+	ancestors: List[str]
+	descendants: List[str]
+	depth: int
+	rootGenres: List[str]
 	
 	backgroundColor: str
 	textColor: str
 
 
-def get_effective_formats(
-		worksheet: Worksheet, row_start: int, col_start: int, row_end: int,
-		col_end: int) -> Generator[List[CellFormat], None, None]:
-	"""Matrix equivalent of gspread-formatting's get_effective_format which only works on one cell
-	   Rationale: Quota limits for large sheets (AKA what we have)"""
-
-	label = f"{worksheet.title}!{rowcol_to_a1(row_start, col_start)}:{rowcol_to_a1(row_end, col_end)}"
-
-	resp = worksheet.spreadsheet.fetch_sheet_metadata({
-		"includeGridData": True,
-		"ranges": [label],
-		"fields":
-		"sheets.data.rowData.values.effectiveFormat"
-	})
-
-	this_sheets_data = resp["sheets"][0]["data"][0]
-
-	for row_num, row in enumerate(this_sheets_data["rowData"],
-								  start=row_start):
-		this_rows_formats: List[CellFormat] = []
-
-		for col_num, cell_info in enumerate(row["values"], start=col_start):
-			props = cell_info.get("effectiveFormat")
-
-			if props.pop("borders", None) is not None:
-				print(
-					"removed borders to prevent error creating CellFormat object"
-				)
-
-			cell_format = CellFormat.from_props(
-				props) if props is not None else None
-			this_rows_formats.append(cell_format)
-
-		yield this_rows_formats
-
-
 def get_genre_colors(genre_sheet: Spreadsheet) -> Dict[str, Tuple[str, str]]:
 	"""Maps the name of a genre to its hex color"""
 
@@ -85,13 +70,12 @@ def get_genre_colors(genre_sheet: Spreadsheet) -> Dict[str, Tuple[str, str]]:
 
 	genre_to_color: Dict[str, Tuple[str, str]] = {}
 
-	all_records: List[Dict] = genre_info_tab.get_all_records()
-	all_formats: List[List[CellFormat]] = list(
-		get_effective_formats(genre_info_tab,
-							  row_start=2,
-							  col_start=1,
-							  col_end=genre_info_tab.col_count,
-							  row_end=genre_info_tab.row_count))
+	# The records and their formats come from the same request
+	grid = get_grid(genre_info_tab, row_start=1, col_start=1, row_end=genre_info_tab.row_count, col_end=genre_info_tab.col_count)
+	header: List[str] = [cell.value for cell in grid[0]]
+
+	all_records: List[Dict[str, str]] = [dict(zip(header, rightpad([cell.value for cell in row], len(header)))) for row in grid[1:]]
+	all_formats: List[List[LeanCellFormat]] = [[cell.format for cell in row] for row in grid[1:]]
 
 	for (row_num, record) in enumerate(all_records):
 		name: str = record["Genre"]
@@ -108,14 +92,7 @@ def get_genre_colors(genre_sheet: Spreadsheet) -> Dict[str, Tuple[str, str]]:
 													i]["Color (#Hex)"].lower()
 
 			if background_hex_color:
-				foreground: CellFormatComponent = all_formats[
-					row_num - i][0].textFormat.foregroundColor
-
-				fr, fg, fb = [
-					round((getattr(foreground, color_component, 0) or 0) * 255)
-					for color_component in ["red", "green", "blue"]
-				]
-				foreground_hex_color: str = f"#{fr:02x}{fg:02x}{fb:02x}"
+				foreground_hex_color: str = all_formats[row_num - i][0].foreground_hex
 
 				break
 		else:
@@ -129,7 +106,7 @@ def get_genre_colors(genre_sheet: Spreadsheet) -> Dict[str, Tuple[str, str]]:
 
 def build_up_subgenre_information(
 		genre_sheet: Spreadsheet
-) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str]]:
+) -> Tuple[Dict[str, SubgenreInformation], Dict[str, str]]:
 	"This thing is frightening."
 
 	
@@ -138,27 +115,33 @@ def build_up_subgenre_information(
 			"the environment variable GENRES_SHEET_NAME is missing and needs to refer to the tab name where genre information is stored on the Google Sheet")
 	genres_tab: Worksheet = genre_sheet.worksheet(GENRES_SHEET_NAME)
 
-	entries: Iterator[List[str]] = iter(genres_tab.get_all_values())
-	# Not necessary for now, but it does advance the iterator which is important
-	header: List[str] = [label.lower() for label in next(entries)]
-
 	row_start: int = 2
 	col_start: int = 1
 	row_end: int = genres_tab.row_count
 	col_end: int = 8
 
-	all_formats = list(
-		get_effective_formats(genres_tab,
-							  row_start=row_start,
-							  col_start=col_start,
-							  row_end=row_end,
-							  col_end=col_end))
-	all_notes = list(
-		get_notes(genres_tab,
-				  row_start=row_start,
-				  col_start=col_start,
-				  row_end=row_end,
-				  col_end=col_end))
+	# The values, formats, and notes all come from the same request,
+	# which goes at the same time as the one for the genres' colors
+	with metrics.current_run.stage("fetch"):
+		grid, genre_to_color = run_concurrently(
+			lambda: get_grid(genres_tab, row_start=1, col_start=col_start, row_end=row_end, col_end=col_end),
+			lambda: get_genre_colors(genre_sheet),
+		)
+
+	with metrics.current_run.stage("transform"):
+		return subgenre_information_from_grid(grid, genre_to_color, row_start=row_start, col_start=col_start)
+
+
+def subgenre_information_from_grid(grid: List[List[GridCell]], genre_to_color: Dict[str, Tuple[str, str]], *,
+                                   row_start: int, col_start: int) -> Tuple[Dict[str, SubgenreInformation], Dict[str, str]]:
+	"""The frightening part of build_up_subgenre_information: everything that comes after reading the genres tab"""
+
+	entries: Iterator[List[str]] = iter([[cell.value for cell in row] for row in grid])
+	# Not necessary for now, but it does advance the iterator which is important
+	header: List[str] = [label.lower() for label in next(entries)]
+
+	all_formats = [[cell.format for cell in row] for row in grid[1:]]
+	all_notes = [[cell.note for cell in row] for row in grid[1:]]
 
 	# All genres (not subgenres)
 	genres: Set[str] = set()
@@ -198,7 +181,7 @@ def build_up_subgenre_information(
 			if col_num == col_start:
 				# Be confident that all genres are bold
 				if __debug__ and not any(
-						cell_format.textFormat.bold
+						cell_format.bold
 						for cell_format in all_formats[row_num - row_start]):
 					# Manually intervene to find the problem
 					breakpoint()
@@ -217,8 +200,8 @@ def build_up_subgenre_information(
 				parent_format = all_formats[parent_row - row_start][-1]
 
 				# Be confident that there are no subgenres of strikethroughed or italicized subgenres / genres
-				if __debug__ and (parent_format.textFormat.strikethrough
-								  or parent_format.textFormat.italic):
+				if __debug__ and (parent_format.strikethrough
+								  or parent_format.italic):
 					# Manually intervene to see the problem
 					breakpoint()
 
@@ -229,7 +212,7 @@ def build_up_subgenre_information(
 			# If this subgenre belongs to this genre without being italicized or strikethroughed,
 			# then it takes on its color
 			subgenre_format = all_formats[row_num - row_start][-1]
-			if not subgenre_format.textFormat.strikethrough and not subgenre_format.textFormat.italic:
+			if not subgenre_format.strikethrough and not subgenre_format.italic:
 				subgenre_to_genre[subgenre] = hierarchy[1][1]
 
 			try:
@@ -242,7 +225,7 @@ def build_up_subgenre_information(
 			else:
 				# Find the note in the row
 				try:
-					note: str = next(filter(bool, this_rows_notes))
+					note: str = next(filter(None, this_rows_notes))
 				except StopIteration:
 					# There are no notes
 					pass
@@ -270,9 +253,7 @@ def build_up_subgenre_information(
 				print(subgenre, "has no origin, if you were curious")
 
 	# Finally, create a composite piece of data (for loading into Redis)
-	full_data: DefaultDict[str, Dict[str, Any]] = defaultdict(dict)
-
-	genre_to_color = get_genre_colors(genre_sheet)
+	full_data: DefaultDict[str, SubgenreInformation] = defaultdict(dict)
 
 	# Make sure the genres found in the genres tab matches the list
 	# of genres from the genre stats tab
@@ -324,50 +305,293 @@ def children_from_origins(origins: Dict[str, List[str]]) -> Dict[str, List[str]]
 	return children
 
 
-def seed_firestore_with_subgenre_data(firestore: FirestoreClient, subgenre_data: Dict[str, Dict[str, Any]], aliases: Aliases) -> None:
+def seed_firestore_with_alias_index(firestore: Sink[Ref], alias_index: AliasIndex, *,
+                                    max_shard_size: int = MAX_ALIAS_INDEX_SHARD_SIZE) -> None:
+	"""Writes the alias index to Firestore (and a copy to ALIAS_INDEX_PATH), so that any name can be resolved from one cached read"""
+
+	alias_index.save(ALIAS_INDEX_PATH, max_shard_size=max_shard_size)
+
+	data = alias_index.to_data(max_shard_size=max_shard_size)
+	collection_ref = firestore.collection(ALIAS_INDEX_COLLECTION)
+
+	# In three steps so that readers (who read the index and then its shards) never find a shard missing:
+	# the new shards, then the index that points to them, then the shards that nothing points to anymore
+	with BatchedWriter(firestore) as writer:
+		for shard_num, shard in enumerate(data["shards"]):
+			writer.set(collection_ref.document(f"shard-{shard_num}"), shard)
+		writer.flush()
+
+		writer.set(collection_ref.document("index"), {"version": data["version"], "revision": data["revision"], "shards": len(data["shards"])})
+		writer.flush()
+
+		shard_ids = {f"shard-{shard_num}" for shard_num in range(len(data["shards"]))}
+		for document_ref in collection_ref.list_documents():
+			if document_ref.id != "index" and document_ref.id not in shard_ids:
+				writer.delete(document_ref)
+
+	print(f"📇 the alias index has {len(alias_index.keys)} names in {len(data['shards'])} shards (revision {data['revision']})")
+
+
+# What of a subgenre's document tracks carry with them (see SubgenreTable)
+EMBEDDED_FIELDS = frozenset({"names", "category", "backgroundColor", "textColor"})
+
+# What tracks whose subgenres aren't known yet point to
+UNKNOWN_SUBGENRE_DOCUMENT: SubgenreDocumentData = {
+	"names": ["?"],
+	"category": "?",
+	"origins": [],
+	"children": [],
+	"ancestors": [],
+	"descendants": [],
+	"depth": 0,
+	"rootGenres": [],
+	"backgroundColor": "#000000",
+	"textColor": "#ffffff",
+}
+
+
+def seed_firestore_with_subgenre_data(firestore: Sink[Ref], subgenre_data: Dict[str, SubgenreInformation], aliases: Aliases, *,
+                                      batch_size: int = MAX_BATCH_SIZE, max_in_flight: int = 4,
+                                      manifest: Optional[SubgenreManifest] = None, full: bool = False, verbose: bool = False) -> None:
+	"""Writes every subgenre (and ?) to Firestore, then the alias index
+	   With a manifest, only subgenres whose documents changed since the last run are written,
+	   subgenres that disappeared from the sheet are deleted, and the alias index is only rewritten if any name changed
+	   With full, everything is written anyway (but the manifest still finds what changed and what to delete)"""
+
+	run = metrics.current_run
+	progress = ProgressLine("subgenres")
+
 	reversed_aliases = reverse_aliases(aliases)
 	origins = {primary_name: data["origins"]
 			   for primary_name, data in subgenre_data.items()}
 	children = children_from_origins(origins)
+	# Raises SubgenreCycleError before anything is written if the family tree has a loop in it
+	with run.stage("transform"):
+		lineages = subgenre_closure(origins)
 
 	subgenres_collection_ref = firestore.collection("subgenres")
-	for primary_name, data in subgenre_data.items():
-		document: SubgenreDocumentData = {
-			"names": [primary_name, *reversed_aliases[primary_name]],
+	writer = BatchedWriter(firestore, batch_size=batch_size, max_in_flight=max_in_flight)
+	# ? goes last, over anything on the sheet that's called that
+	primary_names = [*(primary_name for primary_name in subgenre_data if primary_name != "?"), "?"]
+	processed = unchanged = deleted = 0
+
+	def transform(primary_names: List[str]) -> List[Tuple[str, SubgenreDocumentData]]:
+		documents: List[Tuple[str, SubgenreDocumentData]] = []
+
+		with run.stage("transform"):
+			for primary_name in primary_names:
+				if primary_name == "?":
+					documents.append((primary_name, UNKNOWN_SUBGENRE_DOCUMENT))
+					continue
+
+				data = subgenre_data[primary_name]
+				documents.append((primary_name, {
+					# Sorted so that the same names make the same document every run
+					"names": [primary_name, *sorted(reversed_aliases[primary_name])],
+					"category": data["genre"],
+					"origins": sorted(data["origins"]),
+					"children": sorted(children[primary_name]),
+					"ancestors": list(lineages[primary_name].ancestors),
+					"descendants": list(lineages[primary_name].descendants),
+					"depth": lineages[primary_name].depth,
+					"rootGenres": list(lineages[primary_name].root_genres),
+					"backgroundColor": data["color"][0],
+					"textColor": data["color"][1],
+				}))
+
+		return documents
+
+	def write(documents: List[Tuple[str, SubgenreDocumentData]]) -> None:
+		nonlocal processed, unchanged
+
+		for primary_name, document in documents:
+			if manifest is not None and not manifest.record(primary_name, document):
+				unchanged += 1
+				if not full:
+					continue
+
+			if verbose:
+				print(document)
+
+			with run.stage("write", items=1):
+				writer.set(subgenres_collection_ref.document(primary_name), document)
+
+		processed += len(documents)
+		progress.update(processed, fraction=processed / len(primary_names))
+
+	# Documents are made a batch at a time while the batch before is being written
+	batches_of_names = (primary_names[index:index + batch_size] for index in range(0, len(primary_names), batch_size))
+	run_pipeline(batches_of_names, [("transform", transform), ("write", write)])
+
+	progress.finish(processed)
+
+	if manifest is not None:
+		for primary_name in manifest.unseen():
+			if verbose:
+				print(f"deleting {primary_name} because it's no longer on the sheet")
+			with run.stage("write", items=1):
+				writer.delete(subgenres_collection_ref.document(primary_name))
+			manifest.forget(primary_name)
+			deleted += 1
+
+	with run.stage("write"):
+		writer.close()
+
+	alias_index = AliasIndex.build(primary_names, aliases)
+	if manifest is None or full or manifest.data["aliasIndexRevision"] != alias_index.revision:
+		with run.stage("write"):
+			seed_firestore_with_alias_index(firestore, alias_index)
+	else:
+		print(f"📇 the alias index is unchanged (revision {alias_index.revision})")
+
+	# Only remember what was written once it's definitely been written
+	if manifest is not None:
+		manifest.data["aliasIndexRevision"] = alias_index.revision
+		manifest.save()
+
+	print()
+	print()
+	print(f"🧬 the cloning process for subgenres is done! ({writer.committed_writes} documents in {writer.committed_batches} batches, {writer.retries} retries)")
+	if manifest is not None:
+		print(f"{unchanged} subgenres were unchanged{' (but written anyway)' if full else ' and skipped'}; {manifest.summary()}")
+	run.count("subgenres.processed", processed)
+	run.count("subgenres.unchanged", unchanged)
+	run.count("subgenres.deleted", deleted)
+
+
+def subgenre_table_from_sheet(genre_sheet: Spreadsheet) -> SubgenreTable:
+	"""The subgenre table straight from the Genre Sheet (for when the subgenre sync hasn't left one behind)"""
+
+	subgenre_data, aliases = build_up_subgenre_information(genre_sheet)
+	reversed_aliases = reverse_aliases(aliases)
+
+	documents: Dict[str, Dict[str, object]] = {
+		primary_name: {
+			"names": [primary_name, *sorted(reversed_aliases[primary_name])],
 			"category": data["genre"],
-			"origins": sorted(data["origins"]),
-			"children": sorted(children[primary_name]),
 			"backgroundColor": data["color"][0],
 			"textColor": data["color"][1],
 		}
+		for primary_name, data in subgenre_data.items()
+	}
+	documents["?"] = dict(UNKNOWN_SUBGENRE_DOCUMENT)
+	return SubgenreTable.from_documents(documents)
 
-		print(document)
 
-		document_ref = subgenres_collection_ref.document(primary_name)
-		document_ref.set(document)
-	
-	# Manually add information for ?
-	unknown: SubgenreDocumentData = {
-		"names": ["?"],
-		"category": "?",
-		"origins": [],
-		"children": [],
-		"backgroundColor": "#000000",
-		"textColor": "#ffffff",
+@lru_cache(maxsize=4)
+def subgenre_table_from_manifest(path: Path, modified: int) -> SubgenreTable:
+	# modified is only there so that a manifest that's been saved again since is loaded again
+	return SubgenreTable.from_documents(SubgenreManifest(path).documents)
+
+
+def get_subgenre_table(genre_sheet: Spreadsheet, sink: str) -> SubgenreTable:
+	"""The subgenre table as the subgenre sync last wrote it to sink, or from the Genre Sheet if it hasn't been run for sink here
+	   (loaded once for as long as the manifest doesn't change)"""
+
+	path = manifest_path_for(SUBGENRE_MANIFEST_PATH, sink)
+	try:
+		modified = path.stat().st_mtime_ns
+	except FileNotFoundError:
+		return subgenre_table_from_sheet(genre_sheet)
+	return subgenre_table_from_manifest(path, modified)
+
+
+def release_dates_to_reembed(manifest: SubgenreManifest, track_manifest_path: Path) -> List[str]:
+	"""The release dates (oldest first, one for each track) of the tracks that the track sync remembers writing
+	   which embed a subgenre whose name, category, or colors just changed"""
+
+	changed = set(manifest.added) | set(manifest.removed) | {
+		primary_name for primary_name, fields in manifest.modified.items() if EMBEDDED_FIELDS.intersection(fields)
 	}
+	if not changed or not track_manifest_path.exists():
+		return []
 
-	print(unknown)
+	# Tracks remember their subgenres as they're written on the sheets, which could be any of their names
+	names = {
+		normalize_name(name)
+		for primary_name in changed for name in cast(List[str], manifest.documents.get(primary_name, {}).get("names", [primary_name]))
+	}
+	names.update(normalize_name(primary_name) for primary_name in changed)
 
-	unknown_document_ref = subgenres_collection_ref.document("?")
-	unknown_document_ref.set(unknown)
+	return sorted(
+		entry["releaseDate"]
+		for entry in TrackManifest(track_manifest_path).entries.values()
+		if any(normalize_name(UNKNOWN_SUBGENRE_PATTERN.sub(r"\1", subgenre)) in names for subgenre in entry["subgenres"])
+	)
 
-	print()
-	print()
-	print("🧬 the cloning process for subgenres is done!")
+
+def report_tracks_to_reembed(manifest: SubgenreManifest, track_manifest_path: Path) -> Optional[Tuple[str, str]]:
+	"""Says which tracks still embed the old version of a subgenre that just changed (see release_dates_to_reembed),
+	   which they keep until the track sync is run over them again (like reembed_tracks does),
+	   and gives back the (newest, oldest) release dates that needs to cover, if there are any"""
+
+	release_dates = release_dates_to_reembed(manifest, track_manifest_path)
+	if not release_dates:
+		return None
+
+	print(f"⚠️ {len(release_dates)} tracks released from {release_dates[-1]} back to {release_dates[0]} still embed the old version "
+	      f"of subgenres that changed, and stay that way until they're synced again. Sync subgenres with --reembed next time, or run this to update them:")
+	print(f"    python -m python_backend.sheet_to_db.tracks {release_dates[-1]}:{release_dates[0]} --diff")
+	return release_dates[-1], release_dates[0]
+
+
+def reembed_tracks(firestore: Sink[Ref], genre_sheet: Spreadsheet, subgenre_sheet: Spreadsheet, manifest: SubgenreManifest,
+                   track_manifest_path: Path, *, write_rate: Optional[float] = None, transform_workers: int = 0,
+                   verbose: bool = False) -> Optional[Tuple[date, date]]:
+	"""Runs the track sync again over the tracks that embed a subgenre that just changed (see release_dates_to_reembed),
+	   with the subgenres as manifest has them now, and gives back the (newest, oldest) release dates it covered, if there were any
+	   Like a sync with --diff, only the tracks whose documents come out different are written again"""
+
+	# The track sync needs the subgenre table from here
+	from .tracks import build_up_track_information, seed_firestore_with_track_data
+
+	release_dates = release_dates_to_reembed(manifest, track_manifest_path)
+	if not release_dates:
+		return None
+
+	start, end = [datetime.strptime(release_date, "%Y-%m-%d").date() for release_date in (release_dates[-1], release_dates[0])]
+	print(f"🎨 re-embedding subgenres in {len(release_dates)} tracks released from {start} back to {end}")
+
+	tracks = build_up_track_information(genre_sheet, subgenre_sheet, start, end)
+	seed_firestore_with_track_data(firestore, tracks, manifest=TrackManifest(track_manifest_path), start=start, end=end, write_rate=write_rate,
+	                               transform_workers=transform_workers, subgenre_table=SubgenreTable.from_documents(manifest.documents),
+	                               verbose=verbose)
+	return start, end
 
 
 if __name__ == "__main__":
-	firestore = get_firestore()
-	google_sheet = get_genre_sheet()
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description="Clone subgenres from the Genre Sheet into Firestore")
+	parser.add_argument("--sheets-cache", choices=["off", "on", "offline"], default=SHEETS_CACHE_MODE, help="whether to reuse (or only use) Sheets responses saved on disk")
+	parser.add_argument("--sink", default=SYNC_SINK, metavar="|".join(SINK_KINDS), help="where to write the subgenres to (Firestore unless told otherwise)")
+	parser.add_argument("--full", action="store_true", help="rewrite every subgenre, not just the ones that changed since the last run")
+	parser.add_argument("--reembed", action="store_true", help="sync the tracks that embed a subgenre that changed again afterwards, so that they show it as it is now")
+	parser.add_argument("--transform-workers", type=int, default=0, help="how many processes turn tracks into documents when re-embedding (0 for doing it in this one)")
+	parser.add_argument("-v", "--verbose", action="store_true", help="print every document as it's written")
+	parser.add_argument("--report", type=Path, metavar="PATH", help="save timings and counters of the run as JSON")
+	arguments = parser.parse_args()
+
+	run = start_run("subgenres")
+
+	sink = open_sink(arguments.sink)
+	google_sheet = get_genre_sheet(arguments.sheets_cache)
 	subgenre_data, aliases = build_up_subgenre_information(google_sheet)
-	seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases)
+	try:
+		manifest = SubgenreManifest(manifest_path_for(SUBGENRE_MANIFEST_PATH, arguments.sink))
+		seed_firestore_with_subgenre_data(sink, subgenre_data, aliases, manifest=manifest, full=arguments.full, verbose=arguments.verbose)
+
+		track_manifest_path = manifest_path_for(TRACK_MANIFEST_PATH, arguments.sink)
+		if arguments.reembed:
+			# Only Firestore needs to be eased into (a local sink takes writes as fast as they come)
+			write_rate = INITIAL_WRITE_RATE if arguments.sink == "firestore" else None
+			reembed_tracks(sink, google_sheet, get_subgenre_sheet(arguments.sheets_cache), manifest, track_manifest_path,
+			               write_rate=write_rate, transform_workers=arguments.transform_workers, verbose=arguments.verbose)
+		else:
+			report_tracks_to_reembed(manifest, track_manifest_path)
+	finally:
+		close_sink(sink)
+
+	print(run.summary())
+	if arguments.report is not None:
+		run.save(arguments.report)
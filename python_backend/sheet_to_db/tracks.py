@@ -15,21 +15,35 @@
 #    along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 from bisect import bisect_left, bisect_right
-from collections import defaultdict
-from collections.abc import Sequence
-from datetime import date, datetime
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from heapq import merge
 from itertools import chain, groupby
 from json import dumps
 from operator import itemgetter
+from pathlib import Path
 from parse import parse
-from typing import Awaitable, DefaultDict, Dict, Generator, Iterable, Iterator, List, Optional, Set, Tuple, TypedDict, cast
+from typing import Awaitable, Callable, ContextManager, DefaultDict, Deque, Dict, FrozenSet, Generator, Generic, Iterable, Iterator, List, Optional, overload, Protocol, Sequence, Set, Tuple, TypedDict, TypeVar, Union, cast
 from warnings import warn
 
 from gspread import Spreadsheet, Worksheet
-
-from ..genre_utils import flatten_subgenres, parse_genre, unordered_subgenres_and_operators
-from ..track_utils import id_for_track
-from . import FirestoreClient, GENRE_SHEET_CATALOG_SHEET_NAME, GENRE_SHEET_KEY, get_firestore, get_genre_sheet, get_subgenre_sheet, SUBGENRE_SHEET_KEY
+from gspread.utils import rowcol_to_a1
+
+from ..catalog import CatalogTrack, write_catalog
+from ..genre_utils import parse_genre, parse_genres, ParsedGenres
+from ..subgenre_utils import SubgenreTable
+from ..track_utils import content_hash_for_track, id_for_track
+from .batched_writes import BatchedWriter, INITIAL_WRITE_RATE, MAX_BATCH_SIZE, RampUpLimiter
+from .manifest import manifest_path_for, PostingKey, TrackManifest
+from .metrics import ProgressLine, start_run
+from .pipeline import run_pipeline
+from .postings import merge_posting_lists, PostingChanges, POSTINGS_COLLECTION
+from .quota import sheets_scheduler
+from .sheet_reads import get_header, get_values, iter_records, read_ahead
+from .sinks import close_sink, open_sink, Ref, Sink, SINK_KINDS
+from .subgenres import get_subgenre_table
+from . import GENRE_SHEET_CATALOG_SHEET_NAME, GENRE_SHEET_KEY, get_genre_sheet, get_subgenre_sheet, metrics, SHEETS_CACHE_MODE, SHEETS_MAX_CONCURRENT_REQUESTS, SUBGENRE_SHEET_KEY, SYNC_SINK, TRACK_MANIFEST_PATH
 
 
 class Track(TypedDict):
@@ -63,6 +77,9 @@ class TrackDocumentData(TypedDict):
 
 	# Has to be represented as a string since Firebase doesn't support nested arrays :(
 	subgenresNested: str
+	# subgenresNested with every subgenre as its ResolvedSubgenre (primary name, category, and colors), so showing a track needs no other reads
+	# (None if there was no subgenre table to resolve them with)
+	subgenresResolved: Optional[str]
 
 	unorderedSubgenres: List[str]
 	unorderedOperators: List[str]
@@ -82,21 +99,113 @@ class TrackDocumentData(TypedDict):
 	sourceRow: int
 
 
+# A track, alongside its parsed subgenres: (track, subgenresNested, subgenresResolved, unorderedSubgenres, unorderedOperators)
+TrackRow = Tuple[Track, str, Optional[str], FrozenSet[str], FrozenSet[str]]
+
+
+by_release = itemgetter("release_date")
+by_label = itemgetter("record_label")
+
+T = TypeVar("T")
+K = TypeVar("K")
+
 
 # https://stackoverflow.com/a/35857036
-class LazyBisectable(Sequence):
-	def __init__(self, data, key, reversed: bool = False):
+class LazyBisectable(Sequence[K], Generic[T, K]):
+	def __init__(self, data: Sequence[T], key: Callable[[T], K], reversed: bool = False) -> None:
 		self.data = data
 		self.key = key
 		self.reversed = reversed
 	
-	def __len__(self):
+	def __len__(self) -> int:
 		return len(self.data)
 	
-	def __getitem__(self, i):
+	@overload
+	def __getitem__(self, i: int) -> K:
+		...
+
+	@overload
+	def __getitem__(self, i: "slice[Optional[int], Optional[int], Optional[int]]") -> List[K]:
+		...
+
+	def __getitem__(self, i: Union[int, "slice[Optional[int], Optional[int], Optional[int]]"]) -> Union[K, List[K]]:
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
 		return self.key(self.data[len(self.data) - i - 1 if self.reversed else i])
 
 
+class RemoteReleaseDates(Sequence[date]):
+	"""The release dates in one column of a tab, from row_start to row_end, that are only fetched when they're looked at
+	   (probe_size cells at a time, since neighboring cells are likely to be looked at next when bisecting)"""
+
+	def __init__(self, worksheet: Worksheet, column: int, row_start: int, row_end: int, probe_size: int = 32) -> None:
+		self.worksheet = worksheet
+		self.column = column
+		self.row_start = row_start
+		self.row_end = row_end
+		self.probe_size = probe_size
+		self.probes = 0
+		self.cells: Dict[int, str] = {}
+
+	def __len__(self) -> int:
+		return self.row_end - self.row_start + 1
+
+	def cell(self, row: int) -> str:
+		if row not in self.cells:
+			# Line the probes up so that walking up or down a few rows stays inside the same probe
+			probe_start = row - (row - self.row_start) % self.probe_size
+			probe_end = min(probe_start + self.probe_size - 1, self.row_end)
+			values = get_values(self.worksheet, f"{rowcol_to_a1(probe_start, self.column)}:{rowcol_to_a1(probe_end, self.column)}")
+			self.probes += 1
+
+			for probe_row in range(probe_start, probe_end + 1):
+				values_row = values[probe_row - probe_start] if probe_row - probe_start < len(values) else []
+				self.cells[probe_row] = str(values_row[0]) if values_row else ""
+
+		return self.cells[row]
+
+	@overload
+	def __getitem__(self, i: int) -> date:
+		...
+
+	@overload
+	def __getitem__(self, i: "slice[Optional[int], Optional[int], Optional[int]]") -> List[date]:
+		...
+
+	def __getitem__(self, i: Union[int, "slice[Optional[int], Optional[int], Optional[int]]"]) -> Union[date, List[date]]:
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+
+		# Empty rows are (almost always) the ones at the bottom of the tab, which are older than anything
+		if not self.cell(self.row_start + i):
+			return date.min
+
+		# Rows without a valid date go by the closest row above them that has one,
+		# which keeps them in the same place reading the tab from the top would
+		for row in range(self.row_start + i, self.row_start - 1, -1):
+			try:
+				return datetime.strptime(self.cell(row), "%Y-%m-%d").date()
+			except ValueError:
+				continue
+		return date.max
+
+
+def find_release_window(worksheet: Worksheet, column: int, start: date, end: date) -> Tuple[int, int]:
+	"""Bisects a tab that lists the newest releases first without downloading it,
+	   to find the rows [newest, oldest) with tracks released from start back to end"""
+
+	row_start = 2
+	release_dates = RemoteReleaseDates(worksheet, column, row_start=row_start, row_end=worksheet.row_count)
+	searchable_release_dates = LazyBisectable(release_dates, reversed=True, key=lambda release_date: release_date)
+
+	# Double reverse
+	newest_index_inclusive = len(release_dates) - bisect_right(searchable_release_dates, start)
+	oldest_index_exclusive = len(release_dates) - bisect_left(searchable_release_dates, end)
+
+	print(f"found {worksheet.title}'s rows for {start} to {end} in {release_dates.probes} small reads")
+	return row_start + newest_index_inclusive, row_start + oldest_index_exclusive
+
+
 def genre_sheet_record_to_track(*, record: Dict[str, str], row: int, source_tab: str, source_tab_id: int) -> Track:
 	return {
 		"genre": record["Genre"],
@@ -163,7 +272,68 @@ def clean_up_track(track: Track) -> None:
 			track["subgenre"] = track["subgenre"].replace("Trap", "Trap (EDM)", 1)
 
 
-def build_up_track_information(genre_sheet: Spreadsheet, subgenre_sheet: Spreadsheet, start: date, end: date) -> List[Track]:
+class RecordToTrack(Protocol):
+	def __call__(self, *, record: Dict[str, str], row: int, source_tab: str, source_tab_id: int) -> Track:
+		...
+
+# The columns that the release dates are in on each sheet
+GENRE_SHEET_RELEASE_COLUMN = "Release"
+SUBGENRE_SHEET_RELEASE_COLUMN = "Date"
+
+
+def iter_tab_tracks(worksheet: Worksheet, record_to_track: RecordToTrack, release_column: str, start: date, end: date, *,
+                    chunk_size: int = 1000, bisect: bool = False) -> Iterator[Track]:
+	"""Yields the tracks on a tab (which lists the newest releases first) released from start back to end,
+	   reading it from the top a chunk at a time and stopping as soon as the releases get older than end
+	   (or, with bisect, only reading the rows that find_release_window says are in the date range)"""
+
+	source_tab = worksheet.title
+	header = get_header(worksheet)
+
+	row_start, row_end = 2, worksheet.row_count
+	if bisect:
+		newest_row, oldest_row_exclusive = find_release_window(worksheet, header.index(release_column) + 1, start, end)
+		if newest_row == oldest_row_exclusive:
+			return
+		row_start, row_end = newest_row, oldest_row_exclusive - 1
+
+	first: Optional[Track] = None
+	last: Optional[Track] = None
+	for row, record in iter_records(worksheet, header=header, row_start=row_start, row_end=row_end, chunk_size=chunk_size):
+		# Cells that look like numbers come back as numbers (like get_all_records), which the tracks have always kept as they are
+		track = record_to_track(record=cast(Dict[str, str], record), row=row, source_tab=source_tab, source_tab_id=worksheet.id)
+
+		try:
+			release_date = datetime.strptime(str(track["release_date"]), "%Y-%m-%d").date()
+		except ValueError:
+			# It can't tell where the window is, and it can't be yielded either, since every tab has to come out newest first to be merged
+			if first is not None:
+				warn(f"{track['source_name']}'s row {row} on {source_tab} ({track['artist']} - {track['title']}) is being skipped "
+				     f"because {track['release_date']!r} isn't a valid release date")
+			continue
+
+		if release_date > start:
+			continue
+		if release_date < end:
+			break
+
+		if first is None:
+			first = track
+			print(f"--- {track['source_name']}: {source_tab} ---")
+		last = track
+
+		yield track
+
+	if first is not None and last is not None:
+		print(f"{first['title']} ({first['release_date']}) — {last['title']} ({last['release_date']})")
+		print()
+
+
+def build_up_track_information(genre_sheet: Spreadsheet, subgenre_sheet: Spreadsheet, start: date, end: date, *,
+                               chunk_size: int = 1000, bisect: bool = False) -> Iterator[Track]:
+	"""Lazily yields every track released from start back to end across the Genre Sheet and Subgenre Sheet, newest first
+	   (only about chunk_size rows per tab are held onto at any point)"""
+
 	if GENRE_SHEET_CATALOG_SHEET_NAME is None:
 		raise ValueError("the GENRE_SHEET_CATALOG_SHEET_NAME environment variable needs a value, like Main")
 	genre_sheet_catalog = genre_sheet.worksheet(GENRE_SHEET_CATALOG_SHEET_NAME)
@@ -189,63 +359,77 @@ def build_up_track_information(genre_sheet: Spreadsheet, subgenre_sheet: Spreads
 			relevant_tabs.append(tab)
 
 	print(f"about to start hunting tracks from {start} to {end} down (this could take a while)")
-	# 1 for skipping the header row, + 1 for arrays starting at 0 = 2
-	genre_sheet_tracks = [genre_sheet_record_to_track(record=record, row=row + 2, source_tab=GENRE_SHEET_CATALOG_SHEET_NAME,
-	                                                  source_tab_id=genre_sheet_catalog.id) for row, record in enumerate(genre_sheet_catalog.get_all_records())]
-	subgenre_sheet_tracks = [[subgenre_sheet_record_to_track(record=record, row=row + 2, source_tab=subgenre_sheet_tab.title, source_tab_id=subgenre_sheet_tab.id) for row, record in enumerate(subgenre_sheet_tab.get_all_records())] for subgenre_sheet_tab in relevant_tabs]
-	
-	chunks_of_rows = []
-	for track_catalog in [genre_sheet_tracks, *subgenre_sheet_tracks]:
-		track_list = list(track_catalog)
-		searchable_track_list = LazyBisectable(track_list, reversed=True, key=lambda track: datetime.strptime(track["release_date"], "%Y-%m-%d").date())
-		# Double reverse
-		newest_index_inclusive = len(track_list) - bisect_right(searchable_track_list, start)
-		oldest_index_exclusive = len(track_list) - bisect_left(searchable_track_list, end)
-		oldest_index_inclusive = oldest_index_exclusive - 1
-
-		print(f"--- {track_list[newest_index_inclusive]['source_name']}: {track_list[newest_index_inclusive]['source_tab']} ---")
-		print(f"{track_list[newest_index_inclusive]['title']} ({track_list[newest_index_inclusive]['release_date']}) — {track_list[oldest_index_inclusive]['title']} ({track_list[oldest_index_inclusive]['release_date']})")
-		print()
+	tabs_of_tracks = [
+		iter_tab_tracks(genre_sheet_catalog, genre_sheet_record_to_track, GENRE_SHEET_RELEASE_COLUMN, start, end, chunk_size=chunk_size, bisect=bisect),
+		*(iter_tab_tracks(subgenre_sheet_tab, subgenre_sheet_record_to_track, SUBGENRE_SHEET_RELEASE_COLUMN, start, end, chunk_size=chunk_size, bisect=bisect)
+		  for subgenre_sheet_tab in relevant_tabs),
+	]
 
-		chunks_of_rows.append(track_list[newest_index_inclusive:oldest_index_exclusive])
+	# Every tab downloads on its own thread (with SHEETS_MAX_CONCURRENT_REQUESTS requests going at once, at most),
+	# and since every tab is already newest first, they only need to be interleaved
+	return merge(*(read_ahead(tab_of_tracks, buffer_size=2 * chunk_size) for tab_of_tracks in tabs_of_tracks), key=by_release, reverse=True)
 
-	return list(chain(*chunks_of_rows))
 
+def chunks_of_release_dates(tracks: Iterable[Track], chunk_size: int) -> Iterator[List[Track]]:
+	"""Sorts tracks (that are already newest first) by record label within each release date,
+	   and hands them out in chunks of around chunk_size tracks without splitting up a release date"""
 
-def seed_firestore_with_track_data(firestore: FirestoreClient, tracks: List[Track]) -> None:
-	tracks_collection_ref = firestore.collection("tracks")
-	warnings: List[str] = []
+	chunk: List[Track] = []
+	for _, tracks_released_on_this_date in groupby(tracks, key=by_release):
+		# sorted is stable, so tracks on the same label stay in the order they're in on the sheets
+		chunk.extend(sorted(tracks_released_on_this_date, key=by_label))
+
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+
+	if chunk:
+		yield chunk
+
+
+def resolved_json(parsed: ParsedGenres, subgenre_table: Optional[SubgenreTable], unresolved: Set[str]) -> List[Optional[str]]:
+	"""subgenresResolved for every position of parsed (each distinct subgenre text is only resolved once)"""
+
+	if subgenre_table is None:
+		return [None] * len(parsed.nested_json)
+
+	resolved: Dict[str, str] = {}
+	for nested_json, nested in zip(parsed.nested_json, parsed.nested):
+		if nested_json not in resolved:
+			resolved[nested_json] = dumps(subgenre_table.resolve(nested, unresolved), ensure_ascii=False, separators=(",", ":"))
+	return [resolved[nested_json] for nested_json in parsed.nested_json]
+
+
+def track_documents(tracks: List[Track], warnings: List[str], *, subgenre_table: Optional[SubgenreTable] = None,
+                    unresolved: Optional[Set[str]] = None) -> Iterator[Tuple[str, Track, TrackDocumentData]]:
+	"""Turns tracks (sorted by release date, then record label) into (track ID, track, document) triples
+	   With a subgenre_table, every document carries its subgenres resolved (and names it doesn't know are added to unresolved)"""
+
+	# Parse every distinct subgenre text once, up front, instead of once per track
+	parsed = parse_genres(track["subgenre"] for track in tracks)
+	resolved = resolved_json(parsed, subgenre_table, unresolved if unresolved is not None else set())
+
+	rows: Iterator[TrackRow] = zip(tracks, parsed.nested_json, resolved, parsed.subgenres, parsed.operators)
+	row_release: Callable[[TrackRow], str] = lambda row: row[0]["release_date"]
+	row_label: Callable[[TrackRow], str] = lambda row: row[0]["record_label"]
 
-	list_tracks = list(tracks)
-	# Sort and group by release date
-	by_release = itemgetter("release_date")
-	list_tracks.sort(key=by_release, reverse=True)
-	for release_date_string, tracks_released_on_this_date in groupby(tracks, key=by_release):
+	for release_date_string, rows_released_on_this_date in groupby(rows, key=row_release):
 		try:
 			release_date = datetime.strptime(release_date_string, "%Y-%m-%d")
 		except ValueError:
-			warning_message = f"{release_date_string} is being skipped because it doesn't have a valid release date, but it has these tracks: {list(tracks_released_on_this_date)}"
+			warning_message = f"{release_date_string} is being skipped because it doesn't have a valid release date, but it has these tracks: {[row[0] for row in rows_released_on_this_date]}"
 			warn(warning_message)
 			warnings.append(warning_message)
+			continue
 
-		by_label = itemgetter("record_label")
-		
-		tracks_released_on_this_date_sorted_by_label = list(
-			tracks_released_on_this_date)
-		tracks_released_on_this_date_sorted_by_label.sort(key=by_label)
-		for record_label, row_tracks in groupby(tracks_released_on_this_date_sorted_by_label, key=by_label):
+		for record_label, label_rows in groupby(rows_released_on_this_date, key=row_label):
 			track: Track
-			for i, track in enumerate(row_tracks):
+			for i, (track, subgenres_nested_json, subgenres_resolved_json, subgenres, operators) in enumerate(label_rows):
 				artist = str(track["artist"])
 				title = str(track["title"])
 
 				track_id = id_for_track(artist=artist, title=title, release_date=release_date_string)
 
-				subgenres_nested = parse_genre(track["subgenre"])
-				subgenres_flat = flatten_subgenres(subgenres_nested)
-
-				subgenres, operators = unordered_subgenres_and_operators(subgenres_flat)
-
 				document: TrackDocumentData = {
 					"artist": artist,
 					"title": title,
@@ -254,7 +438,8 @@ def seed_firestore_with_track_data(firestore: FirestoreClient, tracks: List[Trac
 					"recordLabel": record_label,
 					"indexOnLabelOnRelease": i,
 
-					"subgenresNested": dumps(subgenres_nested),
+					"subgenresNested": subgenres_nested_json,
+					"subgenresResolved": subgenres_resolved_json,
 
 					"unorderedSubgenres": sorted(subgenres),
 					"unorderedOperators": sorted(operators),
@@ -272,17 +457,270 @@ def seed_firestore_with_track_data(firestore: FirestoreClient, tracks: List[Trac
 					"sourceRow": track["source_row"],
 				}
 
+				yield track_id, track, document
+
+
+TrackDocuments = List[Tuple[str, Track, TrackDocumentData]]
+
+
+# Set up once in every worker process by start_transform_worker
+worker_subgenre_table: Optional[SubgenreTable] = None
+
+
+def start_transform_worker(subgenre_table: Optional[SubgenreTable]) -> None:
+	global worker_subgenre_table
+	worker_subgenre_table = subgenre_table
+
+
+def transform_chunk(chunk: List[Track]) -> Tuple[TrackDocuments, List[str], Set[str]]:
+	"""Every (track ID, track, document) of a chunk at once, the warnings that came up, and the subgenres that couldn't be resolved
+	   (for running in another process)"""
+
+	warnings: List[str] = []
+	unresolved: Set[str] = set()
+	return list(track_documents(chunk, warnings, subgenre_table=worker_subgenre_table, unresolved=unresolved)), warnings, unresolved
+
+
+def chunk_documents(chunks: Iterable[List[Track]], warnings: List[str], *, workers: int = 0, subgenre_table: Optional[SubgenreTable] = None,
+                    unresolved: Optional[Set[str]] = None) -> Iterator[Tuple[List[Track], Iterable[Tuple[str, Track, TrackDocumentData]]]]:
+	"""(chunk, its track documents) for every chunk, in order
+	   With more than one worker, chunks are turned into documents by that many processes, a few chunks ahead of whoever's using them
+	   (chunks never split up a release date, so indexOnLabelOnRelease comes out the same as it would in one process)
+	   With a subgenre_table, subgenres are resolved with it (see track_documents)"""
+
+	if unresolved is None:
+		unresolved = set()
+
+	if workers <= 1:
+		for chunk in chunks:
+			yield chunk, track_documents(chunk, warnings, subgenre_table=subgenre_table, unresolved=unresolved)
+		return
+
+	from concurrent.futures import Future, ProcessPoolExecutor
+	from multiprocessing import get_context
+
+	# Spawned, since forking with the tabs' reader threads going isn't safe
+	# The subgenre table goes to every worker once, instead of with every chunk
+	with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), initializer=start_transform_worker, initargs=(subgenre_table,)) as executor:
+		ahead: "Deque[Tuple[List[Track], Future[Tuple[TrackDocuments, List[str], Set[str]]]]]" = deque()
+
+		def take_oldest() -> Tuple[List[Track], TrackDocuments]:
+			chunk, future = ahead.popleft()
+			with metrics.current_run.stage("transform"):
+				documents, chunk_warnings, chunk_unresolved = future.result()
+			# (They were already shown as warnings by the worker)
+			warnings.extend(chunk_warnings)
+			unresolved.update(chunk_unresolved)
+			return chunk, documents
+
+		for chunk in chunks:
+			ahead.append((chunk, executor.submit(transform_chunk, chunk)))
+			# Enough to keep every worker busy, without reading the whole range into memory
+			if len(ahead) > 2 * workers:
+				yield take_oldest()
+
+		while ahead:
+			yield take_oldest()
+
+
+# How many writes are held back at a time to interleave by release week
+INTERLEAVE_WINDOW = 10 * MAX_BATCH_SIZE
+
+
+def release_week(release_date: datetime) -> int:
+	"""Which week (counting from the start of the calendar) a release is in, to spread writes out across the releaseDate index"""
+
+	return release_date.toordinal() // 7
+
+
+def seed_firestore_with_track_data(firestore: Sink[Ref], tracks: Iterable[Track], *, batch_size: int = MAX_BATCH_SIZE, max_in_flight: int = 4,
+                                   manifest: Optional[TrackManifest] = None, start: Optional[date] = None, end: Optional[date] = None,
+                                   write_rate: Optional[float] = None, checkpoint: Optional[Callable[[date, int], None]] = None,
+                                   checkpoint_every: int = INTERLEAVE_WINDOW, transform_workers: int = 0,
+                                   subgenre_table: Optional[SubgenreTable] = None, postings_lock: ContextManager[object] = nullcontext(),
+                                   verbose: bool = False) -> None:
+	"""Writes tracks, which need to come newest first (like build_up_track_information gives them), to Firestore as they come in.
+	   With a manifest, only tracks whose content changed since the last run are written,
+	   and (given the start and end of the date range that tracks came from) tracks that disappeared from it are deleted
+	   With a write_rate, writes start out at that many a second and ramp up from there (see RampUpLimiter)
+	   With a checkpoint, every checkpoint_every tracks or so (and once more at the end), it waits for everything so far to be committed
+	   and calls checkpoint with the oldest release date that's completely written and how many tracks were released after it
+	   With more than one transform_workers, tracks are turned into documents in that many processes (see chunk_documents)
+	   With a subgenre_table, every track carries its subgenres resolved (and since that's part of the content hash,
+	   tracks whose subgenres changed since the last run are written again even with a manifest)
+	   Either way, the subgenre -> tracks posting lists that tracks are in (and with a manifest, the ones they or deleted tracks left) are merged
+	   with what's stored (see merge_posting_lists) at every checkpoint and at the end, while holding postings_lock
+	   With verbose, every document is printed as it's written"""
+
+	run = metrics.current_run
+	progress = ProgressLine("tracks")
+
+	tracks_collection_ref = firestore.collection("tracks")
+	limiter = RampUpLimiter(write_rate) if write_rate else None
+	writer = BatchedWriter(firestore, batch_size=batch_size, max_in_flight=max_in_flight, limiter=limiter, interleave_window=INTERLEAVE_WINDOW)
+	warnings: List[str] = []
+	unresolved: Set[str] = set()
+	processed = unchanged = 0
+	processed_at_checkpoint = 0
+	# The oldest release date gone through so far (the tracks from it that haven't come yet may be in the next chunk),
+	# and how many tracks came before it
+	oldest_release: Optional[date] = None
+	processed_before_oldest = 0
+
+	postings_collection_ref = firestore.collection(POSTINGS_COLLECTION)
+	posting_changes = PostingChanges(start.isoformat() if start is not None else None)
+	shards_written = shards_deleted = 0
+
+	# Tracks come newest first, so how far back the current one is gives an idea of how much is left
+	days_in_range = (start - end).days + 1 if start is not None and end is not None else None
+
+	def transform(item: Tuple[List[Track], Iterable[Tuple[str, Track, TrackDocumentData]]]) -> Tuple[TrackDocuments, int, Optional[date], int]:
+		"""The documents of a chunk that need to be written, how many tracks have been processed after it,
+		   and the oldest release date so far along with how many tracks came before it"""
+
+		nonlocal processed, unchanged, oldest_release, processed_before_oldest
+		_, documents = item
+		to_write: TrackDocuments = []
+
+		for track_id, track, document in run.timed("transform", documents):
+			# Documents only come out of tracks with a valid release date
+			release_date = document["releaseDate"].date()
+			if oldest_release is None or release_date < oldest_release:
+				oldest_release = release_date
+				processed_before_oldest = processed
+
+			processed += 1
+			posting_changes.add(track_id, track["release_date"], document["unorderedSubgenres"])
+
+			if manifest is not None:
+				with run.stage("transform"):
+					content_hash = content_hash_for_track(document)
+					is_unchanged = manifest.is_unchanged(track_id, content_hash)
+					manifest.record(track_id, content_hash, track["release_date"], document["unorderedSubgenres"])
+
+				if is_unchanged:
+					unchanged += 1
+					continue
+
+			to_write.append((track_id, track, document))
+
+		return to_write, processed, oldest_release, processed_before_oldest
+
+	def merge_postings(through: Optional[str], also: Iterable[PostingKey] = ()) -> None:
+		nonlocal shards_written, shards_deleted
+
+		# Reading a posting list and writing it back can't have anyone else (like another worker of a backfill) doing the same in between
+		with postings_lock, run.stage("write"):
+			written, deleted = merge_posting_lists(writer, postings_collection_ref, posting_changes, through=through, also=set(also))
+			writer.flush()
+		shards_written += written
+		shards_deleted += deleted
+
+	def write(item: Tuple[TrackDocuments, int, Optional[date], int]) -> None:
+		nonlocal processed_at_checkpoint
+		to_write, processed_so_far, oldest_so_far, processed_before_oldest_so_far = item
+
+		for track_id, track, document in to_write:
+			if verbose:
 				print(f"{track['source_name']}'s row {track['source_row']} ({track_id}):")
 				print(document)
-				# breakpoint()
-
-				document_ref = tracks_collection_ref.document(track_id)
-				document_ref.set(document)
 				print()
 
+			with run.stage("write", items=1):
+				writer.set(tracks_collection_ref.document(track_id), document, partition=release_week(document["releaseDate"]))
+
+		if to_write and start is not None and days_in_range is not None:
+			progress.update(processed_so_far, fraction=((start - to_write[-1][2]["releaseDate"].date()).days + 1) / days_in_range)
+		else:
+			progress.update(processed_so_far)
+
+		if checkpoint is None or oldest_so_far is None or processed_so_far - processed_at_checkpoint < checkpoint_every:
+			return
+
+		# After a flush, every release date newer than the oldest one so far is completely written
+		committed_through = oldest_so_far + timedelta(days=1)
+		if start is not None and committed_through > start:
+			return
+
+		with run.stage("write"):
+			writer.flush()
+		merge_postings(committed_through.isoformat())
+		checkpoint(committed_through, processed_before_oldest_so_far)
+		processed_at_checkpoint = processed_so_far
+
+	# Reading, transforming, and writing all happen at the same time, a couple of chunks apart at most
+	chunks = chunks_of_release_dates(run.timed("fetch", tracks), chunk_size=batch_size)
+	documents = chunk_documents(chunks, warnings, workers=transform_workers, subgenre_table=subgenre_table, unresolved=unresolved)
+	run_pipeline(documents, [("transform", transform), ("write", write)])
+
+	progress.finish(processed)
+
+	deleted = 0
+	if manifest is not None and start is not None and end is not None:
+		for track_id in sorted(manifest.unseen_between(start, end)):
+			if verbose:
+				print(f"deleting {track_id} because it's no longer on the sheets")
+			with run.stage("write", items=1):
+				writer.delete(tracks_collection_ref.document(track_id))
+			manifest.forget(track_id)
+			posting_changes.remove(track_id)
+			deleted += 1
+
+	merge_postings(end.isoformat() if end is not None else None, manifest.touched if manifest is not None else ())
+
+	with run.stage("write"):
+		writer.close()
+
+	# Only remember what was written once it's definitely been written
+	if manifest is not None:
+		manifest.save()
+	# Now nothing is left to come, so the oldest release date is completely written too
+	if checkpoint is not None and oldest_release is not None:
+		checkpoint(oldest_release, processed)
+
 	print()
 	print()
-	print("🧬 the cloning process for tracks is done!")
+	print(f"🧬 the cloning process for tracks is done! ({writer.committed_writes} documents in {writer.committed_batches} batches, {writer.retries} retries)")
+	if limiter is not None:
+		print(f"writes went out at {limiter.achieved_rate():,.0f}/s (allowed up to {limiter.rate():,.0f}/s by the end, slowed down {limiter.contentions} times)")
+	if manifest is not None:
+		print(f"{unchanged} tracks were unchanged and skipped, {deleted} were deleted")
+	print(f"posting lists: {shards_written} shards written, {shards_deleted} deleted")
+	print(f"parse_genre cache: {parse_genre.cache_info()}")
+	if unresolved:
+		print(f"⚠️ {len(unresolved)} subgenres on the sheets aren't in the subgenre table, so they're shown like ?: {', '.join(sorted(unresolved))}")
+	run.count("tracks.processed", processed)
+	run.count("tracks.unchanged", unchanged)
+	run.count("tracks.deleted", deleted)
+	if warnings:
+		print("⚠️ it finished with these warnings: ")
+		for warning in warnings:
+			print(warning)
+
+
+def export_catalog(path: Path, tracks: Iterable[Track], *, transform_workers: int = 0) -> None:
+	"""Writes tracks to a local catalog file (see catalog.py) instead of to Firestore"""
+
+	warnings: List[str] = []
+
+	catalog_tracks = (
+		CatalogTrack(
+			track_id=track_id,
+			artist=document["artist"],
+			title=document["title"],
+			release_date=document["releaseDate"].date(),
+			record_label=document["recordLabel"],
+			index_on_label_on_release=document["indexOnLabelOnRelease"],
+			subgenres=tuple(document["unorderedSubgenres"]),
+			subgenres_nested=document["subgenresNested"],
+		)
+		for _, documents in chunk_documents(chunks_of_release_dates(tracks, chunk_size=MAX_BATCH_SIZE), warnings, workers=transform_workers)
+		for track_id, _, document in documents
+	)
+
+	count = write_catalog(path, catalog_tracks)
+
+	print(f"📚 {count} tracks were exported to {path}")
 	if warnings:
 		print("⚠️ it finished with these warnings: ")
 		for warning in warnings:
@@ -290,10 +728,24 @@ def seed_firestore_with_track_data(firestore: FirestoreClient, tracks: List[Trac
 
 
 if __name__ == "__main__":
-	from sys import argv
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description="Clone tracks from the Genre Sheet and Subgenre Sheet into Firestore")
+	parser.add_argument("dates", help="the newest and oldest release dates to clone, like 2020-06-28:2020-06-10, or just one like 2020-06-28")
+	parser.add_argument("--bisect", action="store_true", help="find the rows in the date range with a few small reads instead of reading tabs from the top (much faster for recent, narrow date ranges)")
+	parser.add_argument("--concurrency", type=int, default=SHEETS_MAX_CONCURRENT_REQUESTS, help="how many requests to the Sheets API can be going at once")
+	parser.add_argument("--sheets-cache", choices=["off", "on", "offline"], default=SHEETS_CACHE_MODE, help="whether to reuse (or only use) Sheets responses saved on disk")
+	parser.add_argument("--diff", action="store_true", help="only write tracks that changed since the last run, and delete tracks that disappeared from the sheets")
+	parser.add_argument("--catalog", type=Path, metavar="PATH", help="export the tracks to a catalog file at PATH instead of writing them to Firestore")
+	parser.add_argument("--sink", default=SYNC_SINK, metavar="|".join(SINK_KINDS), help="where to write the tracks to (Firestore unless told otherwise)")
+	parser.add_argument("--write-rate", type=float, default=INITIAL_WRITE_RATE, help="writes a second to Firestore to start out at, growing 50%% every 5 minutes (0 for no limit)")
+	parser.add_argument("--transform-workers", type=int, default=0, help="how many processes turn tracks into documents (0 for doing it in this one)")
+	parser.add_argument("-v", "--verbose", action="store_true", help="print every document as it's written")
+	parser.add_argument("--report", type=Path, metavar="PATH", help="save timings and counters of the run as JSON")
+	arguments = parser.parse_args()
 
 	# 2020-06-28:2020-06-10 -> 2020-06-28, 2020-06-10
-	start_string, _, end_string = argv[-1].partition(":")
+	start_string, _, end_string = arguments.dates.partition(":")
 
 	# Do a single date (by specifying it as the start and end) 
 	# i.e. 2020-06-28 -> 2020-06-28, 2020-06-28
@@ -301,10 +753,31 @@ if __name__ == "__main__":
 		end_string = start_string
 
 	start, end = [datetime.strptime(thing, "%Y-%m-%d").date() for thing in [start_string, end_string]]
-	
-	firestore = get_firestore()
-	genre_sheet = get_genre_sheet()
-	subgenre_sheet = get_subgenre_sheet()
 
-	tracks = build_up_track_information(genre_sheet, subgenre_sheet, start, end)
-	seed_firestore_with_track_data(firestore, tracks)
+	sheets_scheduler.limit_concurrency(arguments.concurrency)
+	run = start_run(f"tracks {arguments.dates}")
+	
+	genre_sheet = get_genre_sheet(arguments.sheets_cache)
+	subgenre_sheet = get_subgenre_sheet(arguments.sheets_cache)
+
+	tracks = build_up_track_information(genre_sheet, subgenre_sheet, start, end, bisect=arguments.bisect)
+
+	if arguments.catalog is not None:
+		export_catalog(arguments.catalog, tracks, transform_workers=arguments.transform_workers)
+	else:
+		sink = open_sink(arguments.sink)
+		manifest = TrackManifest(manifest_path_for(TRACK_MANIFEST_PATH, arguments.sink)) if arguments.diff else None
+		with run.stage("fetch"):
+			subgenre_table = get_subgenre_table(genre_sheet, arguments.sink)
+		# Only Firestore needs to be eased into (a local sink takes writes as fast as they come)
+		write_rate = arguments.write_rate if arguments.sink == "firestore" else None
+		try:
+			seed_firestore_with_track_data(sink, tracks, manifest=manifest, start=start, end=end,
+			                               write_rate=write_rate, transform_workers=arguments.transform_workers, subgenre_table=subgenre_table,
+			                               verbose=arguments.verbose)
+		finally:
+			close_sink(sink)
+
+	print(run.summary())
+	if arguments.report is not None:
+		run.save(arguments.report)
@@ -0,0 +1,369 @@
+#    genre.guide - Subgenre utilities
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from bisect import bisect_left
+from collections import deque
+from hashlib import blake2b
+from json import dump, dumps, load
+from pathlib import Path
+from re import compile
+from typing import cast, Deque, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple, TypedDict, Union
+from unicodedata import normalize
+
+from .genre_utils import DIVIDERS, OPERATORS
+
+
+# Subgenre to the subgenres it comes directly from
+Origins = Mapping[str, Iterable[str]]
+
+
+class SubgenreCycleError(ValueError):
+	"""Subgenres that (eventually) come from themselves, so they have no place in the family tree"""
+
+	def __init__(self, cycle: List[str]) -> None:
+		super().__init__(f"these subgenres come from each other in a cycle: {' -> '.join([*cycle, cycle[0]])}")
+		self.cycle = cycle
+
+
+class Lineage(NamedTuple):
+	# Every subgenre this one comes from, directly or not
+	ancestors: Tuple[str, ...]
+	# Every subgenre that comes from this one, directly or not
+	descendants: Tuple[str, ...]
+	# The most steps it takes to get from this subgenre up to a subgenre without origins (0 for those)
+	depth: int
+	# The subgenres without origins that this one comes from (or just itself, if it has no origins)
+	root_genres: Tuple[str, ...]
+
+
+def find_cycle(origins: Mapping[str, Set[str]], candidates: Iterable[str]) -> List[str]:
+	"""One cycle among candidates, which all still have origins among themselves after a topological sort gave up on them"""
+
+	remaining = set(candidates)
+	path: List[str] = []
+	seen: Dict[str, int] = {}
+
+	subgenre = next(iter(remaining))
+	while subgenre not in seen:
+		seen[subgenre] = len(path)
+		path.append(subgenre)
+		subgenre = min(origins[subgenre] & remaining)
+
+	# Upwards through the origins, so flip it to read from parent to child
+	return path[seen[subgenre]:][::-1]
+
+
+def topological_order(origins: Origins) -> List[str]:
+	"""Every subgenre (including ones that only show up as an origin), ordered so that each one comes after all of its origins
+	   Raises SubgenreCycleError if there's no such order"""
+
+	parents: Dict[str, Set[str]] = {}
+	for subgenre, subgenre_origins in origins.items():
+		parents.setdefault(subgenre, set()).update(subgenre_origins)
+		for origin in subgenre_origins:
+			parents.setdefault(origin, set())
+
+	children: Dict[str, List[str]] = {subgenre: [] for subgenre in parents}
+	for subgenre, subgenre_origins in parents.items():
+		for origin in subgenre_origins:
+			children[origin].append(subgenre)
+
+	# Kahn's algorithm, going through subgenres in name order whenever there's a choice so the result is the same every time
+	unresolved_origins = {subgenre: len(subgenre_origins) for subgenre, subgenre_origins in parents.items()}
+	ready: Deque[str] = deque(sorted(subgenre for subgenre, count in unresolved_origins.items() if count == 0))
+
+	order: List[str] = []
+	while ready:
+		subgenre = ready.popleft()
+		order.append(subgenre)
+
+		for child in sorted(children[subgenre]):
+			unresolved_origins[child] -= 1
+			if unresolved_origins[child] == 0:
+				ready.append(child)
+
+	if len(order) != len(parents):
+		raise SubgenreCycleError(find_cycle(parents, (subgenre for subgenre, count in unresolved_origins.items() if count)))
+
+	return order
+
+
+def bit_positions(bits: int) -> Iterator[int]:
+	"""The positions of the 1 bits, from the lowest bit to the highest"""
+
+	while bits:
+		lowest_bit = bits & -bits
+		yield lowest_bit.bit_length() - 1
+		bits ^= lowest_bit
+
+
+def names_in(bits: int, names: Sequence[str]) -> List[str]:
+	return sorted(names[position] for position in bit_positions(bits))
+
+
+def subgenre_closure(origins: Origins) -> Dict[str, Lineage]:
+	"""All ancestors, all descendants, depth, and root genres of every subgenre, all at once
+	   Each subgenre is a bit, so a whole set of subgenres is one int and combining sets is one OR:
+	   ancestors are built up in topological order, and descendants in the reverse of it"""
+
+	order = topological_order(origins)
+	bit_of = {subgenre: 1 << index for index, subgenre in enumerate(order)}
+
+	origin_bits: List[int] = []
+	for subgenre in order:
+		bits = 0
+		for origin in origins.get(subgenre, ()):
+			bits |= bit_of[origin]
+		origin_bits.append(bits)
+
+	ancestors = [0] * len(order)
+	depths = [0] * len(order)
+	roots = 0
+	for index in range(len(order)):
+		bits = origin_bits[index]
+		if not bits:
+			roots |= 1 << index
+
+		for origin_index in bit_positions(bits):
+			ancestors[index] |= ancestors[origin_index] | (1 << origin_index)
+			depths[index] = max(depths[index], depths[origin_index] + 1)
+
+	descendants = [0] * len(order)
+	for index in reversed(range(len(order))):
+		for origin_index in bit_positions(origin_bits[index]):
+			descendants[origin_index] |= descendants[index] | (1 << index)
+
+	return {
+		subgenre: Lineage(
+			ancestors=tuple(names_in(ancestors[index], order)),
+			descendants=tuple(names_in(descendants[index], order)),
+			depth=depths[index],
+			root_genres=tuple(names_in((ancestors[index] | (1 << index)) & roots, order)),
+		)
+		for index, subgenre in enumerate(order)
+	}
+
+
+# Bumped whenever the layout of the alias index changes, so readers can tell if they understand it
+ALIAS_INDEX_VERSION = 1
+
+WHITESPACE_PATTERN = compile(r"\s+")
+
+
+def normalize_name(name: str) -> str:
+	"""The key a subgenre name is looked up by, so that differences in case, spacing, and Unicode forms don't matter
+	   (lower instead of casefold because it's what toLowerCase does on the GraphQL side)"""
+
+	return WHITESPACE_PATTERN.sub(" ", normalize("NFKC", name)).strip().lower()
+
+
+class AliasIndexShard(TypedDict):
+	# Sorted normalized names, each lined up with the primary name it's for
+	keys: List[str]
+	primaryNames: List[str]
+
+
+class AliasIndexData(TypedDict):
+	version: int
+	# Changes whenever any name does
+	revision: str
+	shards: List[AliasIndexShard]
+
+
+class AliasIndex:
+	"""Every name (primary or alternative) of every subgenre, normalized, to the subgenre's primary name"""
+
+	def __init__(self, names: Mapping[str, str]) -> None:
+		self.keys: List[str] = sorted(names)
+		self.names: Dict[str, str] = {key: names[key] for key in self.keys}
+
+	@classmethod
+	def build(cls, primary_names: Iterable[str], aliases: Mapping[str, str]) -> "AliasIndex":
+		"""From primary names and the alias -> primary name mapping that the subgenre sync builds up
+		   A primary name always wins over another subgenre's alias that normalizes to the same key"""
+
+		names: Dict[str, str] = {}
+
+		for primary_name in sorted(primary_names):
+			names.setdefault(normalize_name(primary_name), primary_name)
+
+		for alias in sorted(aliases):
+			key = normalize_name(alias)
+			taken_by = names.setdefault(key, aliases[alias])
+			if taken_by != aliases[alias]:
+				print(f"{alias!r} (for {aliases[alias]}) is already a name for {taken_by}, so it's left out of the alias index")
+
+		return cls(names)
+
+	@property
+	def revision(self) -> str:
+		serialized = dumps([self.keys, [self.names[key] for key in self.keys]])
+		return blake2b(serialized.encode("utf8"), digest_size=16).hexdigest()
+
+	def resolve_name(self, name: str) -> Optional[str]:
+		"""The primary name of the subgenre that goes by name, if there is one"""
+
+		return self.names.get(normalize_name(name))
+
+	def search_prefix(self, prefix: str, *, limit: Optional[int] = None) -> List[str]:
+		"""Primary names of the subgenres that have a name starting with prefix, in order of the matching names
+		   (each subgenre only shows up once)"""
+
+		key_prefix = normalize_name(prefix)
+		matches: List[str] = []
+		found: Set[str] = set()
+
+		for index in range(bisect_left(self.keys, key_prefix), len(self.keys)):
+			key = self.keys[index]
+			if not key.startswith(key_prefix) or (limit is not None and len(matches) >= limit):
+				break
+
+			primary_name = self.names[key]
+			if primary_name not in found:
+				found.add(primary_name)
+				matches.append(primary_name)
+
+		return matches
+
+	def to_data(self, *, max_shard_size: int) -> AliasIndexData:
+		"""Split into shards of at most max_shard_size names each, in key order (so each shard covers a range of keys)"""
+
+		return {
+			"version": ALIAS_INDEX_VERSION,
+			"revision": self.revision,
+			"shards": [
+				{"keys": self.keys[start:start + max_shard_size], "primaryNames": [self.names[key] for key in self.keys[start:start + max_shard_size]]}
+				for start in range(0, len(self.keys), max_shard_size)
+			],
+		}
+
+	@classmethod
+	def from_data(cls, data: AliasIndexData) -> "AliasIndex":
+		if data["version"] != ALIAS_INDEX_VERSION:
+			raise ValueError(f"version {data['version']} of the alias index isn't understood (only version {ALIAS_INDEX_VERSION} is)")
+
+		names: Dict[str, str] = {}
+		for shard in data["shards"]:
+			names.update(zip(shard["keys"], shard["primaryNames"]))
+		return cls(names)
+
+	def save(self, path: Path, *, max_shard_size: int) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		temporary_path = path.with_suffix(".tmp")
+		with temporary_path.open("w", encoding="utf8") as file:
+			dump(self.to_data(max_shard_size=max_shard_size), file, ensure_ascii=False)
+		temporary_path.replace(path)
+
+	@classmethod
+	def load(cls, path: Path) -> "AliasIndex":
+		with path.open(encoding="utf8") as file:
+			data: AliasIndexData = load(file)
+		return cls.from_data(data)
+
+
+# What a "? (Genre)" placeholder looks like: a subgenre of Genre that isn't known yet
+UNKNOWN_SUBGENRE_PATTERN = compile(r"\? \((.+)\)")
+
+
+class ResolvedSubgenre(TypedDict):
+	name: str
+	category: str
+	backgroundColor: str
+	textColor: str
+
+
+# What SubgenreTable.resolve gives back: parse_genre's nesting with every name replaced by its subgenre (operators stay as they are)
+ResolvedNested = Union[ResolvedSubgenre, str, List["ResolvedNested"]]
+
+
+class SubgenreTable:
+	"""Just enough of every subgenre to show it (primary name, category, and colors), found by any of its names,
+	   so that tracks can carry their subgenres with them instead of needing a lookup for each one"""
+
+	def __init__(self, subgenres: Mapping[str, ResolvedSubgenre], alias_index: AliasIndex) -> None:
+		self.subgenres = dict(subgenres)
+		self.alias_index = alias_index
+		# Every name that's been resolved so far (the same few thousand names come up over and over)
+		self._resolved: Dict[str, Optional[ResolvedSubgenre]] = {}
+
+	@classmethod
+	def from_documents(cls, documents: Mapping[str, Mapping[str, object]]) -> "SubgenreTable":
+		"""From subgenre documents by primary name (like the subgenre sync writes), whose names start with the primary name"""
+
+		subgenres: Dict[str, ResolvedSubgenre] = {}
+		aliases: Dict[str, str] = {}
+		for primary_name, document in documents.items():
+			subgenres[primary_name] = {
+				"name": primary_name,
+				"category": str(document["category"]),
+				"backgroundColor": str(document["backgroundColor"]),
+				"textColor": str(document["textColor"]),
+			}
+			for alias in cast(List[str], document["names"])[1:]:
+				aliases[alias] = primary_name
+
+		return cls(subgenres, AliasIndex.build(subgenres, aliases))
+
+	@property
+	def revision(self) -> str:
+		"""Changes whenever anything that tracks embed does"""
+
+		serialized = dumps([self.alias_index.revision, sorted(self.subgenres.items())])
+		return blake2b(serialized.encode("utf8"), digest_size=16).hexdigest()
+
+	def resolve_name(self, name: str) -> Optional[ResolvedSubgenre]:
+		"""The subgenre that goes by name (with "? (Genre)" coming back as Genre, renamed to "? (Genre)"), if it's known"""
+
+		if name not in self._resolved:
+			self._resolved[name] = self._resolve_name(name)
+		return self._resolved[name]
+
+	def _resolve_name(self, name: str) -> Optional[ResolvedSubgenre]:
+		match = UNKNOWN_SUBGENRE_PATTERN.fullmatch(name)
+		known_name = match.group(1) if match else name
+		# Trap on its own means the EDM one, like the GraphQL server assumes
+		primary_name = self.alias_index.resolve_name("Trap (EDM)" if known_name == "Trap" else known_name)
+		if primary_name is None or primary_name not in self.subgenres:
+			return None
+
+		subgenre = self.subgenres[primary_name]
+		return {**subgenre, "name": f"? ({primary_name})"} if match else subgenre
+
+	def resolve(self, nested: object, unresolved: Set[str]) -> ResolvedNested:
+		"""nested (as parse_genre gives it) with every subgenre name replaced by its ResolvedSubgenre
+		   Names that aren't known are shown like ? is (and added to unresolved)"""
+
+		if isinstance(nested, (tuple, list)):
+			return [self.resolve(element, unresolved) for element in nested]
+
+		# Anything else is a name or an operator
+		nested = cast(str, nested)
+		if nested in OPERATORS or nested in DIVIDERS:
+			return nested
+
+		subgenre = self.resolve_name(nested)
+		if subgenre is None:
+			unresolved.add(nested)
+			unknown = self.subgenres.get("?")
+			return {
+				"name": nested,
+				"category": "?",
+				"backgroundColor": unknown["backgroundColor"] if unknown else "#000000",
+				"textColor": unknown["textColor"] if unknown else "#ffffff",
+			}
+		return subgenre
@@ -0,0 +1,127 @@
+#    genre.guide - Resumable backfill test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import date
+from itertools import islice
+from pathlib import Path
+from typing import cast, Dict, Iterable, Iterator, List, Mapping, Tuple
+
+from _pytest.monkeypatch import MonkeyPatch
+from google.api_core.exceptions import InvalidArgument
+from pytest import raises
+
+from ..benchmarks.synthetic import track_sheets
+from ..sheet_to_db import tracks
+from ..sheet_to_db.backfill import backfill_chunk, chunk_state_path, date_chunks, load_chunk_state, remaining_range
+from ..sheet_to_db.fakes import FakeAPI, FakeFirestore, FakeWriteBatch
+from ..sheet_to_db.tracks import Track, TrackDocumentData
+
+
+def release_dates_of(documents: Mapping[str, Dict[str, object]]) -> List[date]:
+	"The release dates of the track documents among documents (by path)"
+
+	return [cast(TrackDocumentData, document)["releaseDate"].date() for path, document in documents.items() if path.startswith("tracks/")]
+
+
+class CrashingFirestore(FakeFirestore):
+	"""Stops working (like the connection going down) after commits batches"""
+
+	def __init__(self, api: FakeAPI, commits: int) -> None:
+		super().__init__(api)
+		self.commits_left = commits
+
+	def batch(self) -> FakeWriteBatch:
+		if self.commits_left == 0:
+			raise InvalidArgument("the backfill crashed (fake)")  # type: ignore[no-untyped-call]
+		self.commits_left -= 1
+		return super().batch()
+
+
+def test_date_chunks() -> None:
+	"Chunks cover every day of the range once, newest first"
+
+	assert date_chunks(date(2020, 6, 28), date(2020, 6, 1), 10) == [
+		(date(2020, 6, 28), date(2020, 6, 19)),
+		(date(2020, 6, 18), date(2020, 6, 9)),
+		(date(2020, 6, 8), date(2020, 6, 1)),
+	]
+	assert date_chunks(date(2020, 6, 28), date(2020, 6, 28), 10) == [(date(2020, 6, 28), date(2020, 6, 28))]
+
+
+def test_backfill_resumes_after_a_crash(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"A chunk that crashed partway picks up after its last checkpoint, and every track still ends up written once it finishes"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	api = FakeAPI()
+	genre_sheet, subgenre_sheet = track_sheets(api, 4000, catalog_sheet_name="Main")
+	start, end = date(2020, 12, 31), date(2015, 1, 1)
+
+	crashing = CrashingFirestore(api, commits=5)
+	with raises(InvalidArgument):
+		backfill_chunk(crashing, genre_sheet, subgenre_sheet, tmp_path, start, end, checkpoint_every=200)
+
+	state = load_chunk_state(chunk_state_path(tmp_path, start, end), start, end)
+	assert not state["done"]
+	assert state["committedThrough"] is not None
+	resume_start, resume_end = remaining_range(state)  # type: ignore
+	assert end < resume_start < start
+
+	# Everything up to the checkpoint made it, so the rest of the run only has to write what's past it
+	healthy = FakeFirestore(api)
+	state = backfill_chunk(healthy, genre_sheet, subgenre_sheet, tmp_path, start, end, checkpoint_every=200)
+	assert state["done"]
+
+	written = {path: document for path, document in {**crashing.documents, **healthy.documents}.items() if path.startswith("tracks/")}
+	assert len(written) == state["tracks"]
+	assert all(release_date <= resume_start for release_date in release_dates_of(healthy.documents))
+	assert min(release_dates_of(written)) >= end
+
+	# And a finished chunk doesn't do anything at all
+	again = FakeFirestore(api)
+	backfill_chunk(again, genre_sheet, subgenre_sheet, tmp_path, start, end)
+	assert again.writes == 0
+
+
+def test_checkpoints_only_claim_completely_written_dates(monkeypatch: MonkeyPatch) -> None:
+	"Checkpoints only claim release dates that are completely written (and count exactly their tracks), even with a date split across chunks"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	def chunks_of(tracks: Iterable[Track], chunk_size: int) -> Iterator[List[Track]]:
+		iterator = iter(tracks)
+		return iter(lambda: list(islice(iterator, chunk_size)), [])
+
+	monkeypatch.setattr(tracks, "chunks_of_release_dates", chunks_of)
+
+	api = FakeAPI()
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main")
+	start, end = date(2020, 12, 31), date(2015, 1, 1)
+	firestore = FakeFirestore(api)
+	checkpoints: List[Tuple[date, int, int]] = []
+
+	def checkpoint(committed_through: date, processed: int) -> None:
+		written = sum(release_date >= committed_through for release_date in release_dates_of(firestore.documents))
+		checkpoints.append((committed_through, processed, written))
+
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, start, end),
+	                                      batch_size=7, start=start, end=end, checkpoint=checkpoint, checkpoint_every=1)
+
+	release_dates = release_dates_of(firestore.documents)
+	assert len(checkpoints) > 2
+	for committed_through, processed, written in checkpoints:
+		assert processed == written == sum(release_date >= committed_through for release_date in release_dates)
+	assert checkpoints[-1][0] == min(release_dates)
@@ -0,0 +1,255 @@
+#    genre.guide - Batched Firestore writes test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from threading import Event, Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+from pytest import raises
+
+from ..sheet_to_db.batched_writes import BatchedWriter, RampUpLimiter
+from ..sheet_to_db.fakes import FakeAPI, FakeCollectionReference, FakeDocumentReference, FakeFirestore as ThrottlingFirestore
+
+
+# (kind, path, document) for each write in a commit
+Commit = List[Tuple[str, str, Optional[Dict[str, object]]]]
+
+
+class FakeBatch:
+	def __init__(self, firestore: "FakeFirestore") -> None:
+		self.firestore = firestore
+		self.writes: Commit = []
+
+	def set(self, document_ref: FakeDocumentReference, document: Dict[str, object]) -> None:
+		self.writes.append(("set", document_ref.path, document))
+
+	def delete(self, document_ref: FakeDocumentReference) -> None:
+		self.writes.append(("delete", document_ref.path, None))
+
+	def commit(self) -> None:
+		if self.firestore.before_commit is not None:
+			self.firestore.before_commit(self.writes)
+
+		with self.firestore.lock:
+			if self.firestore.failures_left:
+				self.firestore.failures_left -= 1
+				raise self.firestore.failure
+
+			self.firestore.commits.append(self.writes)
+			for kind, path, document in self.writes:
+				if kind == "set":
+					self.firestore.documents[path] = document
+				else:
+					self.firestore.documents.pop(path, None)
+
+
+class FakeFirestore:
+	def __init__(self, failures: int = 0, failure: Optional[Exception] = None,
+	             before_commit: Optional[Callable[[Commit], None]] = None) -> None:
+		self.lock = Lock()
+		self.failures_left = failures
+		self.failure = failure or ServiceUnavailable("try again")  # type: ignore[no-untyped-call]
+		self.before_commit = before_commit
+		self.commits: List[Commit] = []
+		self.documents: Dict[str, Optional[Dict[str, object]]] = {}
+
+		# Only where document references come from
+		self._references = ThrottlingFirestore(FakeAPI())
+
+	def collection(self, name: str) -> FakeCollectionReference:
+		return self._references.collection(name)
+
+	def batch(self) -> FakeBatch:
+		return FakeBatch(self)
+
+
+def test_batched_writes_group_into_batches() -> None:
+	"Writes are committed in groups of at most batch_size"
+
+	firestore = FakeFirestore()
+	tracks = firestore.collection("tracks")
+	with BatchedWriter(firestore, batch_size=10, max_in_flight=3) as writer:
+		for i in range(25):
+			writer.set(tracks.document(str(i)), {"i": i})
+
+	assert sorted(len(commit) for commit in firestore.commits) == [5, 10, 10]
+	assert firestore.documents == {f"tracks/{i}": {"i": i} for i in range(25)}
+	assert writer.committed_writes == 25
+	assert writer.committed_batches == 3
+
+
+def test_batched_writes_delete() -> None:
+	"Deletes go through the same batches as sets"
+
+	firestore = FakeFirestore()
+	tracks = firestore.collection("tracks")
+	with BatchedWriter(firestore, batch_size=2) as writer:
+		writer.set(tracks.document("a"), {"a": 1})
+		writer.set(tracks.document("b"), {"b": 2})
+		writer.delete(tracks.document("a"))
+
+	assert firestore.documents == {"tracks/b": {"b": 2}}
+
+
+def test_batched_writes_retry() -> None:
+	"Transient failures are retried with backoff"
+
+	firestore = FakeFirestore(failures=2)
+	tracks = firestore.collection("tracks")
+	sleeps: List[float] = []
+	with BatchedWriter(firestore, batch_size=5, initial_backoff=1.0, sleep=sleeps.append) as writer:
+		for i in range(5):
+			writer.set(tracks.document(str(i)), {"i": i})
+
+	assert writer.retries == 2
+	assert len(sleeps) == 2
+	assert 0.5 <= sleeps[0] <= 1.0
+	assert 1.0 <= sleeps[1] <= 2.0
+	assert len(firestore.documents) == 5
+
+
+def test_batched_writes_give_up() -> None:
+	"Failures are raised once the attempts run out, or right away if they aren't transient"
+
+	firestore = FakeFirestore(failures=3)
+	writer = BatchedWriter(firestore, max_attempts=3, sleep=lambda _: None)
+	writer.set(firestore.collection("tracks").document("a"), {"a": 1})
+	with raises(ServiceUnavailable):
+		writer.close()
+
+	firestore = FakeFirestore(failures=1, failure=InvalidArgument("bad"))  # type: ignore[no-untyped-call]
+	writer = BatchedWriter(firestore, sleep=lambda _: None)
+	writer.set(firestore.collection("tracks").document("a"), {"a": 1})
+	with raises(InvalidArgument):
+		writer.close()
+	assert writer.retries == 0
+
+
+def test_batched_writes_batch_size_limit() -> None:
+	"Firestore doesn't allow more than 500 writes in a batch"
+
+	with raises(ValueError):
+		BatchedWriter(FakeFirestore(), batch_size=501)
+
+
+class FakeClock:
+	def __init__(self) -> None:
+		self.now = 0.0
+
+	def __call__(self) -> float:
+		return self.now
+
+	def sleep(self, seconds: float) -> None:
+		self.now += seconds
+
+
+def test_ramp_up_limiter_follows_500_50_5() -> None:
+	"Writes start out at 500 a second and go up by half every 5 minutes"
+
+	clock = FakeClock()
+	limiter = RampUpLimiter(clock=clock, sleep=clock.sleep)
+
+	assert limiter.take(500) == 0
+	assert limiter.take(500) == 1.0
+	assert limiter.rate() == 500
+
+	clock.now = 5 * 60
+	assert limiter.rate() == 750
+	clock.now = 10 * 60
+	assert limiter.rate() == 1125
+
+
+def test_ramp_up_limiter_slows_down_on_contention() -> None:
+	"Contention halves the rate, and it takes another interval to start growing again"
+
+	clock = FakeClock()
+	limiter = RampUpLimiter(clock=clock, sleep=clock.sleep)
+
+	clock.now = 5 * 60
+	limiter.contention()
+	assert limiter.rate() == 375
+	clock.now = 9 * 60
+	assert limiter.rate() == 375
+	clock.now = 10 * 60
+	assert limiter.rate() == 562.5
+
+
+def test_batched_writes_interleave_partitions() -> None:
+	"Writes in partitions are taken from each partition in turn"
+
+	firestore = FakeFirestore()
+	tracks = firestore.collection("tracks")
+	with BatchedWriter(firestore, batch_size=1, max_in_flight=1, interleave_window=6) as writer:
+		for name, partition in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("b2", "b"), ("c1", "c")]:
+			writer.set(tracks.document(name), {}, partition=partition)
+
+	assert [commit[0][1] for commit in firestore.commits] == ["tracks/a1", "tracks/b1", "tracks/c1", "tracks/a2", "tracks/b2", "tracks/a3"]
+
+
+def test_batched_writes_adapt_to_throttling() -> None:
+	"When Firestore can't keep up with the ramp-up, the writer backs off until it can"
+
+	clock = FakeClock()
+	firestore = ThrottlingFirestore(FakeAPI(), capacity=300, clock=clock)
+	limiter = RampUpLimiter(clock=clock, sleep=clock.sleep)
+	tracks = firestore.collection("tracks")
+
+	with BatchedWriter(firestore, batch_size=100, max_in_flight=1, max_attempts=10, limiter=limiter, sleep=clock.sleep) as writer:
+		for i in range(3000):
+			writer.set(tracks.document(str(i)), {"i": i})
+
+	assert len(firestore.documents) == 3000
+	assert firestore.throttled > 0
+	assert limiter.contentions == firestore.throttled
+	assert limiter.rate() <= 300
+
+
+def test_batched_writes_keep_the_latest_waiting_write() -> None:
+	"A write to a document that's still waiting to go replaces the waiting one, partition or not"
+
+	firestore = FakeFirestore()
+	tracks = firestore.collection("tracks")
+	with BatchedWriter(firestore, batch_size=10, interleave_window=10) as writer:
+		writer.set(tracks.document("a"), {"version": 1}, partition="2020-W26")
+		writer.set(tracks.document("b"), {"version": 1}, partition="2020-W27")
+		writer.set(tracks.document("a"), {"version": 2}, partition="2020-W27")
+		writer.delete(tracks.document("b"))
+
+	assert firestore.commits == [[("set", "tracks/a", {"version": 2}), ("delete", "tracks/b", None)]]
+	assert firestore.documents == {"tracks/a": {"version": 2}}
+
+
+def test_batched_writes_to_a_document_land_in_order() -> None:
+	"A commit with a document that an earlier commit (still going) has in it waits for that one, so the last write wins"
+
+	started = Event()
+
+	def before_commit(writes: Commit) -> None:
+		if writes[0][2] == {"version": 1}:
+			# Gives the second commit every chance to finish first, which it could if nothing stopped it from starting
+			started.wait(timeout=1)
+		else:
+			started.set()
+
+	firestore = FakeFirestore(before_commit=before_commit)
+	tracks = firestore.collection("tracks")
+	with BatchedWriter(firestore, batch_size=1, max_in_flight=4) as writer:
+		writer.set(tracks.document("a"), {"version": 1})
+		writer.set(tracks.document("a"), {"version": 2})
+
+	assert [commit[0][2] for commit in firestore.commits] == [{"version": 1}, {"version": 2}]
+	assert firestore.documents == {"tracks/a": {"version": 2}}
@@ -0,0 +1,88 @@
+#    genre.guide - Offline track catalog test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from datetime import date
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+from ..catalog import Catalog, CatalogTrack, write_catalog
+from ..track_utils import id_for_track
+
+
+def catalog_track(artist: str, title: str, release_date: date, label: str, subgenres: Tuple[str, ...], index: int = 0) -> CatalogTrack:
+	return CatalogTrack(
+		track_id=id_for_track(artist=artist, title=title, release_date=release_date.isoformat()),
+		artist=artist,
+		title=title,
+		release_date=release_date,
+		record_label=label,
+		index_on_label_on_release=index,
+		subgenres=subgenres,
+		subgenres_nested=f'["{subgenres[0]}"]',
+	)
+
+
+TRACKS = [
+	catalog_track("Porter Robinson", "Mirror", date(2020, 3, 5), "Mom + Pop", ("Synth-Pop",)),
+	catalog_track("Madeon", "Be Fine", date(2020, 4, 2), "Columbia", ("Nu-Disco", "Future Funk")),
+	catalog_track("Porter Robinson", "Musician", date(2020, 4, 23), "Mom + Pop", ("Future Bass", "Electro House")),
+	catalog_track("Virtual Riot", "Idols ✨", date(2020, 4, 23), "Disciple", ("Future Bass",)),
+	catalog_track("Porter Robinson", "Something Comforting", date(2020, 1, 29), "Mom + Pop", ("Electro House",)),
+]
+
+
+def test_catalog_round_trip(tmp_path: Path) -> None:
+	"Every track comes back out the same as it went in, oldest first"
+
+	assert write_catalog(tmp_path / "catalog.bin", TRACKS) == 5
+
+	with Catalog(tmp_path / "catalog.bin") as catalog:
+		assert len(catalog) == 5
+		tracks = [catalog.track(row) for row in range(len(catalog))]
+
+	assert tracks[0] == TRACKS[4]
+	assert sorted(tracks, key=lambda track: track.title) == sorted(
+		[track._replace(subgenres=tuple(sorted(track.subgenres))) for track in TRACKS], key=lambda track: track.title)
+
+
+def test_catalog_queries(tmp_path: Path) -> None:
+	"Date range, label, artist, and subgenre filters can be mixed together"
+
+	write_catalog(tmp_path / "catalog.bin", TRACKS)
+
+	with Catalog(tmp_path / "catalog.bin") as catalog:
+		def titles(tracks: Iterable[CatalogTrack]) -> List[str]:
+			return [track.title for track in tracks]
+
+		assert titles(catalog.query(start=date(2020, 3, 1), end=date(2020, 4, 2))) == ["Mirror", "Be Fine"]
+		assert titles(catalog.query(end=date(2020, 3, 5))) == ["Something Comforting", "Mirror"]
+		assert titles(catalog.query(subgenre="Future Bass")) == ["Idols ✨", "Musician"]
+		assert titles(catalog.query(subgenre="Electro House", start=date(2020, 2, 1))) == ["Musician"]
+		assert titles(catalog.query(label="Mom + Pop", start=date(2020, 2, 1))) == ["Mirror", "Musician"]
+		assert titles(catalog.query(artist="Porter Robinson", subgenre="Electro House")) == ["Something Comforting", "Musician"]
+		assert titles(catalog.query(subgenre="Dubstep")) == []
+		assert titles(catalog.query(start=date(2021, 1, 1))) == []
+
+
+def test_catalog_empty(tmp_path: Path) -> None:
+	"A catalog without any tracks still works"
+
+	write_catalog(tmp_path / "catalog.bin", [])
+
+	with Catalog(tmp_path / "catalog.bin") as catalog:
+		assert len(catalog) == 0
+		assert catalog.query(subgenre="Future Bass") == []
@@ -0,0 +1,314 @@
+#    genre.guide - Fake backends test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from datetime import date
+from json import loads
+from pathlib import Path
+from typing import cast, Dict, List
+
+from _pytest.monkeypatch import MonkeyPatch
+from gspread.exceptions import APIError
+from pytest import raises, warns
+
+from ..benchmarks.synthetic import genre_color_sheet, GENRE_SHEET_HEADER, NEWEST_RELEASE, OLDEST_RELEASE, SUBGENRE_SHEET_HEADER, track_sheets
+from ..sheet_to_db import subgenres, tracks
+from ..sheet_to_db.fakes import FakeAPI, FakeFirestore, FakeSpreadsheet, FakeWorksheet
+from ..sheet_to_db.manifest import SubgenreManifest, TrackManifest
+from ..sheet_to_db.postings import PostingShard, POSTINGS_COLLECTION
+from ..sheet_to_db.sheet_reads import get_values
+from ..sheet_to_db.tracks import TrackDocumentData
+from ..subgenre_utils import AliasIndex, SubgenreTable
+
+
+def written_tracks(firestore: FakeFirestore) -> Dict[str, TrackDocumentData]:
+	"The track documents in firestore, by path (which are what the track sync wrote)"
+
+	return {path: cast(TrackDocumentData, document) for path, document in firestore.documents.items() if path.startswith("tracks/")}
+
+
+def test_fake_values_get() -> None:
+	"Ranges are read like the real API does, without trailing empty cells and rows"
+
+	sheet = FakeSpreadsheet(FakeAPI())
+	tab = sheet.add_worksheet(FakeWorksheet("Main", [["a", "b", ""], ["c", "", ""], ["", "", ""]]))
+
+	assert get_values(tab, "A1:C3") == [["a", "b"], ["c"]]
+	assert get_values(tab, "B2:C3") == []
+	assert sheet.api.calls["sheets.values_get"] == 2
+
+
+def test_fake_quota_errors() -> None:
+	"Quota errors come out of the fakes the same way they would from gspread"
+
+	sheet = FakeSpreadsheet(FakeAPI(quota_error_rate=1.0))
+	tab = sheet.add_worksheet(FakeWorksheet("Main", [["a"]]))
+
+	with raises(APIError):
+		get_values(tab, "A1:A1")
+
+
+def test_track_sync_end_to_end(monkeypatch: MonkeyPatch) -> None:
+	"Every track on the synthetic sheets ends up in the fake Firestore"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	api = FakeAPI()
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main")
+	firestore = FakeFirestore(api)
+
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE))
+
+	track_documents = written_tracks(firestore)
+	assert len(track_documents) == 2000
+	release_dates = [document["releaseDate"].date() for document in track_documents.values()]
+	assert min(release_dates) >= OLDEST_RELEASE
+	assert max(release_dates) == NEWEST_RELEASE
+
+
+def test_subgenre_sync_end_to_end(monkeypatch: MonkeyPatch) -> None:
+	"The synthetic family tree comes out of the subgenre sync whole"
+
+	monkeypatch.setattr(subgenres, "GENRES_SHEET_NAME", "Genres")
+	monkeypatch.setattr(subgenres, "GENRE_INFO_SHEET_NAME", "Genre Info")
+
+	api = FakeAPI()
+	genre_sheet = genre_color_sheet(api, 300, genres_sheet_name="Genres", genre_info_sheet_name="Genre Info", genre_count=5)
+	subgenre_data, aliases = subgenres.build_up_subgenre_information(genre_sheet)
+
+	assert len(subgenre_data) == 305
+	assert all(data["origins"] for name, data in subgenre_data.items() if not data["is_genre"])
+
+
+def test_track_sync_with_transform_workers(monkeypatch: MonkeyPatch) -> None:
+	"Turning tracks into documents in other processes gives the same documents (indexOnLabelOnRelease included) as doing it in this one"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	written = []
+	for transform_workers in [0, 2]:
+		api = FakeAPI()
+		genre_sheet, subgenre_sheet = track_sheets(api, 3000, catalog_sheet_name="Main")
+		firestore = FakeFirestore(api)
+		tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE),
+		                                      batch_size=200, transform_workers=transform_workers)
+		written.append(firestore.documents)
+
+	in_this_process, in_workers = written
+	assert sum(path.startswith("tracks/") for path in in_workers) == 3000
+	assert in_workers == in_this_process
+
+
+def test_subgenre_sync_only_writes_changes(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"With a manifest, a second subgenre sync writes nothing, and a later one only writes and deletes what changed"
+
+	monkeypatch.setattr(subgenres, "GENRES_SHEET_NAME", "Genres")
+	monkeypatch.setattr(subgenres, "GENRE_INFO_SHEET_NAME", "Genre Info")
+	monkeypatch.setattr(subgenres, "ALIAS_INDEX_PATH", tmp_path / "alias_index.json")
+
+	api = FakeAPI()
+	genre_sheet = genre_color_sheet(api, 300, genres_sheet_name="Genres", genre_info_sheet_name="Genre Info", genre_count=5)
+	subgenre_data, aliases = subgenres.build_up_subgenre_information(genre_sheet)
+	firestore = FakeFirestore(api)
+	manifest_path = tmp_path / "subgenre_manifest.json"
+
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=SubgenreManifest(manifest_path))
+	first_run_writes = firestore.writes
+	assert first_run_writes > 306
+
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=SubgenreManifest(manifest_path))
+	assert firestore.writes == first_run_writes
+
+	# A new color for one subgenre, and one subgenre that nothing comes from taken off the sheet
+	recolored = next(name for name, data in subgenre_data.items() if not data["is_genre"])
+	subgenre_data[recolored]["color"] = ("#123456", "#ffffff")
+	removed = next(name for name in reversed(list(subgenre_data)) if name != recolored and not any(name in data["origins"] for data in subgenre_data.values()))
+	del subgenre_data[removed]
+	aliases = {alias: alias_for for alias, alias_for in aliases.items() if alias_for != removed}
+
+	manifest = SubgenreManifest(manifest_path)
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=manifest)
+
+	assert manifest.removed == [removed]
+	assert "backgroundColor" in manifest.modified[recolored]
+	assert f"subgenres/{removed}" not in firestore.documents
+	assert firestore.documents[f"subgenres/{recolored}"]["backgroundColor"] == "#123456"
+	assert firestore.writes - first_run_writes < 20
+
+
+def test_track_sync_posting_lists(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"A full sync builds every posting list, and a narrow --diff without a manifest to go on only adds to them"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	api = FakeAPI()
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main")
+	firestore = FakeFirestore(api)
+
+	def posting_shards() -> Dict[str, PostingShard]:
+		return {
+			path: cast(PostingShard, document)
+			for path, document in firestore.documents.items() if path.startswith(f"{POSTINGS_COLLECTION}/")
+		}
+
+	def posting_lists() -> Dict[str, List[str]]:
+		return {path: shard["trackIds"] for path, shard in posting_shards().items()}
+
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE))
+
+	track_documents = {path[len("tracks/"):]: document for path, document in written_tracks(firestore).items()}
+	after_full_sync = posting_lists()
+	assert sum(len(track_ids) for track_ids in after_full_sync.values()) == sum(len(document["unorderedSubgenres"]) for document in track_documents.values())
+	assert all(
+		subgenre_name in track_documents[track_id]["unorderedSubgenres"]
+		for path, track_ids in after_full_sync.items()
+		for subgenre_name in [posting_shards()[path]["subgenre"]]
+		for track_id in track_ids
+	)
+
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, NEWEST_RELEASE),
+	                                      manifest=TrackManifest(tmp_path / "track_manifest.json"), start=NEWEST_RELEASE, end=NEWEST_RELEASE)
+	assert posting_lists() == after_full_sync
+
+
+def test_track_sync_embeds_subgenres(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"Tracks carry their subgenres resolved, and only the tracks with a subgenre that changed are written again"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+	monkeypatch.setattr(subgenres, "GENRES_SHEET_NAME", "Genres")
+	monkeypatch.setattr(subgenres, "GENRE_INFO_SHEET_NAME", "Genre Info")
+
+	api = FakeAPI()
+	subgenre_table = subgenres.subgenre_table_from_sheet(genre_color_sheet(api, 500, genres_sheet_name="Genres", genre_info_sheet_name="Genre Info"))
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main")
+	firestore = FakeFirestore(api)
+
+	def sync(subgenre_table: SubgenreTable) -> None:
+		manifest = TrackManifest(tmp_path / "track_manifest.json")
+		tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE),
+		                                      manifest=manifest, start=NEWEST_RELEASE, end=OLDEST_RELEASE, subgenre_table=subgenre_table)
+
+	sync(subgenre_table)
+	track_documents = written_tracks(firestore)
+	assert len(track_documents) == 2000
+
+	single = next(document for document in track_documents.values() if len(document["unorderedSubgenres"]) == 1 and not document["unorderedOperators"])
+	recolored = single["unorderedSubgenres"][0]
+	assert loads(single["subgenresResolved"] or "") == [subgenre_table.subgenres[recolored]]
+	assert all('"category":"?"' not in (document["subgenresResolved"] or "") for document in track_documents.values())
+
+	documents = {
+		primary_name: {"names": [primary_name], **{field: value for field, value in subgenre.items() if field != "name"}}
+		for primary_name, subgenre in subgenre_table.subgenres.items()
+	}
+	documents[recolored]["backgroundColor"] = "#123456"
+	sync(SubgenreTable.from_documents(documents))
+
+	# Documents that were written again are new dicts
+	rewritten_tracks = written_tracks(firestore)
+	rewritten = [path for path, document in track_documents.items() if rewritten_tracks[path] is not document]
+	with_recolored = [path for path, document in track_documents.items() if recolored in document["unorderedSubgenres"]]
+	assert sorted(rewritten) == sorted(with_recolored)
+	assert all("#123456" in (rewritten_tracks[path]["subgenresResolved"] or "") for path in rewritten)
+
+
+def test_subgenre_sync_reembeds_tracks(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"After a subgenre changes, reembed_tracks writes the tracks that embed it again (and only those), with the subgenre as it is now"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+	monkeypatch.setattr(subgenres, "GENRES_SHEET_NAME", "Genres")
+	monkeypatch.setattr(subgenres, "GENRE_INFO_SHEET_NAME", "Genre Info")
+	monkeypatch.setattr(subgenres, "ALIAS_INDEX_PATH", tmp_path / "alias_index.json")
+
+	api = FakeAPI()
+	subgenre_data, aliases = subgenres.build_up_subgenre_information(genre_color_sheet(api, 500, genres_sheet_name="Genres", genre_info_sheet_name="Genre Info"))
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main")
+	firestore = FakeFirestore(api)
+	subgenre_manifest_path = tmp_path / "subgenre_manifest.json"
+	track_manifest_path = tmp_path / "track_manifest.json"
+
+	subgenre_manifest = SubgenreManifest(subgenre_manifest_path)
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=subgenre_manifest)
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE),
+	                                      manifest=TrackManifest(track_manifest_path), start=NEWEST_RELEASE, end=OLDEST_RELEASE,
+	                                      subgenre_table=SubgenreTable.from_documents(subgenre_manifest.documents))
+	track_documents = written_tracks(firestore)
+
+	# Nothing changed, so there's nothing to do
+	subgenre_manifest = SubgenreManifest(subgenre_manifest_path)
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=subgenre_manifest)
+	assert subgenres.reembed_tracks(firestore, genre_sheet, subgenre_sheet, subgenre_manifest, track_manifest_path) is None
+
+	recolored = next(document["unorderedSubgenres"][0] for document in track_documents.values() if document["unorderedSubgenres"])
+	subgenre_data[recolored]["color"] = ("#123456", "#ffffff")
+	subgenre_manifest = SubgenreManifest(subgenre_manifest_path)
+	subgenres.seed_firestore_with_subgenre_data(firestore, subgenre_data, aliases, manifest=subgenre_manifest)
+	assert subgenres.reembed_tracks(firestore, genre_sheet, subgenre_sheet, subgenre_manifest, track_manifest_path) is not None
+
+	# Documents that were written again are new dicts
+	reembedded_tracks = written_tracks(firestore)
+	assert len(reembedded_tracks) == 2000
+	rewritten = [path for path, document in track_documents.items() if reembedded_tracks[path] is not document]
+	with_recolored = [path for path, document in track_documents.items() if recolored in document["unorderedSubgenres"]]
+	assert rewritten and sorted(rewritten) == sorted(with_recolored)
+	assert all("#123456" in (reembedded_tracks[path]["subgenresResolved"] or "") for path in rewritten)
+
+
+def test_invalid_release_dates_stay_out_of_the_merge(monkeypatch: MonkeyPatch) -> None:
+	"A row without a valid release date is skipped instead of breaking up the newest first order of the tabs it's merged with"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	api = FakeAPI()
+	genre_sheet = FakeSpreadsheet(api, title="Genre Sheet", id="genre-sheet")
+	genre_sheet.add_worksheet(FakeWorksheet("Main", [
+		GENRE_SHEET_HEADER,
+		["A", "t1", "2020-06-28", "Label", "Dubstep", "Dubstep"],
+		["A", "t2", "2020-06-27", "Label", "Dubstep", "Dubstep"],
+		["A", "t3", "TBA", "Label", "Dubstep", "Dubstep"],
+	]))
+	subgenre_sheet = FakeSpreadsheet(api, title="Subgenre Sheet", id="subgenre-sheet")
+	subgenre_sheet.add_worksheet(FakeWorksheet("2020-2024", [
+		SUBGENRE_SHEET_HEADER,
+		["B", "u1", "Label", "2020-06-28", "Dubstep", "Dubstep", "", "", ""],
+		["B", "u2", "Label", "2020-06-27", "Dubstep", "Dubstep", "", "", ""],
+	]))
+
+	with warns(UserWarning, match="TBA"):
+		found = list(tracks.build_up_track_information(genre_sheet, subgenre_sheet, date(2020, 6, 28), date(2020, 6, 1)))
+
+	assert [track["release_date"] for track in found] == ["2020-06-28", "2020-06-28", "2020-06-27", "2020-06-27"]
+
+	documents = [document for _, _, document in tracks.track_documents(found, [])]
+	assert sorted(document["indexOnLabelOnRelease"] for document in documents if document["releaseDate"].day == 27) == [0, 1]
+
+
+def test_alias_index_shards_left_over_are_deleted(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"Writing a smaller alias index replaces the index and deletes the shards that nothing points to anymore"
+
+	monkeypatch.setattr(subgenres, "ALIAS_INDEX_PATH", tmp_path / "alias_index.json")
+
+	firestore = FakeFirestore(FakeAPI())
+	names = {f"Subgenre {number}": f"Subgenre {number}" for number in range(10)}
+
+	subgenres.seed_firestore_with_alias_index(firestore, AliasIndex(names), max_shard_size=2)
+	assert firestore.documents[f"{subgenres.ALIAS_INDEX_COLLECTION}/index"]["shards"] == 5
+
+	subgenres.seed_firestore_with_alias_index(firestore, AliasIndex(names), max_shard_size=4)
+	assert firestore.documents[f"{subgenres.ALIAS_INDEX_COLLECTION}/index"]["shards"] == 3
+	assert sorted(path for path in firestore.documents if path.startswith(f"{subgenres.ALIAS_INDEX_COLLECTION}/")) == [
+		f"{subgenres.ALIAS_INDEX_COLLECTION}/{document_id}" for document_id in ("index", "shard-0", "shard-1", "shard-2")
+	]
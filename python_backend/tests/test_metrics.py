@@ -0,0 +1,83 @@
+#    genre.guide - Tests for the run metrics of the sync
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from io import StringIO
+from json import load
+from pathlib import Path
+from time import sleep
+
+from ..sheet_to_db.metrics import ProgressLine, RunMetrics
+
+
+def test_nested_stages_are_timed_exclusively() -> None:
+	"""Time spent in an inner stage doesn't also count towards the stage around it"""
+
+	run = RunMetrics("test")
+	with run.stage("transform"):
+		with run.stage("fetch", items=3):
+			sleep(0.05)
+
+	report = run.report()
+	assert report["stages"]["fetch"]["seconds"] >= 0.05
+	assert report["stages"]["fetch"]["items"] == 3
+	assert report["stages"]["transform"]["seconds"] < 0.05
+
+
+def test_timed_counts_items_passed_through() -> None:
+	"""timed gives back everything it's given, counting each one as an item of its stage"""
+
+	run = RunMetrics("test")
+	assert list(run.timed("fetch", range(5))) == [0, 1, 2, 3, 4]
+	assert run.report()["stages"]["fetch"]["items"] == 5
+
+
+def test_report_saves_counters(tmp_path: Path) -> None:
+	"""Counters add up and are saved with the stages as JSON"""
+
+	run = RunMetrics("tracks")
+	run.count("sheets.requests")
+	run.count("sheets.bytes_received", 2048)
+	run.count("sheets.requests")
+	with run.stage("write", items=1):
+		pass
+
+	path = tmp_path / "reports" / "run.json"
+	run.save(path)
+	with path.open(encoding="utf8") as file:
+		saved = load(file)
+
+	assert saved["name"] == "tracks"
+	assert saved["counters"] == {"sheets.bytes_received": 2048, "sheets.requests": 2}
+	assert saved["stages"]["write"]["items"] == 1
+	assert "sheets.requests: 2" in run.summary()
+
+
+def test_progress_line_only_shows_when_enabled() -> None:
+	"""The progress line is rewritten in place, and says nothing at all when it's turned off"""
+
+	shown = StringIO()
+	progress = ProgressLine("tracks", stream=shown, enabled=True)
+	progress.update(10, fraction=0.5, force=True)
+	progress.finish(20)
+	assert shown.getvalue().startswith("\rtracks: 10 done")
+	assert "100%" in shown.getvalue()
+	assert shown.getvalue().endswith("\n")
+
+	hidden = StringIO()
+	progress = ProgressLine("tracks", stream=hidden, enabled=False)
+	progress.update(10, force=True)
+	progress.finish(20)
+	assert hidden.getvalue() == ""
@@ -17,7 +17,7 @@
 
 from pytest import raises
 
-from ..genre_utils import parse_genre
+from ..genre_utils import GenreSyntaxError, parse_genre, parse_genres
 
 
 def test_parse_genre_single():
@@ -134,3 +134,56 @@ def test_parse_genre_failure():
 	with raises(ValueError):
 		# Malformed (a few operators)
 		parse_genre("> ~ >")
+
+
+def test_parse_genre_cache() -> None:
+	"Parsing the same text again is answered from the cache"
+	parse_genre.cache_clear()
+
+	first = parse_genre("Future Bass || Wonky > Experimental")
+	second = parse_genre("Future Bass || Wonky > Experimental")
+
+	assert first is second
+	assert parse_genre.cache_info().hits == 1
+	assert parse_genre.cache_info().misses == 1
+
+
+def test_parse_genres() -> None:
+	"Batch parsing lines up with parsing one at a time, and repeated texts share their results"
+	genre_texts = ["Space Bass | Drum & Bass", "Future Bass", "Space Bass | Drum & Bass", "Wonky || Trap ~ Glitch Hop"]
+
+	parsed = parse_genres(genre_texts)
+
+	assert parsed.nested == [parse_genre(genre_text) for genre_text in genre_texts]
+	assert parsed.nested_json[0] == '["Space Bass", "|", "Drum & Bass"]'
+	assert parsed.flat[3] == ("Wonky", "|", "Trap", "~", "Glitch Hop")
+	assert parsed.subgenres[3] == {"Wonky", "Trap", "Glitch Hop"}
+	assert parsed.operators[3] == {"|", "~"}
+	assert parsed.operators[1] == set()
+	assert parsed.flat[0] is parsed.flat[2]
+
+
+def test_parse_genre_nested_groups() -> None:
+	"Parentheses can group at any depth, and groups can have any number of genres in them"
+	assert parse_genre("(Trap ~ (Wonky | Glitch Hop)) > Future Bass") == (
+		("Trap", "~", ("Wonky", "|", "Glitch Hop")), ">", "Future Bass")
+	assert parse_genre("(Trap | Wonky | Glitch Hop) > Future Bass") == (
+		("Trap", "|", "Wonky", "|", "Glitch Hop"), ">", "Future Bass")
+
+
+def test_parse_genre_parentheses_in_names() -> None:
+	"Parentheses that are part of a genre name aren't mistaken for grouping"
+	assert parse_genre("Trap (EDM) | Wonky") == ("Trap (EDM)", "|", "Wonky")
+	assert parse_genre("(Trap (EDM) ~ Wonky) > Hardstyle") == (("Trap (EDM)", "~", "Wonky"), ">", "Hardstyle")
+
+
+def test_parse_genre_error_position() -> None:
+	"Syntax errors point at where the problem is"
+
+	with raises(GenreSyntaxError) as error:
+		parse_genre("Progressive House > Melodic Dubstep | Glitch Hop")
+	assert error.value.position == len("Progressive House > Melodic Dubstep ")
+
+	with raises(GenreSyntaxError) as error:
+		parse_genre("(Trap | Wonky")
+	assert error.value.position == 0
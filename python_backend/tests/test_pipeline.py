@@ -0,0 +1,92 @@
+#    genre.guide - Sync pipeline test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from threading import Barrier, Event
+from time import sleep
+from typing import Iterator, List
+
+from pytest import raises
+
+from ..sheet_to_db.pipeline import run_concurrently, run_pipeline
+
+
+def test_stages_overlap() -> None:
+	"Every item goes through every stage in order, and the stages work at the same time"
+
+	pulled_ahead = Event()
+
+	def source() -> Iterator[int]:
+		for number in range(10):
+			if number == 2:
+				pulled_ahead.set()
+			yield number
+
+	def double(number: int) -> int:
+		return number * 2
+
+	written: List[int] = []
+	overlapped: List[bool] = []
+
+	def write(number: int) -> None:
+		if number == 0:
+			# The source only gets this far while the first item is still being written if the stages run at the same time
+			# (one stage after the other would wait out the whole timeout)
+			overlapped.append(pulled_ahead.wait(timeout=5))
+		written.append(number)
+
+	run_pipeline(source(), [("double", double), ("write", write)])
+
+	assert written == [number * 2 for number in range(10)]
+	assert overlapped == [True]
+
+
+def test_failures_stop_everything() -> None:
+	"A stage failing stops the source from being read any further, and the failure comes out of run_pipeline"
+
+	pulled: List[int] = []
+	closed: List[bool] = []
+
+	def source() -> Iterator[int]:
+		try:
+			for number in range(1000):
+				pulled.append(number)
+				yield number
+		finally:
+			closed.append(True)
+
+	def write(number: int) -> None:
+		sleep(0.01)
+		raise ValueError(f"can't write {number}")
+
+	with raises(ValueError, match="can't write 0"):
+		run_pipeline(source(), [("transform", lambda number: number), ("write", write)], queue_size=2)
+
+	assert closed == [True]
+	# Only a few queues' worth got read ahead of the failure
+	assert len(pulled) < 10
+
+
+def test_run_concurrently() -> None:
+	"Functions are called at the same time, and what they give back is in the same order as they were given"
+
+	# Neither function can get past this until the other one has been called too
+	both_called = Barrier(2, timeout=5)
+
+	def called_with(value: str) -> str:
+		both_called.wait()
+		return value
+
+	assert run_concurrently(lambda: called_with("genres"), lambda: called_with("colors")) == ("genres", "colors")
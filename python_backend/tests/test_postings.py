@@ -0,0 +1,91 @@
+#    genre.guide - Subgenre posting lists test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import Collection, Dict, Optional, Sequence, Tuple
+
+from ..sheet_to_db.batched_writes import BatchedWriter
+from ..sheet_to_db.fakes import FakeAPI, FakeFirestore
+from ..sheet_to_db.postings import merge_posting_lists, PostingChanges
+
+
+def sync(firestore: FakeFirestore, tracks: Dict[str, Tuple[str, Sequence[str]]], *, newest: Optional[str] = None, through: Optional[str] = None,
+         gone: Collection[str] = (), also: Collection[Tuple[str, str]] = ()) -> Tuple[int, int]:
+	changes = PostingChanges(newest)
+	for track_id, (release_date, subgenres) in tracks.items():
+		changes.add(track_id, release_date, subgenres)
+	for track_id in gone:
+		changes.remove(track_id)
+
+	with BatchedWriter(firestore) as writer:
+		return merge_posting_lists(writer, firestore.collection("subgenreTracks"), changes, through=through, also=also, shard_size=2)
+
+
+def test_posting_lists() -> None:
+	"Posting lists are newest first, split by year and into shards, and have slashes escaped in their IDs"
+
+	firestore = FakeFirestore(FakeAPI())
+	sync(firestore, {
+		"a": ("2020-06-28", ["Future Bass"]),
+		"b": ("2020-06-10", ["Future Bass", "Melodic Dubstep"]),
+		"c": ("2020-07-01", ["Future Bass"]),
+		"d": ("2019-01-01", ["Future Bass", "Drum & Bass / Jungle"]),
+	})
+
+	assert firestore.documents["subgenreTracks/Future%20Bass:2020:0"]["trackIds"] == ["c", "a"]
+	assert firestore.documents["subgenreTracks/Future%20Bass:2020:1"]["trackIds"] == ["b"]
+	assert firestore.documents["subgenreTracks/Future%20Bass:2020:1"]["shards"] == 2
+	assert firestore.documents["subgenreTracks/Future%20Bass:2019:0"]["releaseDates"] == ["2019-01-01"]
+	assert "subgenreTracks/Drum%20%26%20Bass%20%2F%20Jungle:2019:0" in firestore.documents
+
+
+def test_posting_lists_incremental() -> None:
+	"Only shards that come out different are written again, and shards that aren't needed anymore are deleted"
+
+	firestore = FakeFirestore(FakeAPI())
+	sync(firestore, {
+		"a": ("2020-06-28", ["Future Bass"]),
+		"b": ("2020-06-10", ["Future Bass"]),
+		"c": ("2020-07-01", ["Future Bass"]),
+		"d": ("2020-07-01", ["Moombahton"]),
+	})
+
+	assert sync(firestore, {"d": ("2020-07-01", ["Moombahton"])}) == (0, 0)
+
+	# c was deleted, and the only other track released from 2020-07-01 back to 2020-06-20 is a
+	written, deleted = sync(firestore, {"a": ("2020-06-28", ["Future Bass"])}, newest="2020-07-01", through="2020-06-20", gone=["c"],
+	                        also=[("Future Bass", "2020")])
+	assert (written, deleted) == (1, 1)
+	assert firestore.documents["subgenreTracks/Future%20Bass:2020:0"]["trackIds"] == ["a", "b"]
+	assert "subgenreTracks/Future%20Bass:2020:1" not in firestore.documents
+	assert firestore.documents["subgenreTracks/Moombahton:2020:0"]["trackIds"] == ["d"]
+
+
+def test_posting_lists_keep_what_a_sync_did_not_cover() -> None:
+	"A sync of a few days adds to what's stored instead of replacing it, and only takes out tracks from those days that it didn't come across"
+
+	firestore = FakeFirestore(FakeAPI())
+	sync(firestore, {
+		"old": ("2020-01-01", ["Future Bass"]),
+		"gone": ("2020-06-27", ["Future Bass"]),
+		"moved": ("2020-06-28", ["Future Bass"]),
+	})
+
+	sync(firestore, {"new": ("2020-06-28", ["Future Bass"]), "moved": ("2020-06-28", ["Moombahton"])}, newest="2020-06-28", through="2020-06-27")
+
+	assert firestore.documents["subgenreTracks/Future%20Bass:2020:0"]["trackIds"] == ["new", "old"]
+	assert "subgenreTracks/Future%20Bass:2020:1" not in firestore.documents
+	assert firestore.documents["subgenreTracks/Moombahton:2020:0"]["trackIds"] == ["moved"]
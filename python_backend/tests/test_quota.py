@@ -0,0 +1,131 @@
+#    genre.guide - Sheets API quota scheduler test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from threading import Event, Thread
+from typing import List
+
+from _pytest.monkeypatch import MonkeyPatch
+from gspread.exceptions import APIError
+from pytest import raises
+
+from ..benchmarks.synthetic import NEWEST_RELEASE, OLDEST_RELEASE, track_sheets
+from ..sheet_to_db import tracks
+from ..sheet_to_db.fakes import FakeAPI, FakeErrorResponse, FakeFirestore
+from ..sheet_to_db.quota import RequestScheduler, TokenBucket
+
+
+class FakeClock:
+	def __init__(self) -> None:
+		self.now = 0.0
+		self.slept: List[float] = []
+
+	def __call__(self) -> float:
+		return self.now
+
+	def sleep(self, seconds: float) -> None:
+		self.slept.append(seconds)
+		self.now += seconds
+
+
+def test_token_bucket_paces_after_a_burst() -> None:
+	"A full bucket lets a minute's worth of requests through at once, and one a second after that"
+
+	clock = FakeClock()
+	bucket = TokenBucket(60, clock=clock, sleep=clock.sleep)
+
+	for _ in range(60):
+		bucket.take()
+	assert clock.slept == []
+
+	bucket.take()
+	bucket.take()
+	assert clock.slept == [1.0, 1.0]
+
+
+def test_retries_on_quota_errors_with_backoff() -> None:
+	"429s and 5xxs are retried with growing (jittered) waits until the request goes through"
+
+	clock = FakeClock()
+	scheduler = RequestScheduler("test", [], max_concurrent=1, initial_backoff=1.0, seed=0, sleep=clock.sleep)
+	failures = [APIError(FakeErrorResponse(429, "RESOURCE_EXHAUSTED", "slow down")), APIError(FakeErrorResponse(503, "UNAVAILABLE", "hold on"))]
+
+	def request() -> str:
+		if failures:
+			raise failures.pop(0)
+		return "done"
+
+	assert scheduler.call(None, request) == "done"
+	assert len(clock.slept) == 2
+	assert 0 <= clock.slept[0] <= 1 and 0 <= clock.slept[1] <= 2
+
+
+def test_other_errors_are_not_retried() -> None:
+	"A request that's wrong fails right away"
+
+	clock = FakeClock()
+	scheduler = RequestScheduler("test", [], max_concurrent=1, sleep=clock.sleep)
+
+	def request() -> None:
+		raise APIError(FakeErrorResponse(400, "INVALID_ARGUMENT", "no such range"))
+
+	with raises(APIError):
+		scheduler.call(None, request)
+	assert clock.slept == []
+
+
+def test_identical_requests_are_coalesced() -> None:
+	"A request for the same thing as one that's already going waits for that one's response"
+
+	scheduler = RequestScheduler("test", [], max_concurrent=2)
+	started = Event()
+	release = Event()
+	calls: List[str] = []
+
+	def request() -> str:
+		calls.append("A1:F1000")
+		started.set()
+		release.wait(5)
+		return "values"
+
+	results: List[str] = []
+	leader = Thread(target=lambda: results.append(scheduler.call("A1:F1000", request)))
+	leader.start()
+	started.wait(5)
+
+	follower = Thread(target=lambda: results.append(scheduler.call("A1:F1000", request)))
+	follower.start()
+	release.set()
+	leader.join(5)
+	follower.join(5)
+
+	assert results == ["values", "values"]
+	assert calls == ["A1:F1000"]
+
+
+def test_track_sync_survives_quota_errors(monkeypatch: MonkeyPatch) -> None:
+	"Sheets reads that are turned away for being over quota are retried instead of failing the run"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	api = FakeAPI(quota_error_rate=0.2, seed=4)
+	scheduler = RequestScheduler("sheets", [], max_concurrent=4, seed=5, sleep=lambda seconds: None)
+	genre_sheet, subgenre_sheet = track_sheets(api, 2000, catalog_sheet_name="Main", scheduler=scheduler)
+	firestore = FakeFirestore(FakeAPI())
+
+	tracks.seed_firestore_with_track_data(firestore, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE))
+
+	assert api.quota_errors > 0
+	assert sum(path.startswith("tracks/") for path in firestore.documents) == 2000
@@ -0,0 +1,95 @@
+#    genre.guide - Sheets response cache test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from json import dumps, loads
+from pathlib import Path
+from typing import List
+
+from pytest import raises
+
+from ..sheet_to_db.response_cache import CacheMiss, CachingClient, ResponseCache
+
+
+VALUES_URL = "https://sheets.googleapis.com/v4/spreadsheets/abc/values/Main%21A1%3AF10"
+
+
+class FakeResponse:
+	ok = True
+
+	def __init__(self, body: object) -> None:
+		self.text = dumps(body)
+
+	def json(self) -> object:
+		return loads(self.text)
+
+
+class FakeSession:
+	def __init__(self) -> None:
+		self.modified_time = "2020-06-28T00:00:00Z"
+		self.requests: List[str] = []
+
+	def get(self, endpoint: str, **kwargs: object) -> FakeResponse:
+		self.requests.append(endpoint)
+
+		if "drive" in endpoint:
+			return FakeResponse({"modifiedTime": self.modified_time})
+		return FakeResponse({"values": [[f"fetched at {self.modified_time}"]]})
+
+
+def test_response_cache_reuses_responses(tmp_path: Path) -> None:
+	"Reading the same range of the same revision twice only asks Google once"
+
+	session = FakeSession()
+	client = CachingClient(None, ResponseCache(tmp_path / "cache.sqlite3"), session=session)  # type: ignore
+
+	first = client.request("get", VALUES_URL).json()
+	second = client.request("get", VALUES_URL).json()
+
+	assert first == second
+	assert client.hits == 1
+	assert client.misses == 1
+	# One revision lookup and one read
+	assert len(session.requests) == 2
+
+
+def test_response_cache_invalidates_on_revision(tmp_path: Path) -> None:
+	"A spreadsheet that was modified since is read again"
+
+	cache = ResponseCache(tmp_path / "cache.sqlite3")
+	session = FakeSession()
+	CachingClient(None, cache, session=session).request("get", VALUES_URL)  # type: ignore
+
+	session.modified_time = "2020-06-29T00:00:00Z"
+	client = CachingClient(None, cache, session=session)  # type: ignore
+	assert client.request("get", VALUES_URL).json() == {"values": [["fetched at 2020-06-29T00:00:00Z"]]}
+	assert client.misses == 1
+
+
+def test_response_cache_offline(tmp_path: Path) -> None:
+	"Offline mode replays what was saved, and fails on anything else, without ever asking Google"
+
+	cache = ResponseCache(tmp_path / "cache.sqlite3")
+	CachingClient(None, cache, session=FakeSession()).request("get", VALUES_URL)  # type: ignore
+
+	session = FakeSession()
+	client = CachingClient(None, cache, offline=True, session=session)  # type: ignore
+	assert client.request("get", VALUES_URL).json() == {"values": [["fetched at 2020-06-28T00:00:00Z"]]}
+
+	with raises(CacheMiss):
+		client.request("get", VALUES_URL, params={"valueRenderOption": "FORMULA"})
+
+	assert session.requests == []
@@ -0,0 +1,100 @@
+#    genre.guide - Sheet reading test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import Dict, Iterator
+
+from pytest import raises
+
+from ..sheet_to_db.sheet_reads import NO_FORMAT, LeanCellFormat, get_grid, read_ahead
+
+
+def test_read_ahead_keeps_order() -> None:
+	"Everything comes out in the same order it was produced in"
+
+	assert list(read_ahead(iter(range(1000)), buffer_size=10)) == list(range(1000))
+
+
+def test_read_ahead_raises() -> None:
+	"Errors on the producing thread are raised to whoever is reading"
+
+	def failing() -> Iterator[int]:
+		yield 1
+		raise ValueError("the sheet is on fire")
+
+	items = read_ahead(failing(), buffer_size=10)
+	assert next(items) == 1
+	with raises(ValueError):
+		next(items)
+
+
+def test_read_ahead_stops_early() -> None:
+	"The producing thread gives up once nobody is reading anymore"
+
+	produced = []
+
+	def endless() -> Iterator[int]:
+		for i in range(10 ** 9):
+			produced.append(i)
+			yield i
+
+	items = read_ahead(endless(), buffer_size=5)
+	assert next(items) == 0
+	items.close()  # type: ignore
+
+	from time import sleep
+	sleep(0.3)
+	count = len(produced)
+	sleep(0.3)
+	assert len(produced) == count
+
+
+def test_lean_cell_format() -> None:
+	"The flags and foreground color are decoded the same way gspread-formatting would"
+
+	cell_format = LeanCellFormat.from_props({
+		"textFormat": {"bold": True, "strikethrough": True, "foregroundColor": {"red": 1, "blue": 0.5}},
+	})
+
+	assert cell_format.bold
+	assert not cell_format.italic
+	assert cell_format.strikethrough
+	assert cell_format.foreground_hex == "#ff0080"
+
+	assert LeanCellFormat.from_props({}).foreground_hex == "#000000"
+
+
+class UnformattedSpreadsheet:
+	"Answers grid reads like the Sheets API does for cells that were never formatted: without an effectiveFormat"
+
+	def fetch_sheet_metadata(self, params: Dict[str, object]) -> object:
+		return {"sheets": [{"data": [{"rowData": [{"values": [{"formattedValue": "Ambient"}, {}]}]}]}]}
+
+
+class UnformattedWorksheet:
+	title = "Genres"
+	spreadsheet = UnformattedSpreadsheet()
+
+
+def test_get_grid_without_formats() -> None:
+	"Cells that come back without a format are plain instead of None"
+
+	grid = get_grid(UnformattedWorksheet(), row_start=1, col_start=1, row_end=1, col_end=2)
+
+	assert [cell.value for cell in grid[0]] == ["Ambient", ""]
+	assert all(cell.format is NO_FORMAT for cell in grid[0])
+	assert not grid[0][0].format.bold
+	assert grid[0][0].format.foreground_hex == "#000000"
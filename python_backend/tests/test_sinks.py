@@ -0,0 +1,198 @@
+#    genre.guide - Storage sinks test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, List
+
+from _pytest.monkeypatch import MonkeyPatch
+from pytest import raises
+
+from ..benchmarks.synthetic import NEWEST_RELEASE, OLDEST_RELEASE, track_sheets
+from ..sheet_to_db import tracks
+from ..sheet_to_db.batched_writes import BatchedWriter
+from ..sheet_to_db.fakes import FakeAPI
+from ..sheet_to_db.sinks import JSONLSink, LocalSink, LocalWrite, open_sink, SQLiteSink
+
+
+def test_sqlite_sink_round_trip(tmp_path: Path) -> None:
+	"Sets and deletes committed to SQLite come back out in the order they were made, with dates as ISO strings"
+
+	with SQLiteSink(tmp_path / "documents.sqlite3") as sink:
+		collection = sink.collection("tracks")
+
+		batch = sink.batch()
+		batch.set(collection.document("a"), {"title": "A", "releaseDate": datetime(2020, 6, 28)})
+		batch.set(collection.document("b"), {"title": "B"})
+		batch.delete(collection.document("b"))
+		batch.set(collection.document("c"), {"title": "C"})
+		batch.commit()
+
+		batch = sink.batch()
+		batch.set(collection.document("a"), {"title": "A again"})
+		batch.commit()
+
+		assert sorted(reference.id for reference in collection.list_documents()) == ["a", "c"]
+		assert sink.get("tracks", "a") == {"title": "A again"}
+		assert sink.get("tracks", "b") is None
+		assert sink.get("subgenres", "a") is None
+
+	with SQLiteSink(tmp_path / "documents.sqlite3") as sink:
+		assert sink.get("tracks", "c") == {"title": "C"}
+
+
+def test_jsonl_sink_round_trip(tmp_path: Path) -> None:
+	"Replaying a JSONL log gives the documents that are left after every set and delete"
+
+	with JSONLSink(tmp_path) as sink:
+		collection = sink.collection("subgenres")
+
+		batch = sink.batch()
+		batch.set(collection.document("Dubstep"), {"category": "Dubstep", "origins": []})
+		batch.set(collection.document("?"), {"category": "?"})
+		batch.commit()
+
+		batch = sink.batch()
+		batch.delete(collection.document("?"))
+		batch.commit()
+
+		assert sink.document_ids("subgenres") == ["Dubstep"]
+		assert sink.get("subgenres", "Dubstep") == {"category": "Dubstep", "origins": []}
+		assert sink.get("subgenres", "?") is None
+
+	assert len((tmp_path / "subgenres.jsonl").read_text(encoding="utf8").splitlines()) == 3
+
+
+def test_jsonl_sink_reads_what_others_append(tmp_path: Path) -> None:
+	"Reads pick up where the last one left off, including writes from another sink appending to the same log"
+
+	with JSONLSink(tmp_path) as sink, JSONLSink(tmp_path) as other_sink:
+		reference = sink.collection("subgenreTracks").document("Future%20Bass:2020:0")
+		assert not reference.get().exists
+
+		batch = other_sink.batch()
+		batch.set(other_sink.collection("subgenreTracks").document("Future%20Bass:2020:0"), {"trackIds": ["a"]})
+		batch.commit()
+		assert reference.get().to_dict() == {"trackIds": ["a"]}
+
+		batch = sink.batch()
+		batch.delete(reference)
+		batch.commit()
+		assert not other_sink.collection("subgenreTracks").document("Future%20Bass:2020:0").get().exists
+
+
+def test_jsonl_sink_get_gives_copies(tmp_path: Path) -> None:
+	"Changing a document that get gave back doesn't change what the sink has"
+
+	with JSONLSink(tmp_path) as sink:
+		batch = sink.batch()
+		batch.set(sink.collection("subgenres").document("Dubstep"), {"origins": ["Dub"]})
+		batch.commit()
+
+		document = sink.get("subgenres", "Dubstep")
+		assert document is not None
+		document["origins"] = []
+
+		assert sink.get("subgenres", "Dubstep") == {"origins": ["Dub"]}
+
+
+class ShortWrites:
+	"A file that only takes a few bytes at a time, like a write interrupted by a signal can"
+
+	def __init__(self, file: BinaryIO) -> None:
+		self._file = file
+
+	def write(self, data: bytes) -> int:
+		return self._file.write(data[:10])
+
+	def close(self) -> None:
+		self._file.close()
+
+
+class ShortWritingJSONLSink(JSONLSink):
+	def _file(self, collection: str) -> BinaryIO:
+		if collection not in self._files:
+			self._files[collection] = ShortWrites(super()._file(collection))  # type: ignore
+		return self._files[collection]
+
+
+def test_jsonl_sink_short_writes(tmp_path: Path) -> None:
+	"A batch still gets appended whole when the file takes less of it than it was given"
+
+	with ShortWritingJSONLSink(tmp_path) as sink:
+		batch = sink.batch()
+		for number in range(20):
+			batch.set(sink.collection("numbers").document(str(number)), {"number": number})
+		batch.commit()
+
+	with JSONLSink(tmp_path) as sink:
+		assert len(sink.document_ids("numbers")) == 20
+		assert sink.get("numbers", "19") == {"number": 19}
+
+
+def test_open_sink(tmp_path: Path) -> None:
+	"Sinks are chosen by kind:location, and anything else is refused"
+
+	assert isinstance(open_sink(f"sqlite:{tmp_path / 'documents.sqlite3'}"), SQLiteSink)
+	assert isinstance(open_sink(f"jsonl:{tmp_path}"), JSONLSink)
+
+	with raises(ValueError):
+		open_sink("sqlite")
+	with raises(ValueError):
+		open_sink("postgres:somewhere")
+
+
+def test_incomplete_local_sink() -> None:
+	"A local sink that's missing part of what every sink needs can't be made"
+
+	class WriteOnlySink(LocalSink):
+		def commit(self, writes: List[LocalWrite]) -> None:
+			pass
+
+	with raises(TypeError):
+		WriteOnlySink()  # type: ignore
+
+
+def test_batched_writer_into_sqlite(tmp_path: Path) -> None:
+	"BatchedWriter works with a local sink the same way as with Firestore"
+
+	with SQLiteSink(tmp_path / "documents.sqlite3") as sink:
+		collection = sink.collection("numbers")
+		with BatchedWriter(sink, batch_size=7, max_in_flight=3) as writer:
+			for number in range(100):
+				writer.set(collection.document(str(number)), {"number": number})
+
+		assert writer.committed_batches == 15
+		assert len(list(collection.list_documents())) == 100
+
+
+def test_track_sync_into_sqlite(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+	"Every track on the synthetic sheets ends up in a SQLite sink"
+
+	monkeypatch.setattr(tracks, "GENRE_SHEET_CATALOG_SHEET_NAME", "Main")
+
+	genre_sheet, subgenre_sheet = track_sheets(FakeAPI(), 1000, catalog_sheet_name="Main")
+
+	with SQLiteSink(tmp_path / "documents.sqlite3") as sink:
+		tracks.seed_firestore_with_track_data(sink, tracks.build_up_track_information(genre_sheet, subgenre_sheet, NEWEST_RELEASE, OLDEST_RELEASE))
+
+		track_ids = [reference.id for reference in sink.collection("tracks").list_documents()]
+		assert len(track_ids) == 1000
+
+		document = sink.get("tracks", track_ids[0])
+		assert document is not None
+		assert OLDEST_RELEASE.isoformat() <= str(document["releaseDate"])[:10] <= NEWEST_RELEASE.isoformat()
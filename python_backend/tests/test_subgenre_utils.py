@@ -0,0 +1,130 @@
+#    genre.guide - Subgenre family tree test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from typing import Set
+
+from pytest import raises
+
+from ..genre_utils import parse_genre
+from ..subgenre_utils import AliasIndex, subgenre_closure, SubgenreCycleError, SubgenreTable, topological_order
+
+
+ORIGINS = {
+	"Dubstep": ["UK Garage"],
+	"UK Garage": [],
+	"Hip Hop": [],
+	"Trap (EDM)": ["Hip Hop", "Dubstep"],
+	"Future Bass": ["Trap (EDM)", "Wonky"],
+	"Wonky": ["Hip Hop"],
+	"Brostep": ["Dubstep"],
+}
+
+
+def test_topological_order() -> None:
+	"Every subgenre comes after everything it comes from, including origins that aren't listed themselves"
+	order = topological_order({**ORIGINS, "Jungle Terror": ["Dutch House"]})
+
+	assert "Dutch House" in order
+	for subgenre, origins in ORIGINS.items():
+		for origin in origins:
+			assert order.index(origin) < order.index(subgenre)
+
+
+def test_subgenre_closure() -> None:
+	"Ancestors, descendants, depth, and root genres reach all the way through the family tree"
+	lineages = subgenre_closure(ORIGINS)
+
+	assert lineages["Future Bass"].ancestors == ("Dubstep", "Hip Hop", "Trap (EDM)", "UK Garage", "Wonky")
+	assert lineages["Future Bass"].descendants == ()
+	assert lineages["Future Bass"].depth == 3
+	assert lineages["Future Bass"].root_genres == ("Hip Hop", "UK Garage")
+
+	assert lineages["UK Garage"].descendants == ("Brostep", "Dubstep", "Future Bass", "Trap (EDM)")
+	assert lineages["UK Garage"].depth == 0
+	assert lineages["UK Garage"].root_genres == ("UK Garage",)
+
+
+def test_subgenre_closure_cycle() -> None:
+	"A family tree with a loop in it is reported instead of being written"
+	with raises(SubgenreCycleError) as error:
+		subgenre_closure({**ORIGINS, "UK Garage": ["Brostep"], "Hip Hop": []})
+
+	assert set(error.value.cycle) == {"UK Garage", "Dubstep", "Brostep"}
+
+
+ALIAS_INDEX = AliasIndex.build(
+	["Drum & Bass", "Dubstep", "Drumstep", "Trap (EDM)"],
+	{"DnB": "Drum & Bass", "D&B": "Drum & Bass", "Drum and Bass": "Drum & Bass", "EDM Trap": "Trap (EDM)", "drumstep": "Dubstep"},
+)
+
+
+def test_alias_index_resolve_name() -> None:
+	"Any name resolves to the primary name, no matter its case, spacing, or Unicode form"
+	assert ALIAS_INDEX.resolve_name("dnb") == "Drum & Bass"
+	assert ALIAS_INDEX.resolve_name("  Drum   and Bass ") == "Drum & Bass"
+	assert ALIAS_INDEX.resolve_name("ＤＮＢ") == "Drum & Bass"
+	assert ALIAS_INDEX.resolve_name("Trap (EDM)") == "Trap (EDM)"
+	assert ALIAS_INDEX.resolve_name("Brostep") is None
+	# A primary name isn't taken over by someone else's alias
+	assert ALIAS_INDEX.resolve_name("Drumstep") == "Drumstep"
+
+
+def test_alias_index_search_prefix() -> None:
+	"Prefix search gives back each matching subgenre once, in order of the names that matched"
+	assert ALIAS_INDEX.search_prefix("dr") == ["Drum & Bass", "Drumstep"]
+	assert ALIAS_INDEX.search_prefix("D", limit=1) == ["Drum & Bass"]
+	assert ALIAS_INDEX.search_prefix("Zz") == []
+
+
+def test_alias_index_shards(tmp_path: Path) -> None:
+	"The index survives being split into shards and saved"
+	data = ALIAS_INDEX.to_data(max_shard_size=2)
+	assert len(data["shards"]) == 4
+
+	ALIAS_INDEX.save(tmp_path / "alias_index.json", max_shard_size=2)
+	loaded = AliasIndex.load(tmp_path / "alias_index.json")
+	assert loaded.names == ALIAS_INDEX.names
+	assert loaded.revision == ALIAS_INDEX.revision
+
+
+SUBGENRE_TABLE = SubgenreTable.from_documents({
+	"Dubstep": {"names": ["Dubstep"], "category": "Dubstep", "backgroundColor": "#8c00ff", "textColor": "#ffffff"},
+	"Trap (EDM)": {"names": ["Trap (EDM)", "EDM Trap"], "category": "Trap", "backgroundColor": "#8c0028", "textColor": "#ffffff"},
+	"?": {"names": ["?"], "category": "?", "backgroundColor": "#000000", "textColor": "#ffffff"},
+})
+
+
+def test_subgenre_table_resolve_name() -> None:
+	"Any name resolves to its subgenre, and ? (Genre) resolves to Genre under its ? name"
+	assert SUBGENRE_TABLE.resolve_name("edm trap") == SUBGENRE_TABLE.subgenres["Trap (EDM)"]
+	assert SUBGENRE_TABLE.resolve_name("Trap") == SUBGENRE_TABLE.subgenres["Trap (EDM)"]
+	assert SUBGENRE_TABLE.resolve_name("? (Dubstep)") == {**SUBGENRE_TABLE.subgenres["Dubstep"], "name": "? (Dubstep)"}
+	assert SUBGENRE_TABLE.resolve_name("Wonky") is None
+
+
+def test_subgenre_table_resolve() -> None:
+	"Resolving keeps the nesting and operators of a parsed subgenre text, and shows unknown subgenres like ?"
+	unresolved: Set[str] = set()
+	resolved = SUBGENRE_TABLE.resolve(parse_genre("Dubstep | (EDM Trap > Wonky)"), unresolved)
+
+	assert resolved == [
+		SUBGENRE_TABLE.subgenres["Dubstep"],
+		"|",
+		[SUBGENRE_TABLE.subgenres["Trap (EDM)"], ">", {"name": "Wonky", "category": "?", "backgroundColor": "#000000", "textColor": "#ffffff"}],
+	]
+	assert unresolved == {"Wonky"}
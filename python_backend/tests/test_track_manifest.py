@@ -0,0 +1,139 @@
+#    genre.guide - Track manifest test suite
+#    Copyright (C) 2020 Navith
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from datetime import date, datetime
+from pathlib import Path
+
+from _pytest.capture import CaptureFixture
+
+from ..sheet_to_db.manifest import manifest_path_for, SubgenreManifest, TrackManifest
+from ..sheet_to_db.subgenres import report_tracks_to_reembed
+from ..track_utils import content_hash_for_track
+
+
+def test_content_hash_for_track() -> None:
+	"The hash only depends on the content, not on the order of the keys"
+
+	document = {"artist": "Porter Robinson", "title": "Musician", "releaseDate": datetime(2020, 4, 23)}
+	same_document = {"title": "Musician", "releaseDate": datetime(2020, 4, 23), "artist": "Porter Robinson"}
+	different_document = {**document, "title": "Mirror"}
+
+	assert content_hash_for_track(document) == content_hash_for_track(same_document)
+	assert content_hash_for_track(document) != content_hash_for_track(different_document)
+
+
+def test_track_manifest_round_trip(tmp_path: Path) -> None:
+	"Recorded hashes survive being saved and loaded again"
+
+	path = tmp_path / "manifest.json"
+	manifest = TrackManifest(path)
+	assert not manifest.is_unchanged("a", "1")
+
+	manifest.record("a", "1", "2020-06-28")
+	manifest.save()
+
+	loaded = TrackManifest(path)
+	assert loaded.is_unchanged("a", "1")
+	assert not loaded.is_unchanged("a", "2")
+
+
+def test_track_manifest_from_before_posting_lists(tmp_path: Path) -> None:
+	"Entries saved without subgenres load as being in no posting lists"
+
+	path = tmp_path / "manifest.json"
+	path.write_text('{"a": {"hash": "1", "releaseDate": "2020-06-28"}}', encoding="utf8")
+
+	manifest = TrackManifest(path)
+	assert manifest.entries["a"]["subgenres"] == []
+
+	manifest.record("a", "1", "2020-06-28", ["Future Bass"])
+	assert manifest.touched == {("Future Bass", "2020")}
+
+
+def test_track_manifest_unseen_between(tmp_path: Path) -> None:
+	"Only tracks in the date range that weren't seen this run are reported as gone"
+
+	manifest = TrackManifest(tmp_path / "manifest.json")
+	manifest.record("old", "1", "2020-05-01")
+	manifest.record("kept", "1", "2020-06-10")
+	manifest.record("gone", "1", "2020-06-20")
+	manifest.record("new", "1", "2020-07-01")
+	manifest.save()
+
+	manifest = TrackManifest(tmp_path / "manifest.json")
+	manifest.record("kept", "1", "2020-06-10")
+
+	assert manifest.unseen_between(date(2020, 6, 28), date(2020, 6, 1)) == {"gone"}
+
+	manifest.forget("gone")
+	assert manifest.unseen_between(date(2020, 6, 28), date(2020, 6, 1)) == set()
+
+
+def test_subgenre_manifest_changes(tmp_path: Path) -> None:
+	"Only subgenres whose documents are different count as changed, and the fields that changed are reported"
+
+	path = tmp_path / "subgenre_manifest.json"
+	manifest = SubgenreManifest(path)
+	assert manifest.record("Dubstep", {"category": "Dubstep", "origins": []})
+	assert manifest.record("Brostep", {"category": "Dubstep", "origins": ["Dubstep"]})
+	manifest.save()
+
+	manifest = SubgenreManifest(path)
+	assert not manifest.record("Dubstep", {"category": "Dubstep", "origins": []})
+	assert manifest.record("Riddim", {"category": "Dubstep", "origins": ["Dubstep"]})
+	assert manifest.unseen() == ["Brostep"]
+	manifest.forget("Brostep")
+	assert manifest.record("Dubstep", {"category": "Dubstep", "origins": [], "textColor": "#ffffff"})
+
+	assert manifest.added == ["Riddim"]
+	assert manifest.modified == {"Dubstep": ["textColor"]}
+	assert manifest.removed == ["Brostep"]
+	assert manifest.summary().startswith("1 added, 1 modified, 1 removed")
+
+
+def test_manifest_path_for() -> None:
+	"Every sink besides Firestore gets a manifest of its own"
+
+	path = Path("cache/track_manifest.json")
+
+	assert manifest_path_for(path, "firestore") == path
+	assert manifest_path_for(path, "sqlite:a.sqlite3") != manifest_path_for(path, "sqlite:b.sqlite3")
+	assert manifest_path_for(path, "jsonl:out").parent == path.parent
+
+
+def test_tracks_to_reembed(tmp_path: Path, capsys: CaptureFixture[str]) -> None:
+	"Tracks that embed a subgenre whose colors changed are reported (by any of its names) as a re-sync to run"
+
+	subgenre_manifest = SubgenreManifest(tmp_path / "subgenre_manifest.json")
+	subgenre_manifest.record("Future Bass", {"names": ["Future Bass", "FB"], "backgroundColor": "#9999ff"})
+	subgenre_manifest.record("Moombahton", {"names": ["Moombahton"], "backgroundColor": "#ffcc00"})
+	subgenre_manifest.save()
+
+	track_manifest = TrackManifest(tmp_path / "track_manifest.json")
+	track_manifest.record("a", "1", "2020-06-28", ["FB"])
+	track_manifest.record("b", "1", "2020-05-01", ["? (Future Bass)"])
+	track_manifest.record("c", "1", "2020-07-01", ["Moombahton"])
+	track_manifest.save()
+
+	subgenre_manifest = SubgenreManifest(tmp_path / "subgenre_manifest.json")
+	subgenre_manifest.record("Future Bass", {"names": ["Future Bass", "FB"], "backgroundColor": "#123456"})
+	subgenre_manifest.record("Moombahton", {"names": ["Moombahton"], "backgroundColor": "#ffcc00"})
+
+	assert report_tracks_to_reembed(subgenre_manifest, tmp_path / "track_manifest.json") == ("2020-06-28", "2020-05-01")
+	assert "--reembed" in capsys.readouterr().out
+
+	assert report_tracks_to_reembed(SubgenreManifest(tmp_path / "subgenre_manifest.json"), tmp_path / "track_manifest.json") is None
@@ -16,9 +16,18 @@
 
 
 from hashlib import blake2b
+from json import dumps
+from typing import Mapping
 
 
 def id_for_track(*, artist: str, title: str, release_date: str) -> str:
     # Probably the best traits to form a unique ID from
     song_id: str = "\n".join([artist, title, release_date])
     return blake2b(song_id.encode("utf8")).hexdigest()
+
+
+def content_hash_for_track(document: Mapping[str, object]) -> str:
+    # Sorted keys so the same content always serializes (and hashes) the same way
+    # default=str takes care of the release date being a datetime
+    serialized: str = dumps(document, sort_keys=True, default=str)
+    return blake2b(serialized.encode("utf8"), digest_size=16).hexdigest()
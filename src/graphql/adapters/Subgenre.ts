@@ -26,6 +26,9 @@ import {
 import { Subgenre } from "../object-types/Subgenre";
 
 const SUBGENRES_COLLECTION = "subgenres";
+// Written by the subgenre sync: every name of every subgenre, normalized, to its primary name
+const ALIAS_INDEX_COLLECTION = "subgenreNames";
+const ALIAS_INDEX_VERSION = 1;
 
 export const FirestoreToSubgenre = (documentData: firestore.DocumentData): Subgenre => plainToClass(Subgenre, documentData);
 
@@ -45,6 +48,44 @@ interface GetArgs {
 	cache?: boolean;
 }
 
+// Has to match normalize_name in python_backend/subgenre_utils.py
+const normalizeName = (name: string) => name.normalize("NFKC").replace(/\s+/g, " ").trim().toLowerCase();
+
+const loadAliasIndex = async (cache: boolean): Promise<Map<string, string> | undefined> => {
+	const indexData = (await getDocument(ALIAS_INDEX_COLLECTION, "index", cache)).data();
+	if (!indexData || indexData.version !== ALIAS_INDEX_VERSION) {
+		return undefined;
+	}
+
+	const shards = await Promise.all(
+		Array.from({ length: indexData.shards }, (_, shardNum) => getDocument(ALIAS_INDEX_COLLECTION, `shard-${shardNum}`, cache)),
+	);
+
+	const aliasIndex = new Map<string, string>();
+	shards.forEach((shard) => {
+		const shardData = shard.data();
+		if (shardData) {
+			shardData.keys.forEach((key: string, index: number) => aliasIndex.set(key, shardData.primaryNames[index]));
+		}
+	});
+	return aliasIndex;
+};
+
+let cachedAliasIndex: Promise<Map<string, string> | undefined> | undefined;
+const getAliasIndex = (cache: boolean) => {
+	if (!cache || !cachedAliasIndex) {
+		const aliasIndex = loadAliasIndex(cache);
+		// A failed load (like a passing Firestore error) shouldn't stick around until the next restart
+		aliasIndex.catch(() => {
+			if (cachedAliasIndex === aliasIndex) {
+				cachedAliasIndex = undefined;
+			}
+		});
+		cachedAliasIndex = aliasIndex;
+	}
+	return cachedAliasIndex;
+};
+
 const findSubgenre = (name: string) => db.collection(SUBGENRES_COLLECTION).where("names", "array-contains", name).limit(1).get();
 const memoizedFindSubgenre = memoize(findSubgenre);
 
@@ -61,6 +102,16 @@ export const getOne = async ({ anyName, cache = true, primaryName }: GetArgs & R
 		throw new TypeError("no subgenre name was specified");
 	}
 
+	// Resolve the name with the alias index when there is one, so that it's a dictionary lookup and a cached document read
+	const aliasIndex = await getAliasIndex(cache);
+	if (aliasIndex) {
+		const resolvedName = aliasIndex.get(normalizeName(anyName));
+		if (resolvedName === undefined) {
+			throw new TypeError(`the given subgenre ${anyName} does not exist`);
+		}
+		return getOne({ primaryName: resolvedName, cache });
+	}
+
 	const querySnapshot = await (cache ? memoizedFindSubgenre : findSubgenre)(anyName);
 	let document: Document | undefined;
 	querySnapshot.forEach((document_) => { document = document_; });
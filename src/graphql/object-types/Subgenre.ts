@@ -16,7 +16,7 @@
 	along with this program. If not, see <https://www.gnu.org/licenses/>.
 */
 
-import { Field, ObjectType } from "type-graphql";
+import { Field, Int, ObjectType } from "type-graphql";
 
 @ObjectType({ description: "A subgenre, as understood on the Genre Sheet" })
 export class Subgenre {
@@ -38,6 +38,18 @@ export class Subgenre {
     @Field((type) => [Subgenre], { name: "children", description: "The list of subgenres that originate *directly* from this subgenre, e.x. {Deathstep, Drumstep} for Dubstep, {} for Footwork, {Electro Swing, Jazzstep} for Nu-Jazz" })
     childrenSubgenres?: this[];
 
+    @Field((type) => [String], { description: "The primary names of every subgenre that this subgenre comes from, directly or not, e.x. {Dubstep, Hip Hop, Trap (EDM), UK Garage, Wonky} for Future Bass" })
+    ancestors!: string[];
+
+    @Field((type) => [String], { description: "The primary names of every subgenre that originates from this subgenre, directly or not" })
+    descendants!: string[];
+
+    @Field((type) => Int, { description: "The most steps it takes to get from this subgenre up to a subgenre without origins, e.x. 0 for Hip Hop" })
+    depth!: number;
+
+    @Field((type) => [String], { description: "The primary names of the subgenres without origins that this subgenre ultimately comes from" })
+    rootGenres!: string[];
+
     @Field((type) => String, { description: "The text color this subgenre uses on the Genre Sheet, in hex, e.x. '#000000' for Ambient" })
     textColor!: string;
 
@@ -46,4 +58,8 @@ export class Subgenre {
 
     @Field((type) => String, { nullable: true, description: "A paragraph describing of this subgenre. Currently, no descriptions are available for any subgenre, so this always returns undefined" })
     description?: string;
+
+    // Only on subgenres made from what a track embeds (names, category, and colors),
+    // which read the rest of their document by this primary name when it's asked for (see SubgenreResolver)
+    embeddedFrom?: string;
 }
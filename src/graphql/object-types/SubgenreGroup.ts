@@ -41,6 +41,16 @@ export class SubgenreGroup {
 }
 
 export type NestedStrings = (string | GenreSymbol | NestedStrings)[] | string | GenreSymbol;
+
+// What the sync embeds in a track for each subgenre (see ResolvedSubgenre in python_backend/subgenre_utils.py)
+export interface ResolvedSubgenre {
+	name: string;
+	category: string;
+	backgroundColor: string;
+	textColor: string;
+}
+export type NestedResolved = (ResolvedSubgenre | GenreSymbol | NestedResolved)[] | ResolvedSubgenre | GenreSymbol;
+
 export type NestedTypes = Subgenre | Operator | SubgenreGroup;
 
 export const SubgenreOrOperator = createUnionType({
@@ -75,6 +85,12 @@ const makeSubgenreKnown = (questionableSubgenre: string): [boolean, string] => {
 	return [false, questionableSubgenre];
 };
 
+// A copy of subgenre with the ? (Genre) name(s) reinstated
+const markUnknown = (subgenre: Subgenre): Subgenre => plainToClass(Subgenre, {
+	...subgenre,
+	names: subgenre.names.map((name) => `? (${name})`),
+});
+
 export const convertNestedStrings = async (nestedStrings: NestedStrings): Promise<NestedTypes> => {
 	if (Array.isArray(nestedStrings)) {
 		const promises = nestedStrings.map(convertNestedStrings);
@@ -91,9 +107,26 @@ export const convertNestedStrings = async (nestedStrings: NestedStrings): Promis
 	const anyName = knownSubgenre === "Trap" ? "Trap (EDM)" : knownSubgenre;
 
 	const subgenre = await getOneSubgenre({ anyName });
-	if (wasUnknown) {
-		// Reinstate the ? (Genre) name(s)
-		subgenre.names = subgenre.names.map((name) => `? (${name})`);
+	return wasUnknown ? markUnknown(subgenre) : subgenre;
+};
+
+export const convertNestedResolved = async (nestedResolved: NestedResolved): Promise<NestedTypes> => {
+	if (Array.isArray(nestedResolved)) {
+		const promises = nestedResolved.map(convertNestedResolved);
+		return new SubgenreGroup(await Promise.all(promises));
 	}
-	return subgenre;
+
+	// Operators come through as they are
+	if (typeof nestedResolved === "string") {
+		return convertNestedStrings(nestedResolved);
+	}
+
+	// Everything a track shows of a subgenre is embedded in it, so nothing is read unless more of the subgenre is asked for
+	const {
+		name, category, backgroundColor, textColor,
+	} = nestedResolved;
+	const [, primaryName] = makeSubgenreKnown(name);
+	return plainToClass(Subgenre, {
+		names: [name], category, backgroundColor, textColor, embeddedFrom: primaryName,
+	});
 };
@@ -46,6 +46,9 @@ export class Track {
 
 	subgenresNested!: string;
 
+	// subgenresNested with every subgenre's primary name, category, and colors filled in by the sync (missing on tracks from before it did that)
+	subgenresResolved?: string | null;
+
 	@Field((type) => SubgenreGroup, { name: "subgenresNested", description: "The subgenres and operators that make up this song, but recursive and hard to work with (though fully accurate and reflective of entries on the Genre Sheet and Subgenre Sheet)" })
 	subgenresNestedAsSubgenres?: SubgenreGroup;
 
@@ -23,6 +23,20 @@ import {
 import { getAll as getAllSubgenres, getOne as getOneSubgenre } from "../adapters/Subgenre";
 import { Subgenre } from "../object-types/Subgenre";
 
+// Subgenres made from what a track embeds only have their names, category, and colors,
+// so the rest of their (cached) document is read once something else about them is asked for
+const withDocument = async (subgenre: Subgenre): Promise<Subgenre> => {
+	if (subgenre.embeddedFrom === undefined) {
+		return subgenre;
+	}
+	try {
+		return await getOneSubgenre({ primaryName: subgenre.embeddedFrom });
+	} catch (e) {
+		// A subgenre the sync didn't know, or one that's gone since, goes the long way
+		return getOneSubgenre({ anyName: subgenre.embeddedFrom });
+	}
+};
+
 @Resolver(Subgenre)
 export class SubgenreResolver implements ResolverInterface<Subgenre> {
 	@Query((returns) => Subgenre, { description: "Get information about a subgenre from (one of its) exact name(s)" })
@@ -51,8 +65,9 @@ export class SubgenreResolver implements ResolverInterface<Subgenre> {
 	}
 
 	@FieldResolver()
-	parents(@Root() subgenre: Subgenre) {
-		const originsPromises = subgenre.origins.map(async (origin) => getOneSubgenre({ primaryName: origin }));
+	async parents(@Root() subgenre: Subgenre) {
+		const { origins } = await withDocument(subgenre);
+		const originsPromises = origins.map(async (origin) => getOneSubgenre({ primaryName: origin }));
 		try {
 			return Promise.all(originsPromises);
 		} catch (e) {
@@ -61,8 +76,9 @@ export class SubgenreResolver implements ResolverInterface<Subgenre> {
 	}
 
 	@FieldResolver()
-	childrenSubgenres(@Root() subgenre: Subgenre): Promise<Subgenre[]> {
-		const childrenPromises = subgenre.children.map(async (child) => getOneSubgenre({ primaryName: child }));
+	async childrenSubgenres(@Root() subgenre: Subgenre): Promise<Subgenre[]> {
+		const { children } = await withDocument(subgenre);
+		const childrenPromises = children.map(async (child) => getOneSubgenre({ primaryName: child }));
 		try {
 			return Promise.all(childrenPromises);
 		} catch (e) {
@@ -70,6 +86,26 @@ export class SubgenreResolver implements ResolverInterface<Subgenre> {
 		}
 	}
 
+	@FieldResolver()
+	async ancestors(@Root() subgenre: Subgenre) {
+		return (await withDocument(subgenre)).ancestors;
+	}
+
+	@FieldResolver()
+	async descendants(@Root() subgenre: Subgenre) {
+		return (await withDocument(subgenre)).descendants;
+	}
+
+	@FieldResolver()
+	async depth(@Root() subgenre: Subgenre) {
+		return (await withDocument(subgenre)).depth;
+	}
+
+	@FieldResolver()
+	async rootGenres(@Root() subgenre: Subgenre) {
+		return (await withDocument(subgenre)).rootGenres;
+	}
+
 	@FieldResolver()
 	async description(@Root() _subgenre: Subgenre) {
 		// TODO: allow for descriptions to exist
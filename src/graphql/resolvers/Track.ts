@@ -27,7 +27,9 @@ import { createTrackID, FirestoreToTrack, tracksCollectionRef } from "../adapter
 import { getDocument } from "../firestore";
 import type { Operator } from "../object-types/Operator";
 import type { Subgenre } from "../object-types/Subgenre";
-import { convertNestedStrings, NestedStrings, SubgenreGroup } from "../object-types/SubgenreGroup";
+import {
+	convertNestedResolved, convertNestedStrings, NestedTypes, SubgenreGroup,
+} from "../object-types/SubgenreGroup";
 import { Track } from "../object-types/Track";
 
 @ArgsType()
@@ -58,6 +60,16 @@ const queryLatestUncached = async (limit: number, newestFirst: boolean) => {
 
 const queryLatest = memoize(queryLatestUncached);
 
+// The subgenres the sync embedded in the track when there are any, or else the subgenres as they're written on the sheets
+const convertTrackSubgenres = (track: Track, flatten: boolean): Promise<NestedTypes> => {
+	if (track.subgenresResolved) {
+		const resolved = JSON.parse(track.subgenresResolved);
+		return convertNestedResolved(flatten ? resolved.flat(Infinity) : resolved);
+	}
+	const nested = JSON.parse(track.subgenresNested);
+	return convertNestedStrings(flatten ? nested.flat(Infinity) : nested);
+};
+
 // https://stackoverflow.com/a/9640417
 const hmsToSeconds = (hms: string): number => {
 	const parts = hms.split(":").reverse().map((n) => parseInt(n, 10));
@@ -116,13 +128,7 @@ export class TrackResolver implements ResolverInterface<Track> {
 	@FieldResolver()
 	async subgenresNestedAsSubgenres(@Root() track: Track) {
 		try {
-			const nested: NestedStrings = JSON.parse(track.subgenresNested);
-			if (Array.isArray(nested)) {
-				const promises = nested.map(convertNestedStrings);
-				const typed = await Promise.all(promises);
-				return new SubgenreGroup(typed);
-			}
-			const typed = await convertNestedStrings(nested);
+			const typed = await convertTrackSubgenres(track, false);
 			if (typed instanceof SubgenreGroup) {
 				return typed;
 			}
@@ -136,9 +142,7 @@ export class TrackResolver implements ResolverInterface<Track> {
 
 	@FieldResolver()
 	async subgenresFlat(@Root() track: Track) {
-		const nested = JSON.parse(track.subgenresNested);
-		const flat = nested.flat(Infinity);
-		const typed = await convertNestedStrings(flat) as unknown as SubgenreGroup;
+		const typed = await convertTrackSubgenres(track, true) as unknown as SubgenreGroup;
 		// eslint-disable-next-line no-underscore-dangle
 		return typed._elements as (Operator | Subgenre)[];
 	}